@@ -13,3 +13,5 @@ app = Flask(
 )
 
 from app import routes
+from app import freeze
+from app import watcher
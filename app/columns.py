@@ -0,0 +1,54 @@
+import datetime
+
+import numpy as np
+
+from app.darktable import Photo
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class PhotoColumns:
+    """ Columnar representation of a list of photos with NumPy arrays,
+        so that computations over whole galleries aren't done photo by photo.
+        Timestamps are microseconds since the unix epoch.
+    """
+
+    def __init__(self, photos: list[Photo]):
+        self.photos = photos
+        self.timestamps = datetimes_to_timestamps([photo.datetime_taken for photo in photos])
+        self.film_roll_ids = np.fromiter((photo.film_roll.id for photo in photos),
+                                         dtype=np.int64, count=len(photos))
+
+    def film_roll_midpoints(self) -> np.ndarray:
+        """ Returns for each photo the timestamp halfway between
+            the earliest and the latest photo of its film roll (among these photos),
+            rounded half to even like dividing a timedelta.
+        """
+        if len(self.photos) == 0:
+            return np.empty(0, dtype=np.int64)
+        film_roll_ids, inverse = np.unique(self.film_roll_ids, return_inverse=True)
+        lo = np.full(len(film_roll_ids), np.iinfo(np.int64).max)
+        hi = np.full(len(film_roll_ids), np.iinfo(np.int64).min)
+        np.minimum.at(lo, inverse, self.timestamps)
+        np.maximum.at(hi, inverse, self.timestamps)
+        half, odd = np.divmod(hi - lo, 2)
+        return (lo + half + (odd & half & 1))[inverse]
+
+    def date_order(self, date_keys: np.ndarray) -> np.ndarray:
+        """ Returns the indices of the photos ordered by the given timestamps,
+            latest first, and then by the time they were taken, earliest first.
+            Photos that are equal in both keep their order.
+        """
+        return np.lexsort((self.timestamps, -date_keys))
+
+
+def datetimes_to_timestamps(datetimes: list[datetime.datetime]) -> np.ndarray:
+    # numpy's own conversion of datetime objects is slower than this
+    return np.fromiter(((dt - EPOCH) // MICROSECOND for dt in datetimes),
+                       dtype=np.int64, count=len(datetimes))
+
+
+def timestamps_to_datetimes(timestamps: np.ndarray) -> list[datetime.datetime]:
+    return timestamps.astype('datetime64[us]').tolist()
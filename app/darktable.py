@@ -1,28 +1,46 @@
+import io
 import re
 import os
+import json
+import zlib
+import base64
+import struct
+import atexit
+import shutil
 import subprocess
 import tempfile
+import hashlib
 import datetime
 import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 from dateutil.relativedelta import relativedelta
-from pathlib import Path
 from collections import defaultdict
-from xml.etree import ElementTree
 from xml.etree.ElementTree import Element
 from io import TextIOWrapper
 from os import path
 from typing import Callable
+import numpy as np
 from PIL import Image
 
-import exif
+try:
+    # optional, registers an AVIF encoder with Pillow
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
 
+from app.metadata import rewrite_exif
+from app.metrics import metrics
 from app.util import Cache, filehash, readonly_sqlite_connection, fullname
+from app.scheduler import ExportScheduler
+from app.xmp import XMP_NAMESPACES, XmpChange, XmpTransform, clark_name, parse_xmp, xmp_visitor
 from app.vendor.args_hash import args_hash
 from app.config import config
 
 
 MODULE_DIR = path.abspath(path.dirname(__file__))
-CACHE_FILENAME = os.path.splitext(__file__)[0] + '.cache.pkl'
+CACHE_FILENAME = path.abspath(config.get('EXPORT_CACHE_FILE') or os.path.splitext(__file__)[0] + '.cache.sqlite')
 
 
 Position = int
@@ -58,7 +76,9 @@ class Tag(HasId):
 
 class Photo(HasId):
     def __init__(self, id, filepath, version, datetime_taken: datetime.datetime,
-                 tags: dict[Tag, Position], film_roll: FilmRoll, position: Position):
+                 tags: dict[Tag, Position], film_roll: FilmRoll, position: Position,
+                 width: int = 0, height: int = 0, orientation: int = 0,
+                 change_timestamp: int = 0):
         self.id: int = id
         self.filepath: str = filepath
         self.version: int = version
@@ -66,6 +86,12 @@ class Photo(HasId):
         self.tags: dict[Tag, Position] = tags
         self.film_roll: FilmRoll = film_roll
         self.position: Position = position
+        # dimensions and orientation of the raw file, as stored in the library
+        self.width: int = width
+        self.height: int = height
+        self.orientation: int = orientation
+        # changes whenever the photo is edited in darktable
+        self.change_timestamp: int = change_timestamp
 
     @property
     def xmp_path(self):
@@ -86,6 +112,10 @@ class Photo(HasId):
                 repr(self.tags),
                 repr(self.film_roll),
                 repr(self.position),
+                repr(self.width),
+                repr(self.height),
+                repr(self.orientation),
+                repr(self.change_timestamp),
             ]) + ')'
 
 
@@ -94,9 +124,11 @@ def parse_format_options(options_list: str):
 
 
 class Export:
-    def __init__(self, photo: Photo, filepath: str):
+    def __init__(self, photo: Photo, filepath: str, digest: str = None):
         self.photo: Photo = photo
         self.filepath: str = filepath
+        # identifies the contents of the export, see Exporter.export_digest()
+        self.digest: str = digest
 
     @property
     def filepath(self):
@@ -132,10 +164,71 @@ class Export:
         return f'Export({self.filepath}, {self.photo})'
 
 
+def stat_signature(filepath):
+    stat = os.stat(filepath)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class PhotoManifest:
+    """ Record of the source files of photos that is shared by all exporters.
+        Every photo is mapped to a digest of its raw file's identity
+        (size and mtime) and the contents of its XMP sidecar.
+        The XMP is only hashed again when its size or mtime changed,
+        so looking up an unchanged photo costs a single stat() of the XMP.
+        The raw file is checked again whenever the XMP changed
+        and once per process.
+    """
+
+    def __init__(self, cache_filepath):
+        self.cache = Cache(cache_filepath, prefix='manifest:')
+        # xmp path -> (xmp signature, raw signature, xmp hash, source digest)
+        self._entries: dict[str, tuple] = {}
+
+    def _lookup(self, photo: Photo) -> tuple:
+        xmp_path = photo.xmp_path
+        xmp_signature = stat_signature(xmp_path)
+        entry = self._entries.get(xmp_path)
+        if entry is not None and entry[0] == xmp_signature:
+            return entry
+
+        stored = self.cache.load(xmp_path) if entry is None else entry
+        if stored is not None and stored[0] == xmp_signature:
+            xmp_hash = stored[2]
+        else:
+            with metrics.timer('xmp_hash'):
+                xmp_hash = filehash(xmp_path)
+        raw_signature = stat_signature(photo.filepath)
+        digest = hashlib.sha1(repr((raw_signature, xmp_hash)).encode()).hexdigest()
+        entry = (xmp_signature, raw_signature, xmp_hash, digest)
+        if entry != stored:
+            self.cache.save(xmp_path, entry)
+        self._entries[xmp_path] = entry
+        return entry
+
+    def xmp_hash(self, photo: Photo) -> str:
+        return self._lookup(photo)[2]
+
+    def source_digest(self, photo: Photo) -> str:
+        return self._lookup(photo)[3]
+
+
+photo_manifest = PhotoManifest(CACHE_FILENAME)
+
+
+# prefix of the raw files of a batch, by which exported files are mapped to photos
+BATCH_MARKER = '~batch{}~'
+BATCH_MARKER_PATTERN = re.compile(r'~batch(\d+)~')
+# batches are exported within the output directory, so their files
+# are moved into place atomically, sync() leaves these directories alone
+BATCH_DIR_PREFIX = '.darktable-batch-'
+
+
 class Exporter:
     def __init__(self, *, cache_key, cli_bin, config_dir, filename_format,
                  out_ext, format_options, hq_resampling, width, height,
-                 debug=False, xmp_changes=[]):
+                 debug=False, xmp_changes=[], scheduler: ExportScheduler = None,
+                 placeholders=False, batch_size=1):
+        self.name = cache_key
         self.cli_bin = cli_bin
         self.config_dir = config_dir
         self.filename_format = filename_format
@@ -146,75 +239,350 @@ class Exporter:
         self.height = height
         self.debug = debug
         self.xmp_changes = xmp_changes
-        _, self.tmp_xmp_name = tempfile.mkstemp(suffix='.xmp')
-
-        self.args_hash = args_hash(
-            cli_bin=str(cli_bin),
-            config_dir=str(config_dir),
-            filename_format=str(filename_format),
-            out_ext=str(out_ext),
-            format_options=str(format_options),
-            hq_resampling=str(hq_resampling),
-            width=str(width),
-            height=str(height),
-            xmp_changes=str([fullname(func) for func in xmp_changes])
-        )
+        self.xmp_transform = XmpTransform.for_changes(xmp_changes)
+        self.scheduler = scheduler or ExportScheduler()
+        # whether placeholders are created right after exporting
+        self.placeholders = placeholders
+        # number of photos that one darktable-cli process exports at most,
+        # see submit_export_cached_many()
+        self.batch_size = batch_size
+
+        self.args_hash = args_hash(**self._hashed_arguments())
         self.cache = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix=f'{cache_key}:main:')
-        self.cache_xmp_hashes = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix=f'{cache_key}:xmp:')
-        self.cache_exported = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix=f'{cache_key}:export:')
-        if self.args_hash != self.cache.load('args_hash'):
-            self.cache_exported.prune()
-            self.cache_xmp_hashes.prune()
-        self.cache.save('args_hash', self.args_hash)
-
+        # export digest -> export file path
+        self.cache_exported = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix=f'{cache_key}:digest:')
+        # export digest -> size of the export file in bytes
+        self.cache_sizes = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix=f'{cache_key}:size:')
+        # photo -> file path of its most recent export, which might be outdated
+        self.cache_latest = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix=f'{cache_key}:latest:')
+        # export file path -> placeholder of the export, see create_placeholder()
+        self.cache_placeholders = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix=f'{cache_key}:placeholder:')
+        with self.cache.transaction():
+            if self.args_hash != self.cache.load('args_hash'):
+                self.cache_exported.prune()
+                self.cache_sizes.prune()
+                self.cache_placeholders.prune()
+            self.cache.save('args_hash', self.args_hash)
+
+        # files of this session (see sync()), which workers add to concurrently
         self._sess_exported = set()
+        self._sess_lock = threading.Lock()
+        # exports that are known to exist, by digest
+        self._verified: dict[str, str] = {}
+        self._sizes: dict[str, int] = {}
+        self._placeholders: dict[str, tuple[str, str]] = {}
+
+    def _add_to_session(self, export_filepath: str):
+        with self._sess_lock:
+            self._sess_exported.add(export_filepath)
 
-    def __del__(self):
-        os.unlink(self.tmp_xmp_name)
+    def _hashed_arguments(self) -> dict[str, str]:
+        """ All arguments that affect the exported files.
+            Cached exports are discarded when any of these change.
+        """
+        return dict(
+            cli_bin=str(self.cli_bin),
+            config_dir=str(self.config_dir),
+            filename_format=str(self.filename_format),
+            out_ext=str(self.out_ext),
+            format_options=str(self.format_options),
+            hq_resampling=str(self.hq_resampling),
+            width=str(self.width),
+            height=str(self.height),
+            xmp_changes=str([fullname(func) for func in self.xmp_changes])
+        )
+
+    def submit_export_cached(self, photo: Photo, out_dir: str, priority: tuple = None) -> Future:
+        """ Schedules export_cached() on the exporter's scheduler.
+            Requests for the same photo that are still pending
+            share a single export job, which is promoted
+            if it is requested with a lower priority (see ExportScheduler).
+        """
+        return self.scheduler.submit(self._job_key(photo), self.export_cached, photo, out_dir,
+                                     priority=priority)
+
+    def submit_export_cached_many(self, photos: list[Photo], out_dir: str,
+                                  priority: tuple = None) -> list[Future]:
+        """ Schedules export_cached() for all photos.
+            Photos that need to be exported are grouped into batches
+            of up to batch_size photos, each batch is developed
+            by a single darktable-cli process (see export_cached_batch()).
+            The batches are shared with submit_export_cached() of the same photos.
+            Returns the futures in the order of the given photos.
+        """
+        if self.batch_size <= 1:
+            return [self.submit_export_cached(photo, out_dir, priority) for photo in photos]
+        futures: list[Future] = [None] * len(photos)
+        missing = []
+        for i, photo in enumerate(photos):
+            if self._load_export(photo, self.export_digest(photo)) is None:
+                missing.append(i)
+            else:
+                futures[i] = self.submit_export_cached(photo, out_dir, priority)
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            batch_futures = self.scheduler.submit_batch(
+                [(self._job_key(photos[i]), photos[i]) for i in batch],
+                self.export_cached_batch, out_dir, priority=priority)
+            for i, future in zip(batch, batch_futures):
+                futures[i] = future
+        return futures
+
+    def _job_key(self, photo: Photo):
+        return (self.name, self._photo_key(photo))
+
+    def _photo_key(self, photo: Photo):
+        return f'{photo.filepath}:{photo.version}'
+
+    def export_cached_many(self, photos: list[Photo], out_dir: str) -> list[Export]:
+        """ Exports all photos concurrently and waits until all are done.
+            Returns the exports in the order of the given photos.
+        """
+        futures = self.submit_export_cached_many(photos, out_dir)
+        return [future.result() for future in futures]
+
+    def export_digest(self, photo: Photo, source_digest: str = None) -> str:
+        """ Identifies the export of a photo by its source files
+            and the arguments of this exporter.
+            A source digest that was already looked up
+            (see PhotoManifest.source_digest()) saves looking it up again.
+        """
+        source_digest = source_digest or photo_manifest.source_digest(photo)
+        return hashlib.sha1(f'{source_digest}:{self.args_hash}'.encode()).hexdigest()
 
     def export_cached(self, photo: Photo, out_dir: str) -> Export:
         """ Exports a photo to a directory through Darktable's CLI interface,
-            but only if there are changes to the XMP
+            but only if its raw file or XMP changed
             or it hasn't been exported yet.
             Returns a copy of the photo instance where export_filepath is set.
         """
 
-        # TODO hash the class instead and return this identifier
-        cache_key = f'{photo.filepath}:{photo.version}'
-
-        xmp_hash = filehash(photo.xmp_path)
-        export_filepath = self.cache_exported.load(cache_key)
-        if export_filepath is not None and path.exists(export_filepath):
-            self._sess_exported.add(export_filepath)
-            if xmp_hash == self.cache_xmp_hashes.load(cache_key):
-                return Export(photo, filepath=export_filepath)
+        digest = self.export_digest(photo)
+        export = self._load_export(photo, digest)
+        if export is not None:
+            metrics.count('export_cache_hits', media_size=self.name)
+            return export
+        metrics.count('export_cache_misses', media_size=self.name)
 
         export = self.export(photo, out_dir=out_dir)
+        return self._record_export(photo, digest, export)
 
-        self.cache_xmp_hashes.save(cache_key, xmp_hash)
-        self.cache_exported.save(cache_key, export.filepath)
+    def export_cached_batch(self, photos: list[Photo], out_dir: str) -> list[Export]:
+        """ Like export_cached() for several photos, but all photos
+            that need to be exported are exported with one darktable-cli process.
+            If that fails, they are exported one by one.
+        """
+        exports: list[Export] = [None] * len(photos)
+        missing = []
+        for i, photo in enumerate(photos):
+            exports[i] = self._load_export(photo, self.export_digest(photo))
+            if exports[i] is not None:
+                metrics.count('export_cache_hits', media_size=self.name)
+            else:
+                missing.append(i)
+        if len(missing) > 1:
+            try:
+                export_filepaths = self._export_batch([photos[i] for i in missing], out_dir)
+            except Exception as e:
+                # e.g. a darktable-cli that does not support multiple input files
+                if self.debug:
+                    print(f'exporting {len(missing)} photos at once failed, exporting them one by one: {e}')
+            else:
+                metrics.count('export_cache_misses', len(missing), media_size=self.name)
+                for i, export_filepath in zip(missing, export_filepaths):
+                    export = self._finish_export(photos[i], export_filepath)
+                    exports[i] = self._record_export(photos[i], self.export_digest(photos[i]), export)
+        for i in missing:
+            if exports[i] is None:
+                exports[i] = self.export_cached(photos[i], out_dir)
+        return exports
+
+    def _record_export(self, photo: Photo, digest: str, export: Export) -> Export:
+        export.digest = digest
+        placeholder = create_placeholder(export.filepath) if self.placeholders else None
+
+        with self.cache.transaction():
+            # the file now belongs to this digest only
+            previous_digests = [key for key in self.cache_exported.keys(has_value=export.filepath)
+                                if key != digest]
+            self.cache_exported.delete_many(previous_digests)
+            self.cache_sizes.delete_many(previous_digests)
+            self.cache_exported.save(digest, export.filepath)
+            self.cache_sizes.save(digest, path.getsize(export.filepath))
+            self.cache_latest.save(self._photo_key(photo), export.filepath)
+            # the placeholder of the file's previous contents is outdated
+            if placeholder is not None:
+                self.cache_placeholders.save(export.filepath, placeholder)
+            else:
+                self.cache_placeholders.delete_many([export.filepath])
+        if placeholder is not None:
+            self._placeholders[export.filepath] = placeholder
+        else:
+            self._placeholders.pop(export.filepath, None)
+        for previous_digest in previous_digests:
+            self._verified.pop(previous_digest, None)
+            self._sizes.pop(previous_digest, None)
+        self._verified[digest] = export.filepath
 
         return export
 
+    def export_size(self, export: Export) -> int:
+        """ Returns the recorded size of an up to date export in bytes.
+        """
+        size = self._sizes.get(export.digest)
+        if size is None:
+            size = self.cache_sizes.load(export.digest)
+            if size is None:
+                size = path.getsize(export.filepath)
+            self._sizes[export.digest] = size
+        return size
+
+    def placeholder(self, export: Export) -> tuple[str, str]:
+        """ Returns the placeholder of an export as (data uri, colour),
+            see create_placeholder(). It's created once per export file
+            and kept until the file is exported again.
+        """
+        placeholder = self._placeholders.get(export.filepath)
+        if placeholder is None:
+            placeholder = self.cache_placeholders.load(export.filepath)
+            if placeholder is None:
+                placeholder = create_placeholder(export.filepath)
+                self.cache_placeholders.save(export.filepath, placeholder)
+            self._placeholders[export.filepath] = placeholder
+        return placeholder
+
+    def _load_export(self, photo: Photo, digest: str) -> Export:
+        export_filepath = self._verified.get(digest)
+        if export_filepath is not None:
+            self._add_to_session(export_filepath)
+            return Export(photo, filepath=export_filepath, digest=digest)
+
+        export_filepath = self.cache_exported.load(digest)
+        if export_filepath is not None and path.exists(export_filepath):
+            self._add_to_session(export_filepath)
+            self._verified[digest] = export_filepath
+            return Export(photo, filepath=export_filepath, digest=digest)
+        return None
+
+    def find_export(self, photo: Photo, source_digest: str = None) -> tuple[Export, bool]:
+        """ Returns the most recent export of a photo without exporting it
+            and whether that export is up to date.
+            The export is None if the photo has not been exported yet.
+        """
+        export = self._load_export(photo, self.export_digest(photo, source_digest))
+        if export is not None:
+            return export, True
+        export_filepath = self.cache_latest.load(self._photo_key(photo))
+        if export_filepath is not None and path.exists(export_filepath):
+            return Export(photo, filepath=export_filepath), False
+        return None, False
+
     def export(self, photo: Photo, out_dir: str) -> Export:
         """ Exports a photo to a directory through Darktable's CLI interface.
             Returns a copy of the photo instance where export_filepath is set.
         """
+        return self._finish_export(photo, self._export_single(photo, out_dir))
+
+    def _finish_export(self, photo: Photo, export_filepath: str) -> Export:
+        self._add_to_session(export_filepath)
+
+        # replace all metadata with personal details,
+        # only the original date and time is kept
+        with metrics.timer('exif_rewrite', media_size=self.name):
+            rewrite_exif(export_filepath,
+                         artist=config['EXIF_SET_ARTIST'],
+                         copyright=config['EXIF_SET_COPYRIGHT'])
+
+        return Export(photo, filepath=export_filepath)
 
+    def _export_single(self, photo: Photo, out_dir: str) -> str:
+        """ Exports a photo with its own darktable-cli process.
+            Returns the path of the exported file.
+        """
         xmp_path = photo.xmp_path
+        tmp_xmp_name = None
 
         if len(self.xmp_changes) > 0:
-            with open(self.tmp_xmp_name, 'w') as tmp_xmp_file:
-                modify_xmp(xmp_path, tmp_xmp_file, changes=self.xmp_changes)
-            xmp_path = self.tmp_xmp_name
+            # every job needs its own file, exports may run concurrently
+            fd, tmp_xmp_name = tempfile.mkstemp(suffix='.xmp')
+            with os.fdopen(fd, 'wb') as tmp_xmp_file:
+                tmp_xmp_file.write(self.xmp_transform.transform(xmp_path, photo_manifest.xmp_hash(photo)))
+            xmp_path = tmp_xmp_name
 
+        if self.debug:
+            print('xmp:', photo.xmp_path)
+        try:
+            return self._run_cli([photo.filepath, xmp_path], out_dir, count=1)[0]
+        finally:
+            if tmp_xmp_name is not None:
+                os.unlink(tmp_xmp_name)
+
+    def _export_batch(self, photos: list[Photo], out_dir: str) -> list[str]:
+        """ Exports several photos with a single darktable-cli process.
+            darktable-cli only accepts one XMP for all inputs,
+            so every raw file is linked into the batch directory
+            next to its (changed) XMP, which darktable reads as the sidecar.
+            The links are marked with the photo's index, by which the exported
+            files are moved to where export() would have written them,
+            replacing previous exports atomically.
+            Raises a RuntimeError if the files can't be mapped unambiguously.
+            Returns the paths of the exported files in the order of the photos.
+        """
+        if '$(FILE.NAME)' not in self.filename_format:
+            raise RuntimeError('batches need $(FILE.NAME) in the filename format')
+        os.makedirs(out_dir, exist_ok=True)
+        # on the same file system as the exports, see os.replace() below
+        batch_dir = tempfile.mkdtemp(prefix=BATCH_DIR_PREFIX, dir=out_dir)
+        try:
+            inputs = []
+            for i, photo in enumerate(photos):
+                input_path = path.join(batch_dir, BATCH_MARKER.format(i) + path.basename(photo.filepath))
+                try:
+                    os.link(photo.filepath, input_path)
+                except OSError:
+                    os.symlink(path.abspath(photo.filepath), input_path)
+                if len(self.xmp_changes) > 0:
+                    with open(input_path + '.xmp', 'wb') as f:
+                        f.write(self.xmp_transform.transform(photo.xmp_path, photo_manifest.xmp_hash(photo)))
+                else:
+                    shutil.copyfile(photo.xmp_path, input_path + '.xmp')
+                inputs.append(input_path)
+                if self.debug:
+                    print('xmp:', photo.xmp_path)
+            # files of other exports in out_dir can't collide with the batch
+            batch_out_dir = path.join(batch_dir, 'out')
+            batch_filepaths: list[str] = [None] * len(photos)
+            export_filepaths: list[str] = [None] * len(photos)
+            for filepath in self._run_cli(inputs, batch_out_dir, count=len(photos)):
+                filename = path.basename(filepath)
+                match = BATCH_MARKER_PATTERN.search(filename)
+                if match is None or int(match.group(1)) >= len(photos) \
+                        or export_filepaths[int(match.group(1))] is not None:
+                    raise RuntimeError(f'exported file does not belong to the batch: {filepath}')
+                relative_dir = path.relpath(path.dirname(filepath), batch_out_dir)
+                batch_filepaths[int(match.group(1))] = filepath
+                export_filepaths[int(match.group(1))] = path.normpath(path.join(
+                    out_dir, relative_dir, filename.replace(match.group(0), '', 1)))
+            # e.g. duplicates of a raw file, whose exports have the same name
+            if None in export_filepaths or len(set(export_filepaths)) != len(photos):
+                raise RuntimeError('exported files of the batch are ambiguous')
+            for filepath, export_filepath in zip(batch_filepaths, export_filepaths):
+                os.makedirs(path.dirname(export_filepath), exist_ok=True)
+                os.replace(filepath, export_filepath)
+            return export_filepaths
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    def _run_cli(self, inputs: list[str], out_dir: str, count: int) -> list[str]:
+        """ Runs darktable-cli with the given input files (and XMP)
+            and returns the paths of the exported files.
+        """
         out_path = path.join(out_dir, self.filename_format)
         # https://docs.darktable.org/usermanual/4.0/en/special-topics/program-invocation/darktable-cli
         # https://docs.darktable.org/usermanual/4.0/en/special-topics/program-invocation/darktable
         command = [
             self.cli_bin,
-            photo.filepath,
-            xmp_path,
+            *inputs,
             out_path,
             f'--width', str(self.width),
             f'--height', str(self.height),
@@ -223,74 +591,287 @@ class Exporter:
             f'--upscale', 'false',
             f'--apply-custom-presets', 'false',
             f'--core', # everything after this are darktable core parameters
-            f'--configdir', self.config_dir,
         ]
         for option in self.format_options:
             command.append('--conf')
             command.append(f'plugins/imageio/format/{option}')
 
-        if self.debug:
-            print('xmp:', photo.xmp_path)
-            print(' '.join([f"'{word}'" for word in command]))
-
-        result = subprocess.run(command, capture_output=True, text=True)
+        with self._job_config_dir() as config_dir:
+            command += ['--configdir', config_dir]
+            if self.debug:
+                print(' '.join([f"'{word}'" for word in command]))
+            with metrics.timer('darktable_cli', media_size=self.name):
+                result = subprocess.run(command, capture_output=True, text=True)
+        metrics.count('darktable_cli_photos', count, media_size=self.name)
         if self.debug:
             print(result.stdout.rstrip())
 
-        # extract the exported filename
-        match = re.search(r'exported to `([^\']+)\'', result.stdout)
-        if not match:
+        # extract the exported filenames, in the order of the inputs
+        export_filepaths = re.findall(r'exported to `([^\']+)\'', result.stdout)
+        if len(export_filepaths) == 0:
             raise RuntimeError('expected darktable-cli output to contain filename')
-
-        export_filepath = match.groups()[0]
-        self._sess_exported.add(export_filepath)
-
-        # save personal details in exif
-        with open(export_filepath, 'rb') as image_file:
-            original_exif_image = exif.Image(image_file)
-
-        # remove exif data
-        image = Image.open(export_filepath)
-        data = list(image.getdata())
-        image_noexif = Image.new(image.mode, image.size)
-        image_noexif.putdata(data)
-        image_noexif.save(export_filepath)
-        image_noexif.close()
-
-        # save personal details in exif
-        with open(export_filepath, 'rb') as image_file:
-            exif_image = exif.Image(image_file)
-        exif_image.set('artist', config['EXIF_SET_ARTIST'])
-        exif_image.set('copyright', config['EXIF_SET_COPYRIGHT'])
-        exif_image.set('datetime_original', original_exif_image.get('datetime_original'))
-        with open(export_filepath, 'wb') as image_file:
-            image_file.write(exif_image.get_file())
-
-        return Export(photo, filepath=export_filepath)
-
-    def sync(self, directory):
+        if len(export_filepaths) != count:
+            raise RuntimeError(f'expected darktable-cli to export {count} files, '
+                               f'but it exported {len(export_filepaths)}')
+        return export_filepaths
+
+    @contextmanager
+    def _job_config_dir(self):
+        if self.scheduler.workers <= 1:
+            yield self.config_dir
+        else:
+            with config_dir_copies.lease(self.config_dir) as copy_dir:
+                yield copy_dir
+
+    def sync(self, directory, dry_run=False) -> 'SyncReport':
         """ Removes all files in the given directory, except:
             - Files that have been exported during this session and
             - Files that would have been exported but already existed.
+            Cache entries of exports in the directory that are not part
+            of the session are removed as well, in a single transaction.
+            With dry_run nothing is removed, the report lists what would be.
             The current session starts at object creation
             and is reset (cleared) whenever sync() is called.
         """
-        for filepath_obj in Path(directory).glob('**/*'):
-            filepath = str(filepath_obj)
-            if filepath_obj.is_file() and filepath not in self._sess_exported:
-                if not is_raw_photo_ext(path.splitext(filepath)[1]):
-                    # Remove all data associated with the photo from the cache
-                    # and delete the exported photo from the directory.
-                    for cache_key in self.cache_exported.keys(has_value=filepath):
-                        print(f'Removed from portfolio: {cache_key}')
-                        self.cache_exported.delete(cache_key)
-                        self.cache_xmp_hashes.delete(cache_key)
-                    try:
-                        os.remove(filepath)
-                    except Exception:
-                        pass
-
-        self._sess_exported.clear()
+        directory = path.abspath(directory)
+
+        files = set()
+        for dirpath, dirnames, filenames in os.walk(directory):
+            # batches that are being exported (see _export_batch())
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(BATCH_DIR_PREFIX)]
+            for filename in filenames:
+                if not is_raw_photo_ext(path.splitext(filename)[1]):
+                    files.add(path.join(dirpath, filename))
+
+        # the session is taken after the walk and kept until it's reset,
+        # so files that are exported meanwhile are never removed
+        with self._sess_lock:
+            live = set(path.abspath(filepath) for filepath in self._sess_exported)
+
+            def is_stale(filepath):
+                filepath = path.abspath(filepath)
+                return filepath.startswith(directory + os.sep) and filepath not in live
+
+            stale_cache_keys = [digest for digest, filepath in self.cache_exported.items() if is_stale(filepath)]
+            stale_latest_keys = [key for key, filepath in self.cache_latest.items() if is_stale(filepath)]
+            stale_placeholder_keys = [filepath for filepath in self.cache_placeholders.keys() if is_stale(filepath)]
+
+            report = SyncReport(sorted(files - live), stale_cache_keys, dry_run=dry_run)
+            if dry_run:
+                return report
+
+            for filepath in report.removed_files:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+            with self.cache.transaction():
+                self.cache_exported.delete_many(stale_cache_keys)
+                self.cache_sizes.delete_many(stale_cache_keys)
+                self.cache_latest.delete_many(stale_latest_keys)
+                self.cache_placeholders.delete_many(stale_placeholder_keys)
+            for digest in stale_cache_keys:
+                self._sizes.pop(digest, None)
+                self._verified.pop(digest, None)
+            for filepath in stale_placeholder_keys:
+                self._placeholders.pop(filepath, None)
+
+            self._sess_exported.clear()
+        return report
+
+
+class SyncReport:
+    def __init__(self, removed_files: list[str], removed_cache_keys: list[str], dry_run=False):
+        self.removed_files = removed_files
+        self.removed_cache_keys = removed_cache_keys
+        self.dry_run = dry_run
+
+    def __str__(self):
+        verb = 'would remove' if self.dry_run else 'removed'
+        return f'{verb} {len(self.removed_files)} files and {len(self.removed_cache_keys)} cache entries'
+
+
+class ResampledExporter(Exporter):
+    """ Exporter that derives its exports from the exports of another exporter
+        by downscaling them with Pillow, instead of developing the raw file again.
+        The source exporter should therefore export at the largest size needed.
+        Exports are placed in the directory of the filename format,
+        with the same file name as the source export.
+        EXIF data is copied from the source export.
+    """
+
+    def __init__(self, *, source: Exporter, cache_key, filename_format, width, height,
+                 out_ext=None, format_options=None, hq_resampling=None,
+                 source_out_dir=None, debug=False, scheduler: ExportScheduler = None,
+                 placeholders=False):
+        self.source = source
+        self.source_out_dir = source_out_dir
+        super().__init__(
+            cache_key=cache_key,
+            cli_bin=source.cli_bin,
+            config_dir=source.config_dir,
+            filename_format=filename_format,
+            out_ext=out_ext or source.out_ext,
+            format_options=format_options if format_options is not None else source.format_options,
+            hq_resampling=hq_resampling or source.hq_resampling,
+            width=width,
+            height=height,
+            debug=debug,
+            xmp_changes=source.xmp_changes,
+            scheduler=scheduler or source.scheduler,
+            placeholders=placeholders,
+        )
+
+    def _hashed_arguments(self) -> dict[str, str]:
+        arguments = super()._hashed_arguments()
+        arguments['source'] = self.source.args_hash
+        return arguments
+
+    def submit_export_cached_many(self, photos: list[Photo], out_dir: str,
+                                  priority: tuple = None) -> list[Future]:
+        # the source exports in batches, the downscaled copies wait for them
+        self.source.submit_export_cached_many(photos, self.source_out_dir or out_dir, priority)
+        return super().submit_export_cached_many(photos, out_dir, priority)
+
+    def export(self, photo: Photo, out_dir: str) -> Export:
+        """ Exports the photo with the source exporter (if necessary)
+            and writes a downscaled copy of it to the given directory.
+        """
+        source_out_dir = self.source_out_dir or out_dir
+        source_export = self.source.submit_export_cached(photo, source_out_dir).result()
+
+        filename = path.splitext(path.basename(source_export.filepath))[0] + '.' + self.out_ext
+        export_filepath = path.join(out_dir, path.dirname(self.filename_format), filename)
+        os.makedirs(path.dirname(export_filepath), exist_ok=True)
+
+        if self.debug:
+            print('resample:', source_export.filepath, '->', export_filepath)
+
+        resample = Image.Resampling.LANCZOS if str(self.hq_resampling).lower() == 'true' \
+            else Image.Resampling.BILINEAR
+        with Image.open(source_export.filepath) as image, metrics.timer('resample', media_size=self.name):
+            scale = min(float(self.width) / image.width, float(self.height) / image.height, 1.0)
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            resized = image.resize(size, resample, reducing_gap=3.0) if size != image.size else image.copy()
+            save_options = pillow_save_options(self.out_ext, self.format_options)
+            for key in ['exif', 'icc_profile']:
+                if key in image.info:
+                    save_options[key] = image.info[key]
+
+        # write to a temporary file first, the previous export might be served meanwhile
+        fd, tmp_filepath = tempfile.mkstemp(suffix='.' + self.out_ext, dir=path.dirname(export_filepath))
+        os.close(fd)
+        try:
+            with metrics.timer('encode', media_size=self.name):
+                resized.save(tmp_filepath, **save_options)
+            os.replace(tmp_filepath, export_filepath)
+        except BaseException:
+            os.unlink(tmp_filepath)
+            raise
+        finally:
+            resized.close()
+
+        self._add_to_session(export_filepath)
+        return Export(photo, filepath=export_filepath)
+
+
+def pillow_save_options(out_ext, format_options: list[str]) -> dict:
+    """ Translates darktable format options (e.g. "jpeg/quality=90")
+        to the equivalent options of Pillow's Image.save().
+    """
+    options = defaultdict(dict)
+    for option in format_options:
+        name, _, value = option.partition('=')
+        image_format, _, key = name.partition('/')
+        options[image_format][key] = value
+    ext = out_ext.lower().lstrip('.')
+    if ext in ['jpg', 'jpeg']:
+        # progressive is not a darktable option, darktable exports are baseline
+        progressive = options['jpeg'].get('progressive') == '1'
+        return {
+            'quality': int(options['jpeg'].get('quality', 95)),
+            'progressive': progressive,
+            'optimize': progressive,
+        }
+    if ext == 'webp':
+        return {
+            'lossless': options['webp'].get('comp_type') == '1',
+            'quality': int(options['webp'].get('quality', 95)),
+            'method': 6,
+        }
+    if ext == 'avif':
+        return {
+            'quality': int(options['avif'].get('quality', 75)),
+            'speed': int(options['avif'].get('speed', 4)),
+        }
+    return {}
+
+
+PLACEHOLDER_SIZE = 16
+
+
+def create_placeholder(filepath) -> tuple[str, str]:
+    """ Creates a tiny, low quality version of an image that is inlined
+        into pages and shown until the image itself is loaded.
+        Returns it as a base64 JPEG data uri, together with the
+        average colour of the image as a hex string (e.g. "#47553f").
+    """
+    with Image.open(filepath) as image:
+        # jpeg images are decoded at a fraction of their size
+        image.draft('RGB', (PLACEHOLDER_SIZE * 4, PLACEHOLDER_SIZE * 4))
+        image = image.convert('RGB')
+    image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.Resampling.BOX)
+    color = image.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=40, optimize=True)
+    data_uri = 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+    return data_uri, '#{:02x}{:02x}{:02x}'.format(*color)
+
+
+def pillow_can_encode(out_ext) -> bool:
+    image_format = Image.registered_extensions().get('.' + out_ext.lower().lstrip('.'))
+    return image_format is not None and image_format in Image.SAVE
+
+
+class ConfigDirCopies:
+    """ Private copies of darktable config directories.
+        darktable-cli reads and rewrites darktablerc in its config directory,
+        which is not safe to do concurrently, so every process leases a copy.
+        Copies are reused once they are returned, there are at most
+        as many as darktable-cli processes ever ran at the same time.
+        The databases are not copied, darktable-cli does not use them.
+        A copy is refreshed when darktablerc changed.
+    """
+
+    def __init__(self):
+        # config dir -> [(copy dir, mtime of darktablerc)] that are not leased
+        self._free: dict[str, list[tuple[str, int]]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, config_dir):
+        darktablerc = path.join(config_dir, 'darktablerc')
+        mtime = os.stat(darktablerc).st_mtime_ns if path.exists(darktablerc) else None
+        with self._lock:
+            free = self._free[config_dir]
+            copy = free.pop() if len(free) > 0 else None
+        if copy is not None and copy[1] != mtime:
+            shutil.rmtree(copy[0], ignore_errors=True)
+            copy = None
+        if copy is None:
+            copy_dir = tempfile.mkdtemp(prefix='darktable-config-')
+            atexit.register(shutil.rmtree, copy_dir, ignore_errors=True)
+            shutil.copytree(config_dir, copy_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('*.db', '*.db-*', '*.lock', 'backups'))
+            copy = (copy_dir, mtime)
+        try:
+            yield copy[0]
+        finally:
+            with self._lock:
+                self._free[config_dir].append(copy)
+
+
+config_dir_copies = ConfigDirCopies()
 
 
 def parse_darktable_datetime(datetime_taken):
@@ -298,34 +879,151 @@ def parse_darktable_datetime(datetime_taken):
     return dt - relativedelta(years=1969) + relativedelta(days=1)
 
 
-class AttachedDatabase:
-    def __init__(self, cursor: sqlite3.Cursor, name, db_path):
-        self.cursor = cursor
-        self.name = name
-        self.db_path = db_path
-        self.cursor.execute("""--sql
-            ATTACH DATABASE ? AS ?;
-        """, (self.db_path, self.name))
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *args):
-        self.cursor.execute("""--sql
-            DETACH ?;
-        """, (self.name,))
+def parse_darktable_datetimes(values: list[int]) -> list[datetime.datetime]:
+    """ Vectorized version of parse_darktable_datetime() for many values,
+        with exactly the same results, including its rounding.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    as_float = values.astype(np.float64)
+    # the division is only rounded like python's for values that are exact floats
+    exact = as_float.astype(np.int64) == values
+    seconds = np.empty(len(values), dtype=np.float64)
+    seconds[exact] = as_float[exact] / 1000
+    seconds[~exact] = [int(value) / 1000 for value in values[~exact]]
+    seconds = seconds / 1000 % 100000000000
+
+    # utcfromtimestamp() rounds to microseconds, half to even
+    fractions, seconds = np.modf(seconds)
+    microseconds = np.rint(fractions * 1e6)
+    seconds[microseconds >= 1e6] += 1
+    microseconds[microseconds >= 1e6] -= 1e6
+    seconds[microseconds < 0] -= 1
+    microseconds[microseconds < 0] += 1e6
+    timestamps = (seconds.astype(np.int64) * 1000000 + microseconds.astype(np.int64)).astype('datetime64[us]')
+
+    # relativedelta(years=1969) keeps the month and clamps the day to its length
+    months = timestamps.astype('datetime64[M]')
+    days = timestamps.astype('datetime64[D]')
+    day_of_month = days - months.astype('datetime64[D]')
+    shifted_months = months - np.timedelta64(1969 * 12, 'M')
+    month_lengths = (shifted_months + 1).astype('datetime64[D]') - shifted_months.astype('datetime64[D]')
+    shifted = shifted_months.astype('datetime64[D]') + np.minimum(day_of_month, month_lengths - 1)
+    result = shifted + np.timedelta64(1, 'D') + (timestamps - days)
+
+    # the modulo keeps all years in the range of datetime
+    return result.astype('datetime64[us]').tolist()
+
+
+class LibraryConnectionPool:
+    """ Thread-safe pool of read-only connections to a darktable library.
+        The data database is attached once when a connection is opened,
+        so every connection can query both databases.
+        Connections are kept open between requests, which also keeps
+        their cache of prepared statements, and are only reopened
+        once one of the database files changed on disk.
+    """
+
+    PRAGMAS = [
+        'query_only = ON',
+        'temp_store = MEMORY',
+    ]
+    SCHEMA_PRAGMAS = [
+        'mmap_size = 268435456',
+        'cache_size = -32768',
+    ]
+    CACHED_STATEMENTS = 256
+
+    _pools: dict[str, 'LibraryConnectionPool'] = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, library_dbpath, data_dbpath, max_idle=None):
+        self.library_dbpath = library_dbpath
+        self.data_dbpath = data_dbpath
+        self.max_idle = max_idle or (os.cpu_count() or 1) * 2
+        self._lock = threading.Lock()
+        self._idle: list[sqlite3.Connection] = []
+        self._generations: dict[sqlite3.Connection, int] = {}
+        self._generation = 0
+        self._signature = None
+
+    @classmethod
+    def for_config_dir(cls, config_dir) -> 'LibraryConnectionPool':
+        with cls._pools_lock:
+            if config_dir not in cls._pools:
+                cls._pools[config_dir] = cls(
+                    path.join(config_dir, DarktableLibrary.LIBRARY_DB),
+                    path.join(config_dir, DarktableLibrary.DATA_DB)
+                )
+            return cls._pools[config_dir]
+
+    def _files_signature(self):
+        signature = []
+        for db_path in [self.library_dbpath, self.data_dbpath]:
+            stat = os.stat(db_path)
+            signature.append((stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def _connect(self) -> sqlite3.Connection:
+        con = readonly_sqlite_connection(
+            self.library_dbpath,
+            check_same_thread=False,
+            cached_statements=self.CACHED_STATEMENTS
+        )
+        con.execute("""--sql
+            ATTACH DATABASE ? AS data
+        """, (f'file:{self.data_dbpath}?mode=ro',))
+        for pragma in self.PRAGMAS:
+            con.execute(f'PRAGMA {pragma}')
+        for schema in ['main', 'data']:
+            for pragma in self.SCHEMA_PRAGMAS:
+                con.execute(f'PRAGMA {schema}.{pragma}')
+        return con
+
+    def acquire(self) -> sqlite3.Connection:
+        signature = self._files_signature()
+        with self._lock:
+            if signature != self._signature:
+                self._signature = signature
+                self._generation += 1
+                for con in self._idle:
+                    self._generations.pop(con, None)
+                    con.close()
+                self._idle.clear()
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            generation = self._generation
+        con = self._connect()
+        with self._lock:
+            self._generations[con] = generation
+        return con
+
+    def release(self, con: sqlite3.Connection):
+        with self._lock:
+            if self._generations.get(con) == self._generation and len(self._idle) < self.max_idle:
+                self._idle.append(con)
+                return
+            self._generations.pop(con, None)
+        con.close()
+
+    @contextmanager
+    def connection(self):
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release(con)
 
 
 class DarktableLibrary:
     DATA_DB = 'data.db'
     LIBRARY_DB = 'library.db'
 
-    def __init__(self, config_dir):
+    def __init__(self, config_dir, pool: LibraryConnectionPool = None):
         self.config_dir = config_dir
         self.data_dbpath = path.join(config_dir, self.DATA_DB)
         self.library_dbpath = path.join(config_dir, self.LIBRARY_DB)
-        self.data_conn = readonly_sqlite_connection(self.data_dbpath)
-        self.library_conn = readonly_sqlite_connection(self.library_dbpath)
+        self.pool = pool or LibraryConnectionPool.for_config_dir(config_dir)
+        self.conn = self.pool.acquire()
 
     def __enter__(self):
         return self
@@ -334,46 +1032,64 @@ class DarktableLibrary:
         self.close()
 
     def __del__(self):
-        self.close()
+        # __init__ might have failed before acquiring a connection
+        if getattr(self, 'conn', None) is not None:
+            self.close()
 
     def close(self):
-        self.data_conn.close()
-        self.library_conn.close()
-
-    def _row_to_photo(self, row: sqlite3.Row, tag_separator: str) -> Photo:
+        # returns the connection to the pool
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+    # columns of a photo, tags are aggregated as a JSON array of [id, name, position]
+    PHOTO_COLUMNS = """--sql
+        images.id,
+        rtrim(film_rolls.folder, '/') || '/' || images.filename AS filepath,
+        images.version,
+        images.datetime_taken,
+        film_rolls.id AS film_id,
+        film_rolls.folder AS film_directory,
+        images.position AS film_position,
+        images.width,
+        images.height,
+        images.orientation,
+        images.change_timestamp
+    """
+
+    def _row_to_photo(self, row: sqlite3.Row, tags_by_id: dict[int, Tag] = None,
+                      datetime_taken: datetime.datetime = None) -> Photo:
+        # tags that are shared by many photos only need to be created once
+        if tags_by_id is None:
+            tags_by_id = {}
+        tags = {}
+        for tag_id, tag_name, tag_position in json.loads(row['tags']):
+            if tag_id not in tags_by_id:
+                tags_by_id[tag_id] = Tag(int(tag_id), tag_name)
+            tags[tags_by_id[tag_id]] = int(tag_position or 0)
         return Photo(
             id=int(row['id']),
             filepath=row['filepath'],
             version=int(row['version']),
-            datetime_taken=parse_darktable_datetime(row['datetime_taken']),
-            tags={
-                Tag(int(tag_id), tag_name): int(tag_position)
-                for tag_id, tag_name, tag_position in zip(
-                    row['tag_ids'].split(tag_separator),
-                    row['tag_names'].split(tag_separator),
-                    row['tag_positions'].split(tag_separator)
-                )
-            },
+            datetime_taken=datetime_taken or parse_darktable_datetime(row['datetime_taken']),
+            tags=tags,
             film_roll=FilmRoll(int(row['film_id']), row['film_directory']),
-            position=int(row['film_position'])
+            position=int(row['film_position']),
+            width=int(row['width'] or 0),
+            height=int(row['height'] or 0),
+            orientation=int(row['orientation'] or 0),
+            change_timestamp=int(row['change_timestamp'] or 0)
         )
 
     def _select_photos(self, where_clause: str, args: tuple, limit: int = None) -> list[Photo]:
-        cur = self.library_conn.cursor()
-        separator = '#~~~#'
-        with AttachedDatabase(cur, 'data', self.data_dbpath):
+        cur = self.conn.cursor()
+        with metrics.timer('library_query', query='select_photos'):
             cur.execute(f"""--sql
                 SELECT
-                    images.id,
-                    rtrim(film_rolls.folder, '/') || '/' || images.filename AS filepath,
-                    images.version,
-                    images.datetime_taken,
-                    film_rolls.id AS film_id,
-                    film_rolls.folder AS film_directory,
-                    images.position AS film_position,
-                    GROUP_CONCAT(_tagged_images_2.tagid, ?) AS tag_ids,
-                    GROUP_CONCAT(data.tags.name, ?) AS tag_names,
-                    GROUP_CONCAT(_tagged_images_2.position, ?) AS tag_positions
+                    {self.PHOTO_COLUMNS},
+                    json_group_array(json_array(
+                        _tagged_images_2.tagid, data.tags.name, _tagged_images_2.position
+                    )) AS tags
                 FROM tagged_images
                 INNER JOIN images ON tagged_images.imgid = images.id
                 INNER JOIN film_rolls ON film_rolls.id = images.film_id
@@ -382,12 +1098,14 @@ class DarktableLibrary:
                 {where_clause}
                 GROUP BY images.id
                 {f'LIMIT {limit}' if limit is not None and limit >= 0 else ''}
-            """, (separator, separator, separator) + args)
+            """, args)
             result = cur.fetchall()
-            return [
-                self._row_to_photo(row, tag_separator=separator)
-                for row in result
-            ]
+        tags_by_id = {}
+        datetimes = parse_darktable_datetimes([row['datetime_taken'] for row in result])
+        return [
+            self._row_to_photo(row, tags_by_id, datetime_taken)
+            for row, datetime_taken in zip(result, datetimes)
+        ]
 
     def get_photo_by_id_and_tag(self, id: int, tag: Tag) -> Photo:
         photos = self._select_photos("""--sql
@@ -396,10 +1114,10 @@ class DarktableLibrary:
         return photos[0] if len(photos) > 0 else None
 
     def get_tag(self, tag_name) -> Tag:
-        cur = self.data_conn.cursor()
+        cur = self.conn.cursor()
         cur.execute("""--sql
             SELECT id, name
-            FROM tags
+            FROM data.tags
             WHERE name=?
             LIMIT 1
         """, (tag_name,))
@@ -411,108 +1129,242 @@ class DarktableLibrary:
             WHERE tagged_images.tagid=? AND LOWER(data.tags.name) NOT LIKE 'darktable%'
         """, (tag.id,))
 
-        """
-        cur = self.library_conn.cursor()
-        separator = '#~~~#'
-        with AttachedDatabase(cur, 'data', self.data_dbpath):
-            cur.execute(""--sql
-                SELECT
-                    i.id,
-                    rtrim(fr.folder, '/') || '/' || i.filename AS filepath,
-                    i.version,
-                    i.datetime_taken,
-                    fr.id AS film_id,
-                    fr.folder AS film_directory,
-                    i.position AS film_position,
-                    GROUP_CONCAT(ti2.tagid, ?) AS tag_ids,
-                    GROUP_CONCAT(d_t.name, ?) AS tag_names,
-                    GROUP_CONCAT(ti2.position, ?) AS tag_positions
-                FROM tagged_images ti
-                INNER JOIN images i ON ti.imgid = i.id
-                INNER JOIN film_rolls fr ON fr.id = i.film_id
-                INNER JOIN tagged_images ti2 ON i.id = ti2.imgid
-                INNER JOIN data.tags d_t ON ti2.tagid = d_t.id
-                WHERE ti.tagid=? AND LOWER(d_t.name) NOT LIKE 'darktable%'
-                GROUP BY i.id
-            "", (separator, separator, separator, tag.id,))
-            result = cur.fetchall()
-
-        return [
-            Photo(
-                id=int(id),
-                filepath=filepath,
-                version=int(version),
-                datetime_taken=parse_darktable_datetime(datetime_taken),
-                tags={
-                    Tag(int(tag_id), tag_name): int(tag_position)
-                    for tag_id, tag_name, tag_position in zip(
-                        tag_ids.split(separator),
-                        tag_names.split(separator),
-                        tag_positions.split(separator)
-                    )
-                },
-                film_roll=FilmRoll(int(film_id), film_directory),
-                position=int(film_position)
-            )
-            for id, filepath, version, datetime_taken,
-            film_id, film_directory, film_position,
-            tag_ids, tag_names, tag_positions in result
-        ]
-        """
-
     def get_subtags(self, tag_name, including_tag=False) -> list[Tag]:
         """ Returns all tag names and their tag ID
             that are underneath the given tag name in the hierarchy.
             E.g. tag_name="foo" yields "bar" for "foo|bar",
             but not "foo" if a tag is named "foo" only.
         """
-        cur = self.data_conn.cursor()
+        cur = self.conn.cursor()
         cur.execute(f"""--sql
             SELECT id, name
-            FROM tags
+            FROM data.tags
             WHERE name LIKE ? || '|_%' {'OR name = ?' if including_tag else ''}
         """, (tag_name,) + ((tag_name,) if including_tag else ()))
         return [Tag(int(id), name) for id, name in cur.fetchall()]
 
+    def get_photos_in_hierarchy(self, tag_name, including_tag=False) -> dict[Tag, list[Photo]]:
+        """ Returns all photos that are tagged with any of the tags
+            underneath the given tag name in the hierarchy (see get_subtags()),
+            grouped by these tags, with a single query.
+            Each photo is only created once, a photo with multiple of these tags
+            is the same instance in each of the lists.
+            Photos are ordered by their id.
+        """
+        cur = self.conn.cursor()
+        with metrics.timer('library_query', query='photos_in_hierarchy'):
+            cur.execute(f"""--sql
+                SELECT
+                    {self.PHOTO_COLUMNS},
+                    json_group_array(json_array(
+                        tagged_images.tagid, data.tags.name, tagged_images.position
+                    )) FILTER (WHERE LOWER(data.tags.name) NOT LIKE 'darktable%') AS tags,
+                    json_group_array(tagged_images.tagid) FILTER (
+                        WHERE data.tags.name LIKE :tag_name || '|_%'
+                        OR (:including_tag AND data.tags.name = :tag_name)
+                    ) AS hierarchy_tag_ids
+                FROM images
+                INNER JOIN film_rolls ON film_rolls.id = images.film_id
+                INNER JOIN tagged_images ON images.id = tagged_images.imgid
+                INNER JOIN data.tags ON tagged_images.tagid = data.tags.id
+                WHERE images.id IN (
+                    SELECT tagged_images.imgid
+                    FROM tagged_images
+                    INNER JOIN data.tags ON tagged_images.tagid = data.tags.id
+                    WHERE data.tags.name LIKE :tag_name || '|_%'
+                    OR (:including_tag AND data.tags.name = :tag_name)
+                )
+                GROUP BY images.id
+                ORDER BY images.id
+            """, {'tag_name': tag_name, 'including_tag': including_tag})
+            rows = cur.fetchall()
+        tags_by_id: dict[int, Tag] = {}
+        result: dict[Tag, list[Photo]] = defaultdict(list)
+        datetimes = parse_darktable_datetimes([row['datetime_taken'] for row in rows])
+        for row, datetime_taken in zip(rows, datetimes):
+            photo = self._row_to_photo(row, tags_by_id, datetime_taken)
+            for tag_id in json.loads(row['hierarchy_tag_ids']):
+                result[tags_by_id[tag_id]].append(photo)
+        return result
+
     def get_photos_under_tag(self, tag_name) -> dict[Tag, list[Photo]]:
         """ Returns a dictionary of photos that are under the given tag
-            in the hierarchy. The key is the subtag's name and the value
-            is a tuple of the full path to the photo and its version number.
-            e.g. tag_name="foo" yields "bar"->("/img.raw", 0)
+            in the hierarchy. The key is the subtag and the value
+            is the list of photos that are tagged with it.
+            e.g. tag_name="foo" yields Tag("foo|bar")->[Photo("/img.raw")]
             if that photo is tagged "foo|bar" in Darktable.
         """
-        result = defaultdict(list)
-        for tag in self.get_subtags(tag_name):
-            for photo in self.get_tagged_photos(tag):
-                result[tag].append(photo)
-        return result
+        return self.get_photos_in_hierarchy(tag_name)
 
 
-def modify_xmp(in_filename, out_fd: TextIOWrapper, changes: list[Callable[[Element, dict], None]]):
-    # register all namespaces
-    namespaces = dict([node for _, node in ElementTree.iterparse(in_filename, events=['start-ns'])])
-    for name, uri in namespaces.items():
-        ElementTree.register_namespace(name, uri)
-    # parse xmp file
-    tree = ElementTree.parse(in_filename)
-    root = tree.getroot()
-    # go through all "changers" which modify the xmp
-    for func in changes:
-        func(root, namespaces)
-    # write output
-    xmp_data = ElementTree.tostring(root, encoding='unicode')
+def modify_xmp(in_filename, out_fd: TextIOWrapper, changes: list[XmpChange]):
+    xmp_data = XmpTransform.for_changes(changes).transform(in_filename)
     out_fd.seek(0)
     out_fd.truncate()
-    out_fd.write(str(xmp_data))
+    out_fd.write(xmp_data.decode('utf-8'))
     out_fd.flush()
 
 
-def xmp_remove_borders(xmp_root, namespaces):
-    for parent in xmp_root.findall('.//darktable:history//rdf:Seq', namespaces):
-        for element in parent.findall('rdf:li[@darktable:operation="borders"]', namespaces):
-            key = f'{{{namespaces["darktable"]}}}enabled'
-            if key in element.attrib:
-                element.attrib[key] = '0'
+@xmp_visitor('rdf:li', within='darktable:history')
+def xmp_remove_borders(element: Element, namespaces):
+    key = clark_name('darktable:enabled')
+    if element.get(clark_name('darktable:operation')) == 'borders' and key in element.attrib:
+        element.attrib[key] = '0'
+
+
+class HistoryItem:
+    def __init__(self, num, operation, enabled, modversion, params: bytes, multi_priority):
+        self.num: int = num
+        self.operation: str = operation
+        self.enabled: bool = enabled
+        self.modversion: int = modversion
+        self.params: bytes = params
+        self.multi_priority: int = multi_priority
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.num}, {self.operation}, {self.enabled})'
+
+
+def decode_history_params(value: str) -> bytes:
+    # darktable writes params either as hex or, when compressed,
+    # as "gz" followed by a two digit compression factor and base64 data
+    if value.startswith('gz'):
+        return zlib.decompress(base64.b64decode(value[4:]))
+    return bytes.fromhex(value)
+
+
+def read_xmp_history(xmp_root: Element) -> list[HistoryItem]:
+    """ Returns the active part of the darktable history in an XMP,
+        i.e. all items before history_end, in order.
+    """
+    dt = f'{{{XMP_NAMESPACES["darktable"]}}}'
+    description = xmp_root.find('.//rdf:Description', XMP_NAMESPACES)
+    if description is None:
+        return []
+    items = []
+    for element in description.findall('darktable:history/rdf:Seq/rdf:li', XMP_NAMESPACES):
+        items.append(HistoryItem(
+            num=int(element.get(dt + 'num', len(items))),
+            operation=element.get(dt + 'operation'),
+            enabled=element.get(dt + 'enabled') == '1',
+            modversion=int(element.get(dt + 'modversion', 0)),
+            params=decode_history_params(element.get(dt + 'params', '')),
+            multi_priority=int(element.get(dt + 'multi_priority', 0)),
+        ))
+    history_end = int(description.get(dt + 'history_end', len(items)))
+    return sorted([item for item in items if item.num < history_end], key=lambda item: item.num)
+
+
+class AspectRatioResolver:
+    """ Calculates the aspect ratio of a photo's export
+        from the raw dimensions in the library and the XMP history,
+        without developing the photo.
+        Only the geometry of rawprepare, flip and crop is modelled.
+        Photos with other modules that change the geometry
+        (e.g. perspective correction or enabled borders)
+        are resolved with the fallback, which usually exports a sample.
+        Results are cached by the hash of the XMP.
+    """
+
+    # modules that change the dimensions of the image
+    # and are not modelled by _model_aspect_ratio()
+    UNSUPPORTED_OPERATIONS = set([
+        'ashift', 'borders', 'clipping', 'rotatepixels', 'scalepixels'
+    ])
+    ORIENTATION_SWAP_XY = 4
+
+    def __init__(self, xmp_changes=[]):
+        self.xmp_changes = xmp_changes
+        self.cache = Cache(path.join(MODULE_DIR, CACHE_FILENAME), prefix='aspect_ratio:')
+
+    def _cache_key(self, photo: Photo, xmp_hash: str):
+        changes = ','.join(fullname(func) for func in self.xmp_changes)
+        return f'{xmp_hash}:{photo.width}x{photo.height}:{photo.orientation}:{changes}'
+
+    def get_aspect_ratios(self, photos: list[Photo],
+                          fallback: Callable[[list[Photo]], list[float]]) -> list[float]:
+        """ Returns the aspect ratio of each photo's export.
+            fallback is called once with all photos that can't be modelled.
+        """
+        aspect_ratios: list[float] = [None] * len(photos)
+        cache_keys = [self._cache_key(photo, photo_manifest.xmp_hash(photo)) for photo in photos]
+        # only aspect ratios that were not cached yet are written
+        resolved: dict[str, float] = {}
+        unresolved = []
+        for i, (photo, cache_key) in enumerate(zip(photos, cache_keys)):
+            aspect_ratio = self.cache.load(cache_key)
+            if aspect_ratio is None:
+                aspect_ratio = self.model_aspect_ratio(photo)
+                if aspect_ratio is None:
+                    unresolved.append(i)
+                else:
+                    resolved[cache_key] = aspect_ratio
+            aspect_ratios[i] = aspect_ratio
+
+        if len(unresolved) > 0:
+            fallback_ratios = fallback([photos[i] for i in unresolved])
+            for i, aspect_ratio in zip(unresolved, fallback_ratios):
+                aspect_ratios[i] = aspect_ratio
+                resolved[cache_keys[i]] = aspect_ratio
+
+        if len(resolved) > 0:
+            self.cache.update(resolved)
+        return aspect_ratios
+
+    def model_aspect_ratio(self, photo: Photo) -> float:
+        """ Returns None if the history can't be modelled.
+        """
+        if photo.width <= 0 or photo.height <= 0:
+            return None
+        root, namespaces = parse_xmp(photo.xmp_path)
+        XmpTransform.for_changes(self.xmp_changes).apply(root, namespaces)
+
+        # the last item of every module instance determines its state
+        instances: dict[tuple[str, int], HistoryItem] = {}
+        for item in read_xmp_history(root):
+            instances[(item.operation, item.multi_priority)] = item
+        modules = defaultdict(list)
+        for item in instances.values():
+            if item.enabled:
+                modules[item.operation].append(item)
+        if any(operation in self.UNSUPPORTED_OPERATIONS for operation in modules):
+            return None
+        if any(len(items) > 1 for items in modules.values()):
+            return None
+
+        width, height = float(photo.width), float(photo.height)
+
+        if 'rawprepare' in modules:
+            item = modules['rawprepare'][0]
+            if item.modversion not in [1, 2] or len(item.params) < 16:
+                return None
+            x, y, right, bottom = struct.unpack_from('<4i', item.params)
+            width, height = width - x - right, height - y - bottom
+
+        # the flip module is applied by default, with the orientation of the raw
+        orientation = photo.orientation
+        if 'flip' in modules:
+            item = modules['flip'][0]
+            if item.modversion != 2 or len(item.params) < 4:
+                return None
+            flip_orientation, = struct.unpack_from('<i', item.params)
+            if flip_orientation >= 0:
+                orientation = flip_orientation
+        elif ('flip', 0) in instances:
+            orientation = 0
+        if orientation >= 0 and orientation & self.ORIENTATION_SWAP_XY:
+            width, height = height, width
+
+        if 'crop' in modules:
+            item = modules['crop'][0]
+            if item.modversion != 1 or len(item.params) < 16:
+                return None
+            cx, cy, cw, ch = struct.unpack_from('<4f', item.params)
+            width, height = width * (cw - cx), height * (ch - cy)
+
+        if width <= 0 or height <= 0:
+            return None
+        return width / height
 
 
 def sanitize_xmp(in_filename, out_fd: TextIOWrapper):
@@ -0,0 +1,287 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import posixpath
+from os import path
+
+import click
+from werkzeug.exceptions import HTTPException
+
+from app import app, darktable
+from app.config import config
+from app.metrics import metrics
+from app.routes import export_manager, photo_index, portfolio_galleries
+
+
+URL_ATTRIBUTE_PATTERN = re.compile(r'(\b(?:href|src|data-[a-z-]*src)=")([^"]*)(")')
+CSS_URL_PATTERN = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+SRCSET_ATTRIBUTE_PATTERN = re.compile(r'\b[a-z-]*srcset[a-z0-9-]*="([^"]*)"')
+
+# files in the output directory that are not created by the site builder
+KEEP_FILES = ['CNAME']
+
+
+class SiteBuilder:
+    """ Builds the static version of the site in process,
+        without running a server and crawling it.
+        Pages are rendered with Flask's test client,
+        all media is exported in parallel and copied into the output directory
+        and only the static files that are referenced by pages are included.
+        Outputs that did not change are not written again
+        and files that are not part of the site anymore are removed.
+    """
+
+    def __init__(self, out_dir, debug=False):
+        self.out_dir = out_dir
+        self.debug = debug
+        self.static_url = app.static_url_path.strip('/')
+        self.outputs: set[str] = set()
+        self.exporters: dict[str, darktable.Exporter] = {}
+        self.url_adapter = app.url_map.bind('localhost')
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def page_urls(self) -> list[str]:
+        urls = ['/']
+        for gallery in portfolio_galleries.keys():
+            if gallery != config['PORTFOLIO_INDEX_GALLERY']:
+                urls.append(f'/{gallery}')
+        urls.append('/about')
+        return urls
+
+    def build(self):
+        photo_index.validate()
+        pages = self.render_pages()
+        media_urls, static_urls = self.page_links(pages)
+        # pages embed placeholders of existing exports only,
+        # so they are rendered again once missing exports were created
+        if self.build_media(sorted(media_urls)) > 0:
+            pages = self.render_pages()
+            rendered_media_urls, static_urls = self.page_links(pages)
+            self.build_media(sorted(rendered_media_urls - media_urls))
+        for url, html in pages.items():
+            self.write_text(self.page_filename(url), html)
+        self.build_static(static_urls)
+        self.remove_stale_files()
+
+    def render_pages(self) -> dict[str, str]:
+        pages: dict[str, str] = {}
+        with app.test_client() as client:
+            for url in self.page_urls():
+                response = client.get(url)
+                if response.status_code != 200:
+                    raise RuntimeError(f'failed to render {url}: {response.status}')
+                pages[url] = rewrite_root_relative_urls(response.get_data(as_text=True))
+        return pages
+
+    def page_links(self, pages: dict[str, str]) -> tuple[set[str], set[str]]:
+        """ The media and static urls that the pages link to.
+        """
+        media_urls = set()
+        static_urls = set()
+        for html in pages.values():
+            links = [match.group(2) for match in URL_ATTRIBUTE_PATTERN.finditer(html)]
+            for match in SRCSET_ATTRIBUTE_PATTERN.finditer(html):
+                links += [candidate.split()[0] for candidate in match.group(1).split(',') if candidate.strip()]
+            for link in links:
+                # media urls are versioned with a query string
+                link = link.split('?')[0]
+                if self.media_endpoint(link) is not None:
+                    media_urls.add(link)
+                elif link.startswith(self.static_url + '/'):
+                    static_urls.add(link)
+        return media_urls, static_urls
+
+    def page_filename(self, url: str) -> str:
+        if url == '/':
+            return 'index.html'
+        return url.strip('/') + '.html'
+
+    def media_endpoint(self, url: str):
+        """ Returns the endpoint and the arguments of a media url,
+            or None if the url is not a media url.
+        """
+        try:
+            endpoint, arguments = self.url_adapter.match('/' + url)
+        except HTTPException:
+            return None
+        if endpoint not in ['media', 'media_variant']:
+            return None
+        return endpoint, arguments
+
+    def build_media(self, media_urls: list[str]) -> int:
+        """ Exports the media and copies it into the output directory.
+            Returns the number of exports that were missing or outdated.
+        """
+        # submit all exports at once, so that they run in parallel
+        # and the photos of an exporter can be exported in batches
+        jobs: dict[str, list[tuple[str, darktable.Photo]]] = {}
+        outdated = 0
+        for url in media_urls:
+            _, arguments = self.media_endpoint(url)
+            exporter = export_manager.get_media_exporter(
+                arguments['media_size'], arguments.get('width'), arguments['file_extension'])
+            self.exporters[exporter.name] = exporter
+            photo = photo_index.get_photo(arguments['id'])
+            if photo is None:
+                raise RuntimeError(f'page links to an unknown photo: {url}')
+            _, up_to_date = exporter.find_export(photo)
+            if not up_to_date:
+                outdated += 1
+            jobs.setdefault(exporter.name, []).append((url, photo))
+        results = []
+        for name, exporter_jobs in jobs.items():
+            futures = self.exporters[name].submit_export_cached_many(
+                [photo for _, photo in exporter_jobs], out_dir=config['EXPORT_DIR'])
+            results.extend(zip([url for url, _ in exporter_jobs], futures))
+        for url, future in results:
+            self.copy_file(future.result().filepath, url)
+        return outdated
+
+    def prune_exports(self, dry_run=False) -> dict[str, darktable.SyncReport]:
+        """ Removes the exports of all media sizes used by the site
+            which were not needed for this build, e.g. of photos
+            that were removed from the portfolio.
+        """
+        reports = {}
+        for name, exporter in self.exporters.items():
+            directory = path.join(config['EXPORT_DIR'], path.dirname(exporter.filename_format))
+            reports[name] = exporter.sync(directory, dry_run=dry_run)
+        return reports
+
+    def build_static(self, static_urls: set[str]):
+        pending = list(static_urls)
+        visited = set()
+        while len(pending) > 0:
+            url = pending.pop()
+            if url in visited:
+                continue
+            visited.add(url)
+            filepath = path.join(app.static_folder, *url.removeprefix(self.static_url + '/').split('/'))
+            if not path.isfile(filepath):
+                raise RuntimeError(f'referenced static file does not exist: {filepath}')
+            if not filepath.endswith('.css'):
+                self.copy_file(filepath, url)
+                continue
+            with open(filepath, encoding='utf-8') as f:
+                stylesheet = f.read()
+            # links in stylesheets are relative to the stylesheet
+            stylesheet_dir = posixpath.dirname(url)
+
+            def rewrite(match: re.Match):
+                link = match.group(2)
+                if link.startswith('data:') or '://' in link or link.startswith('//'):
+                    return match.group(0)
+                if link.startswith('/'):
+                    target = link.removeprefix('/')
+                    link = posixpath.relpath(target, stylesheet_dir)
+                else:
+                    target = posixpath.normpath(posixpath.join(stylesheet_dir, link))
+                pending.append(target.split('#')[0].split('?')[0])
+                return f'url({match.group(1)}{link}{match.group(1)})'
+            self.write_text(url, CSS_URL_PATTERN.sub(rewrite, stylesheet))
+
+    def output_path(self, relative_url: str) -> str:
+        self.outputs.add(relative_url)
+        return path.join(self.out_dir, *relative_url.split('/'))
+
+    def write_text(self, relative_url: str, content: str):
+        filepath = self.output_path(relative_url)
+        data = content.encode('utf-8')
+        if path.isfile(filepath) and path.getsize(filepath) == len(data):
+            with open(filepath, 'rb') as f:
+                if f.read() == data:
+                    self.unchanged += 1
+                    return
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        self.written += 1
+        if self.debug:
+            print('wrote', relative_url)
+
+    def copy_file(self, src: str, relative_url: str):
+        dst = self.output_path(relative_url)
+        src_stat = os.stat(src)
+        try:
+            dst_stat = os.stat(dst)
+        except FileNotFoundError:
+            dst_stat = None
+        if dst_stat is not None and dst_stat.st_size == src_stat.st_size \
+                and dst_stat.st_mtime_ns == src_stat.st_mtime_ns:
+            self.unchanged += 1
+            return
+        os.makedirs(path.dirname(dst), exist_ok=True)
+        tmp = dst + '.tmp'
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+        self.written += 1
+        if self.debug:
+            print('copied', relative_url)
+
+    def remove_stale_files(self):
+        for dirpath, dirnames, filenames in os.walk(self.out_dir, topdown=False):
+            for filename in filenames:
+                filepath = path.join(dirpath, filename)
+                relative_url = path.relpath(filepath, self.out_dir).replace(os.sep, '/')
+                if relative_url in self.outputs or relative_url in KEEP_FILES:
+                    continue
+                os.unlink(filepath)
+                self.removed += 1
+                if self.debug:
+                    print('removed', relative_url)
+            if dirpath != self.out_dir and len(os.listdir(dirpath)) == 0:
+                os.rmdir(dirpath)
+
+
+def rewrite_root_relative_urls(html: str) -> str:
+    """ Makes links relative to the site's root directory,
+        since all pages are placed there. Links to the index page
+        remain "/" and pages are linked without their .html extension.
+    """
+    def rewrite(match: re.Match):
+        url = match.group(2)
+        if url.startswith('/') and not url.startswith('//') and url != '/':
+            url = url.removeprefix('/')
+        return match.group(1) + url + match.group(3)
+    return URL_ATTRIBUTE_PATTERN.sub(rewrite, html)
+
+
+@app.cli.command('freeze')
+@click.option('--out-dir', default='docs', show_default=True, help='Directory of the static site.')
+@click.option('--prune-exports', is_flag=True, help='Remove exports that the site does not use anymore.')
+@click.option('--dry-run', is_flag=True, help='Only report which exports would be removed.')
+@click.option('--debug', is_flag=True, help='Print every file that is written or removed.')
+@click.option('--metrics', 'metrics_file', type=click.Path(dir_okay=False, allow_dash=True),
+              help='Write a JSON summary of the timings of the build to this file ("-" for stdout).')
+def freeze_command(out_dir, prune_exports, dry_run, debug, metrics_file):
+    """ Builds the static site into the output directory.
+    """
+    started = time.monotonic()
+    builder = SiteBuilder(out_dir, debug=debug)
+    builder.build()
+    print(f'{builder.written} written, {builder.unchanged} unchanged, {builder.removed} removed')
+    if prune_exports or dry_run:
+        for name, report in builder.prune_exports(dry_run=dry_run).items():
+            print(f'{name}: {report}')
+            if debug or dry_run:
+                for filepath in report.removed_files:
+                    print(' ', filepath)
+    if metrics_file is not None:
+        summary = {
+            'seconds': round(time.monotonic() - started, 3),
+            'written': builder.written,
+            'unchanged': builder.unchanged,
+            'removed': builder.removed,
+            **metrics.summary(),
+        }
+        if metrics_file == '-':
+            json.dump(summary, sys.stdout, indent=2)
+            print()
+        else:
+            with open(metrics_file, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
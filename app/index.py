@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+from os import path
+from typing import Any, Callable, Hashable
+
+from app.darktable import DarktableLibrary, FilmRoll, Photo, Tag, stat_signature
+
+
+class MultipleVersionsError(RuntimeError):
+    """ Raised when photos are included with more than one version.
+        Lists all conflicting photos at once.
+    """
+
+    def __init__(self, multiple_versions: dict[str, list[int]]):
+        self.multiple_versions = multiple_versions
+        lines = [f'{filepath} (versions {", ".join(map(str, versions))})'
+                 for filepath, versions in sorted(multiple_versions.items())]
+        super().__init__('multiple versions of the same photo:\n  ' + '\n  '.join(lines))
+
+
+class PhotoIndexSnapshot:
+    """ Immutable state of the photo index at one point in time.
+        Readers keep a reference to a snapshot,
+        so a concurrent refresh never changes the data they're working with.
+    """
+
+    def __init__(self, photos_by_tag: dict[Tag, list[Photo]], signature,
+                 photo_signatures: dict[int, tuple] = None):
+        self.signature = signature
+        self.photos_by_tag = photos_by_tag
+        self.photos: dict[int, Photo] = {}
+        self.tags: dict[int, Tag] = {}
+        self.film_rolls: dict[int, FilmRoll] = {}
+        for tag, photos in photos_by_tag.items():
+            self.tags[tag.id] = tag
+            for photo in photos:
+                self.photos[photo.id] = photo
+                self.film_rolls[photo.film_roll.id] = photo.film_roll
+        # includes the state of the XMP sidecars when the snapshot was taken
+        self.photo_signatures: dict[int, tuple] = photo_signatures or {
+            id: photo_signature(photo) for id, photo in self.photos.items()
+        }
+        self.sidecars_checked = time.monotonic()
+        self.multiple_versions = find_multiple_versions(self.photos.values())
+        # validation verdict of this snapshot, computed only once
+        self.error = MultipleVersionsError(self.multiple_versions) if self.multiple_versions else None
+        self.memo: dict[Hashable, Any] = {}
+        self.memo_tags: dict[Hashable, set[str]] = {}
+
+
+class PhotoIndex:
+    """ Process-wide in-memory index of all photos under the root tag.
+        The index is refreshed when the darktable databases change on disk
+        or when the XMP sidecar of any photo changed.
+        Photos whose library data did not change keep their instance,
+        and data that was derived from the photos of some tags
+        (see memoize()) is only discarded if any of those photos changed.
+    """
+
+    DB_FILES = [
+        DarktableLibrary.LIBRARY_DB, DarktableLibrary.LIBRARY_DB + '-wal',
+        DarktableLibrary.DATA_DB, DarktableLibrary.DATA_DB + '-wal',
+    ]
+    # seconds between checks of the XMP sidecars, since that's a stat per photo
+    SIDECAR_CHECK_INTERVAL = 2.0
+
+    def __init__(self, config_dir, root_tag):
+        self.config_dir = config_dir
+        self.root_tag = root_tag
+        self._snapshot: PhotoIndexSnapshot = None
+        self._lock = threading.Lock()
+
+    def _files_signature(self):
+        signature = []
+        for filename in self.DB_FILES:
+            try:
+                stat = os.stat(path.join(self.config_dir, filename))
+            except FileNotFoundError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    @property
+    def snapshot(self) -> PhotoIndexSnapshot:
+        """ Returns the current snapshot, after refreshing it if necessary.
+        """
+        self.refresh()
+        return self._snapshot
+
+    def _sidecars_changed(self, snapshot: PhotoIndexSnapshot, check_now=False):
+        if not check_now and time.monotonic() - snapshot.sidecars_checked < self.SIDECAR_CHECK_INTERVAL:
+            return False
+        snapshot.sidecars_checked = time.monotonic()
+        return any(
+            sidecar_signature(photo) != snapshot.photo_signatures[id][-1]
+            for id, photo in snapshot.photos.items()
+        )
+
+    def refresh(self, force=False, check_sidecars=False) -> bool:
+        """ Reloads the photos if the darktable databases or any XMP sidecar changed.
+            Sidecars are checked at most every SIDECAR_CHECK_INTERVAL seconds,
+            unless check_sidecars is set. Returns whether the index was reloaded.
+        """
+        snapshot = self._snapshot
+        signature = self._files_signature()
+        if not force and snapshot is not None and snapshot.signature == signature \
+                and not self._sidecars_changed(snapshot, check_sidecars):
+            return False
+        with self._lock:
+            previous = self._snapshot
+            if not force and previous is not snapshot:
+                # reloaded by another thread in the meantime
+                return False
+            with DarktableLibrary(self.config_dir) as lib:
+                photos_by_tag = lib.get_photos_in_hierarchy(self.root_tag, including_tag=True)
+            self._snapshot = self._merge(previous, photos_by_tag, signature)
+        return True
+
+    def _merge(self, previous: PhotoIndexSnapshot, photos_by_tag: dict[Tag, list[Photo]],
+               signature) -> PhotoIndexSnapshot:
+        if previous is None:
+            return PhotoIndexSnapshot(photos_by_tag, signature)
+
+        # reuse the instances of unchanged photos
+        changed_photo_ids = set(previous.photos.keys())
+        reused: dict[int, Photo] = {}
+        photo_signatures: dict[int, tuple] = {}
+        for photos in photos_by_tag.values():
+            for photo in photos:
+                if photo.id in reused:
+                    continue
+                previous_photo = previous.photos.get(photo.id)
+                photo_signatures[photo.id] = photo_signature(photo)
+                if previous_photo is not None and previous.photo_signatures[photo.id] == photo_signatures[photo.id]:
+                    reused[photo.id] = previous_photo
+                    changed_photo_ids.discard(photo.id)
+                else:
+                    reused[photo.id] = photo
+                    changed_photo_ids.add(photo.id)
+        photos_by_tag = {
+            tag: [reused[photo.id] for photo in photos]
+            for tag, photos in photos_by_tag.items()
+        }
+        snapshot = PhotoIndexSnapshot(photos_by_tag, signature, photo_signatures)
+
+        # tags whose list of photos or any of its photos changed
+        changed_tags = set()
+        previous_tags = {tag.name: photos for tag, photos in previous.photos_by_tag.items()}
+        current_tags = {tag.name: photos for tag, photos in snapshot.photos_by_tag.items()}
+        for name in set(previous_tags) | set(current_tags):
+            previous_ids = [photo.id for photo in previous_tags.get(name, [])]
+            current_ids = [photo.id for photo in current_tags.get(name, [])]
+            if previous_ids != current_ids or not changed_photo_ids.isdisjoint(current_ids):
+                changed_tags.add(name)
+
+        for key, tag_names in previous.memo_tags.items():
+            if key in previous.memo and changed_tags.isdisjoint(tag_names):
+                snapshot.memo[key] = previous.memo[key]
+                snapshot.memo_tags[key] = tag_names
+        return snapshot
+
+    def get_photos(self, sub_tag: str = None, include_root_tag=False) -> list[Photo]:
+        """ Returns the photos tagged with a direct subtag of the root tag
+            (or any subtag if sub_tag is None), each photo only once.
+        """
+        snapshot = self.snapshot
+        photos: dict[int, Photo] = dict()
+        for tag in self._select_tags(snapshot, sub_tag, include_root_tag):
+            for photo in snapshot.photos_by_tag[tag]:
+                photos.setdefault(photo.id, photo)
+        return list(photos.values())
+
+    def get_tags(self, sub_tag: str = None, include_root_tag=False) -> list[Tag]:
+        return self._select_tags(self.snapshot, sub_tag, include_root_tag)
+
+    def _select_tags(self, snapshot: PhotoIndexSnapshot, sub_tag, include_root_tag) -> list[Tag]:
+        tags = []
+        for tag in snapshot.photos_by_tag.keys():
+            tag_path = tag.name.split('|')
+            if len(tag_path) == 1:
+                if include_root_tag and sub_tag is None:
+                    tags.append(tag)
+            elif sub_tag is None or len(tag_path) == 2 and tag_path[1] == sub_tag:
+                tags.append(tag)
+        return tags
+
+    def get_photo(self, id: int, tag_name: str = None) -> Photo:
+        """ Returns the photo with the given id,
+            if it is tagged with the given tag (by default the root tag).
+        """
+        photo = self.snapshot.photos.get(id)
+        tag_name = tag_name or self.root_tag
+        if photo is None or not any(tag.name == tag_name for tag in photo.tags):
+            return None
+        return photo
+
+    @property
+    def multiple_versions(self) -> dict[str, list[int]]:
+        return self.snapshot.multiple_versions
+
+    def validate(self):
+        """ Raises a MultipleVersionsError listing all photos
+            that are included with more than one version.
+            The result is computed once per reload of the library.
+        """
+        error = self.snapshot.error
+        if error is not None:
+            raise error
+
+    def memoize(self, key: Hashable, tag_names: list[str], func: Callable[[], Any]):
+        """ Returns the cached result of func(), which is derived from the photos
+            of the given tags. It's recomputed when any of these photos changed.
+        """
+        snapshot = self.snapshot
+        if key not in snapshot.memo:
+            snapshot.memo[key] = func()
+            snapshot.memo_tags[key] = set(tag_names)
+        return snapshot.memo[key]
+
+    def memoized(self, key: Hashable, default=None):
+        """ Returns the cached result of memoize() with the given key
+            without computing it, or default if it's not cached.
+        """
+        return self.snapshot.memo.get(key, default)
+
+
+def sidecar_signature(photo: Photo):
+    try:
+        return stat_signature(photo.xmp_path)
+    except FileNotFoundError:
+        return None
+
+
+def photo_signature(photo: Photo):
+    """ The library data of a photo and the state of its XMP sidecar,
+        which changes when the photo is edited without touching the library.
+    """
+    return (
+        photo.filepath,
+        photo.version,
+        photo.datetime_taken,
+        tuple(sorted((tag.id, tag.name, position) for tag, position in photo.tags.items())),
+        photo.film_roll.id,
+        photo.film_roll.directory,
+        photo.position,
+        photo.width,
+        photo.height,
+        photo.orientation,
+        photo.change_timestamp,
+        sidecar_signature(photo),
+    )
+
+
+def find_multiple_versions(photos) -> dict[str, list[int]]:
+    """ Returns the file paths of all photos that are included
+        with more than one version, mapped to these versions.
+    """
+    versions: dict[str, set[int]] = {}
+    for photo in photos:
+        versions.setdefault(photo.filepath, set()).add(photo.version)
+    return {
+        filepath: sorted(photo_versions)
+        for filepath, photo_versions in versions.items()
+        if len(photo_versions) > 1
+    }
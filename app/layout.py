@@ -0,0 +1,58 @@
+from collections import deque
+
+
+# galleries with more columns are laid out by the browser alone
+MAX_LAYOUT_COLUMNS = 8
+
+
+def justified_rows(aspect_ratios: list[float], orders: list[int], columns: int,
+                   wide_landscapes=True) -> list[list[int]]:
+    """ Determines which photos are placed next to each other in a gallery
+        with the given number of columns, the same way as the RowRenderStrategy
+        of the gallery script does (src/scripts/components/gallery).
+        Rows are filled from left to right, landscapes take two columns
+        (if wide_landscapes is set) and the last column prefers the next portrait
+        unless it belongs to a later group of photos (see orders).
+        Returns the indices of the photos in each row, in placement order.
+        The sizes of the photos are only known in the browser.
+    """
+    portraits = deque(i for i, aspect_ratio in enumerate(aspect_ratios) if aspect_ratio <= 1.0)
+    landscapes = deque(i for i, aspect_ratio in enumerate(aspect_ratios) if aspect_ratio > 1.0)
+
+    rows: list[list[int]] = []
+    row: list[int] = []
+    filled_columns = 0
+    while len(portraits) > 0 or len(landscapes) > 0:
+        column = filled_columns
+        if len(landscapes) == 0 or len(portraits) > 0 and portraits[0] < landscapes[0]:
+            index = portraits.popleft()
+        elif columns > 1 and column == columns - 1 and len(portraits) > 0 \
+                and orders[portraits[0]] <= orders[landscapes[0]]:
+            index = portraits.popleft()
+        else:
+            index = landscapes.popleft()
+        row.append(index)
+        is_wide = wide_landscapes and columns > 1 and aspect_ratios[index] > 1.0
+        # a wide photo in the last column only occupies that column
+        filled_columns += 2 if is_wide and column + 1 < columns else 1
+        if filled_columns >= columns:
+            rows.append(row)
+            row = []
+            filled_columns = 0
+    if len(row) > 0:
+        rows.append(row)
+    return rows
+
+
+def gallery_layout(aspect_ratios: list[float], orders: list[int], wide_landscapes=True) -> dict:
+    """ Justified rows of a gallery for every number of columns
+        up to MAX_LAYOUT_COLUMNS, as read by the gallery script.
+    """
+    return {
+        'images': len(aspect_ratios),
+        'wideLandscapes': wide_landscapes,
+        'rows': {
+            str(columns): justified_rows(aspect_ratios, orders, columns, wide_landscapes)
+            for columns in range(1, MAX_LAYOUT_COLUMNS + 1)
+        },
+    }
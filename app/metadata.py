@@ -0,0 +1,216 @@
+import os
+import struct
+import shutil
+import tempfile
+from os import path
+from typing import BinaryIO
+
+from PIL import Image
+
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+TAG_ARTIST = 0x013b
+TAG_COPYRIGHT = 0x8298
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+
+JPEG_SOI = 0xd8
+JPEG_SOS = 0xda
+JPEG_APP0 = 0xe0
+# markers without a length field
+JPEG_STANDALONE_MARKERS = set([0x01, JPEG_SOI, 0xd9] + list(range(0xd0, 0xd8)))
+# segments that carry metadata: APP1 (Exif and XMP), APP13 (IPTC) and comments
+JPEG_METADATA_MARKERS = set([0xe1, 0xed, 0xfe])
+
+WEBP_METADATA_CHUNKS = set([b'EXIF', b'XMP '])
+WEBP_VP8X_FLAG_XMP = 0x04
+WEBP_VP8X_FLAG_EXIF = 0x08
+WEBP_VP8X_FLAG_ALPHA = 0x10
+
+
+def build_exif(*, artist=None, copyright=None, datetime_original=None) -> bytes:
+    """ Returns an EXIF block (including the "Exif" header)
+        that only contains the given tags.
+    """
+    exif = Image.Exif()
+    if artist is not None:
+        exif[TAG_ARTIST] = artist
+    if copyright is not None:
+        exif[TAG_COPYRIGHT] = copyright
+    if datetime_original is not None:
+        exif[TAG_EXIF_IFD] = {TAG_DATETIME_ORIGINAL: datetime_original}
+    return exif.tobytes()
+
+
+def read_datetime_original(exif_data: bytes):
+    if not exif_data:
+        return None
+    exif = Image.Exif()
+    exif.load(exif_data)
+    return exif.get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL)
+
+
+def rewrite_exif(filepath, *, artist, copyright):
+    """ Removes all metadata from an image file and replaces it
+        with an EXIF block that only contains the artist, the copyright
+        and the original date and time of the previous metadata.
+        JPEG and WebP files are rewritten segment by segment
+        without decoding any pixels. The file is replaced atomically.
+    """
+    ext = path.splitext(filepath)[1].lower()
+    if ext in ['.jpg', '.jpeg']:
+        rewrite = _rewrite_jpeg_exif
+    elif ext == '.webp':
+        rewrite = _rewrite_webp_exif
+    else:
+        rewrite = _rewrite_image_exif
+
+    fd, tmp_filepath = tempfile.mkstemp(suffix=ext, dir=path.dirname(filepath))
+    try:
+        with open(filepath, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            rewrite(src, dst, artist=artist, copyright=copyright)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.unlink(tmp_filepath)
+        raise
+
+
+def _copy(src: BinaryIO, dst: BinaryIO, length: int):
+    while length > 0:
+        chunk = src.read(min(length, 1 << 16))
+        if not chunk:
+            raise RuntimeError('unexpected end of file')
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def _read_jpeg_marker(src: BinaryIO) -> int:
+    byte = src.read(1)
+    if byte != b'\xff':
+        raise RuntimeError('expected a jpeg marker')
+    marker = 0xff
+    while marker == 0xff:  # fill bytes
+        marker = src.read(1)[0]
+    return marker
+
+
+def _rewrite_jpeg_exif(src: BinaryIO, dst: BinaryIO, *, artist, copyright):
+    if _read_jpeg_marker(src) != JPEG_SOI:
+        raise RuntimeError('not a jpeg file')
+
+    # collect all segments up to the start of the image data,
+    # these are small compared to the image data itself
+    segments: list[tuple[int, bytes]] = []
+    datetime_original = None
+    while True:
+        marker = _read_jpeg_marker(src)
+        if marker in JPEG_STANDALONE_MARKERS:
+            segments.append((marker, None))
+            continue
+        length, = struct.unpack('>H', src.read(2))
+        if marker == JPEG_SOS:
+            break
+        payload = src.read(length - 2)
+        if marker in JPEG_METADATA_MARKERS:
+            if datetime_original is None and payload.startswith(EXIF_HEADER):
+                datetime_original = read_datetime_original(payload)
+            continue
+        segments.append((marker, payload))
+
+    exif_data = build_exif(artist=artist, copyright=copyright, datetime_original=datetime_original)
+    # the exif segment must follow the JFIF segment, if there is one
+    insert_at = 1 if len(segments) > 0 and segments[0][0] == JPEG_APP0 else 0
+    segments.insert(insert_at, (0xe1, exif_data))
+
+    dst.write(b'\xff' + bytes([JPEG_SOI]))
+    for marker, payload in segments:
+        dst.write(b'\xff' + bytes([marker]))
+        if payload is not None:
+            dst.write(struct.pack('>H', len(payload) + 2))
+            dst.write(payload)
+    # start of scan, everything after it is copied as is
+    dst.write(b'\xff' + bytes([JPEG_SOS]) + struct.pack('>H', length))
+    shutil.copyfileobj(src, dst)
+
+
+def _webp_canvas_size(fourcc: bytes, payload: bytes) -> tuple[int, int, bool]:
+    """ Reads width, height and whether there is alpha
+        from the header of a simple (lossy or lossless) WebP bitstream.
+    """
+    if fourcc == b'VP8 ':
+        width, height = struct.unpack_from('<HH', payload, 6)
+        return width & 0x3fff, height & 0x3fff, False
+    if fourcc == b'VP8L':
+        bits, = struct.unpack_from('<I', payload, 1)
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1, bool((bits >> 28) & 1)
+    raise RuntimeError(f'unexpected webp chunk: {fourcc}')
+
+
+def _write_webp_chunk(dst: BinaryIO, fourcc: bytes, payload: bytes):
+    dst.write(fourcc + struct.pack('<I', len(payload)) + payload)
+    if len(payload) % 2 == 1:
+        dst.write(b'\x00')
+
+
+def _rewrite_webp_exif(src: BinaryIO, dst: BinaryIO, *, artist, copyright):
+    riff, _, webp = struct.unpack('<4sI4s', src.read(12))
+    if riff != b'RIFF' or webp != b'WEBP':
+        raise RuntimeError('not a webp file')
+
+    # read the chunk headers and remember where the payloads are,
+    # only small chunks are read into memory
+    chunks: list[tuple[bytes, int, int]] = []
+    header = src.read(8)
+    while len(header) == 8:
+        fourcc, size = struct.unpack('<4sI', header)
+        chunks.append((fourcc, src.tell(), size))
+        src.seek(size + size % 2, os.SEEK_CUR)
+        header = src.read(8)
+
+    def read_payload(offset, size):
+        src.seek(offset)
+        return src.read(size)
+
+    datetime_original = None
+    for fourcc, offset, size in chunks:
+        if fourcc == b'EXIF':
+            datetime_original = read_datetime_original(read_payload(offset, size))
+
+    exif_data = build_exif(artist=artist, copyright=copyright, datetime_original=datetime_original)
+    exif_data = exif_data.removeprefix(EXIF_HEADER)
+
+    if chunks[0][0] == b'VP8X':
+        vp8x = bytearray(read_payload(chunks[0][1], chunks[0][2]))
+        chunks = chunks[1:]
+    else:
+        width, height, alpha = _webp_canvas_size(chunks[0][0], read_payload(chunks[0][1], 30))
+        vp8x = bytearray(10)
+        vp8x[4:7] = (width - 1).to_bytes(3, 'little')
+        vp8x[7:10] = (height - 1).to_bytes(3, 'little')
+        if alpha:
+            vp8x[0] |= WEBP_VP8X_FLAG_ALPHA
+    vp8x[0] = (vp8x[0] & ~WEBP_VP8X_FLAG_XMP) | WEBP_VP8X_FLAG_EXIF
+
+    dst.write(b'RIFF\x00\x00\x00\x00WEBP')
+    _write_webp_chunk(dst, b'VP8X', bytes(vp8x))
+    for fourcc, offset, size in chunks:
+        if fourcc in WEBP_METADATA_CHUNKS:
+            continue
+        src.seek(offset)
+        dst.write(fourcc + struct.pack('<I', size))
+        _copy(src, dst, size + size % 2)
+    _write_webp_chunk(dst, b'EXIF', exif_data)
+
+    # the riff size excludes the riff header itself
+    riff_size = dst.tell() - 8
+    dst.seek(4)
+    dst.write(struct.pack('<I', riff_size))
+
+
+def _rewrite_image_exif(src: BinaryIO, dst: BinaryIO, *, artist, copyright):
+    # other formats are re-encoded, which decodes the image
+    with Image.open(src) as image:
+        datetime_original = image.getexif().get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL)
+        exif_data = build_exif(artist=artist, copyright=copyright, datetime_original=datetime_original)
+        image.save(dst, format=image.format, exif=exif_data)
@@ -0,0 +1,128 @@
+import time
+import threading
+
+
+class Timer:
+    """ Context manager that records its duration in a metrics registry.
+    """
+
+    __slots__ = ('metrics', 'key', 'start')
+
+    def __init__(self, metrics: 'Metrics', key: tuple):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics._observe(self.key, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """ Process-wide timings of the stages of the export pipeline
+        and counters, e.g. of cache hits. Metrics are identified
+        by a name and labels (e.g. the exporter of a media size).
+        Timings are recorded as count, sum and maximum in seconds.
+        The metrics can be read as Prometheus text format or as JSON.
+    """
+
+    PREFIX = 'portfolio_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> [count, sum, max]
+        self._timings: dict[tuple, list] = {}
+        # (name, labels) -> value
+        self._counters: dict[tuple, int] = {}
+
+    def timer(self, name: str, **labels) -> Timer:
+        """ Times the duration of a with block.
+        """
+        return Timer(self, (name, tuple(sorted(labels.items()))))
+
+    def observe(self, name: str, seconds: float, **labels):
+        self._observe((name, tuple(sorted(labels.items()))), seconds)
+
+    def _observe(self, key: tuple, seconds: float):
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                self._timings[key] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+
+    def count(self, name: str, value: int = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+
+    def summary(self) -> dict:
+        """ All metrics as a JSON serializable dictionary.
+        """
+        with self._lock:
+            timings = sorted((key, list(timing)) for key, timing in self._timings.items())
+            counters = sorted(self._counters.items())
+        return {
+            'timings': [
+                {'name': name, 'labels': dict(labels), 'count': count,
+                 'seconds': round(total, 6), 'max_seconds': round(maximum, 6)}
+                for (name, labels), (count, total, maximum) in timings
+            ],
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in counters
+            ],
+        }
+
+    def prometheus(self) -> str:
+        """ All metrics in the Prometheus text exposition format.
+            Timings are summaries without quantiles and a gauge of their maximum.
+        """
+        with self._lock:
+            timings = sorted((key, list(timing)) for key, timing in self._timings.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        declared = set()
+
+        def declare(metric, kind):
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} {kind}')
+
+        for (name, labels), (count, total, maximum) in timings:
+            metric = f'{self.PREFIX}{name}_seconds'
+            declare(metric, 'summary')
+            lines.append(f'{metric}_count{format_labels(labels)} {count}')
+            lines.append(f'{metric}_sum{format_labels(labels)} {total:.6f}')
+        for (name, labels), (count, total, maximum) in timings:
+            metric = f'{self.PREFIX}{name}_seconds_max'
+            declare(metric, 'gauge')
+            lines.append(f'{metric}{format_labels(labels)} {maximum:.6f}')
+        for (name, labels), value in counters:
+            metric = f'{self.PREFIX}{name}_total'
+            declare(metric, 'counter')
+            lines.append(f'{metric}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = [
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+metrics = Metrics()
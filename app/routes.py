@@ -1,6 +1,10 @@
 from collections import defaultdict
+import base64
 import datetime
+import io
+import itertools
 import json
+import mimetypes
 import os
 import pathlib
 import re
@@ -8,11 +12,19 @@ from os import path
 from enum import Enum
 import string
 import sys
+import threading
 from typing import Any, Iterable
+from urllib.parse import urlsplit
 
-from flask import render_template, send_file, abort, request
+from flask import Response, render_template, send_file, abort, request
+from PIL import Image
 
 from app import app, darktable
+from app.columns import PhotoColumns, timestamps_to_datetimes
+from app.index import PhotoIndex
+from app.layout import gallery_layout
+from app.metrics import metrics
+from app.scheduler import ExportScheduler
 from app.config import DEBUG_ENV, STATIC_URL, config
 # from app.model import load_photos, export_photos, organize_exports, group_exports
 
@@ -35,9 +47,13 @@ class MediaSize:
     LARGE = 'large'
     DEFAULT = LARGE
 
-    def __init__(self, name: str, dimensions: Dimensions):
+    def __init__(self, name: str, dimensions: Dimensions, srcset_widths: list[int] = []):
+        """ srcset_widths are the widths of smaller variants of this size,
+            from which browsers select the smallest sufficient one.
+        """
         self.name = name
         self.dimensions = dimensions
+        self.srcset_widths = sorted(srcset_widths)
 
     @property
     def lower_name(self):
@@ -92,6 +108,26 @@ class FilenameFormat:
         return result
 
 
+export_scheduler = ExportScheduler(workers=int(config.get('EXPORT_WORKERS') or 0) or None)
+
+# serve outdated exports or placeholders instead of waiting for darktable
+ASYNC_MEDIA = config.get('EXPORT_ASYNC_MEDIA', '').lower() == 'true'
+ASYNC_MEDIA_RETRY_AFTER = 5
+# exports of other media sizes that are at most this much larger are served instead
+ASYNC_MEDIA_MAX_FALLBACK_SCALE = 2.0
+# length of the export digest in versioned media urls
+MEDIA_VERSION_LENGTH = 16
+
+# additional encodings of all exports, in order of preference,
+# codecs that Pillow can't encode are ignored
+EXPORT_CODECS = [
+    out_ext for out_ext in re.split(r'[,\s]+', (config.get('EXPORT_CODECS') or '').lower())
+    if out_ext and out_ext != config['EXPORT_EXT'].lower() and darktable.pillow_can_encode(out_ext)
+]
+# not known to all python versions
+mimetypes.add_type('image/avif', '.avif')
+
+
 class MediaExporter(darktable.Exporter):
     """ Flask media exporter with arguments from the app's configuration
         and default values that make sense in the context of the app.
@@ -104,6 +140,8 @@ class MediaExporter(darktable.Exporter):
         'hq_resampling': config['EXPORT_HQ_RESAMPLING'],
         'xmp_changes': [darktable.xmp_remove_borders],
         'debug': os.getenv(DEBUG_ENV) == '1',
+        'scheduler': export_scheduler,
+        'batch_size': int(config.get('EXPORT_BATCH_SIZE') or 1),
     }
 
     def __init__(self, **kwargs):
@@ -112,13 +150,29 @@ class MediaExporter(darktable.Exporter):
         super().__init__(**arguments)
 
 
-class SampleExporter(MediaExporter):
+class SampleExports:
+    """ Exporter mixin for accessing the sample export of photos.
+    """
+
+    @property
+    def export_dir(self):
+        return os.path.join(config['EXPORT_DIR'], 'samples')
+
+    def get_sample_export(self, photo: darktable.Photo) -> darktable.Export:
+        # on the scheduler's workers, like all other exports
+        return self.submit_export_cached(photo, self.export_dir).result()
+
+    def get_sample_exports(self, photos: list[darktable.Photo]) -> list[darktable.Export]:
+        return self.export_cached_many(photos, self.export_dir)
+
+
+class SampleExporter(SampleExports, MediaExporter):
     """ Exporter that exports small samples of photos,
         mainly to be able to determine a photo's export dimensions.
         Photos can e.g. have border's (which are removed by the exporter)
         and thus the export dimensions in the Darktable database are unreliable.
-        Exporting a small, low-res sample is the only sensible solution
-        with the least amount of work needed to implement.
+        Samples are only exported for photos whose history
+        can't be modelled by the AspectRatioResolver.
     """
     def __init__(self):
         super().__init__(
@@ -133,17 +187,36 @@ class SampleExporter(MediaExporter):
             debug=True, # TODO: False
         )
 
-    def get_sample_export(self, photo: darktable.Photo) -> darktable.Export:
-        export_dir = os.path.join(config['EXPORT_DIR'], 'samples')
-        return sample_exporter.export_cached(photo, export_dir)
+
+class ResampledSampleExporter(SampleExports, darktable.ResampledExporter):
+    """ Sample exporter that downscales the exports of another exporter
+        instead of running Darktable for every sample.
+    """
+    def __init__(self, source: darktable.Exporter):
+        super().__init__(
+            source=source,
+            source_out_dir=config['EXPORT_DIR'],
+            cache_key=self.__class__.__name__,
+            out_ext='jpg',
+            filename_format=FilenameFormat('{EXIF.YEAR}{EXIF.MONTH}{EXIF.DAY}{EXIF.HOUR}{EXIF.MINUTE}{EXIF.SECOND}-{FILE.NAME}').render(),
+            format_options=darktable.parse_format_options('jpeg/quality=5'),
+            hq_resampling='false',
+            width=1920,
+            height=1080,
+            debug=MediaExporter.defaults['debug'],
+        )
 
 
 class ExportManager:
     EXPORT_FILENAME_FORMAT = FilenameFormat('{media_size}/{EXIF.YEAR}{EXIF.MONTH}{EXIF.DAY}{EXIF.HOUR}{EXIF.MINUTE}{EXIF.SECOND}-{FILE.NAME}')
 
-    def __init__(self):
+    def __init__(self, multi_resolution=False):
+        """ With multi_resolution enabled only the largest media size
+            is exported with Darktable, all other sizes are downscaled from it.
+        """
         self.exporter_instances: dict[str, darktable.Exporter] = {}
         self.media_sizes: dict[str, MediaSize] = {}
+        self.multi_resolution = multi_resolution
 
     def register_media_size(self, media_size: MediaSize):
         self.media_sizes[media_size.lower_name] = media_size
@@ -156,6 +229,11 @@ class ExportManager:
             raise RuntimeError(f'unknown media size name: {media_size_name}')
         return self.media_sizes[media_size_name.lower()]
 
+    @property
+    def largest_media_size(self) -> MediaSize:
+        return max(self.media_sizes.values(),
+                   key=lambda media_size: media_size.dimensions.width * media_size.dimensions.height)
+
     def get_exporter_instance(self, media_size_name: str):
         key = media_size_name.lower()
         if key not in self.media_sizes:
@@ -167,25 +245,100 @@ class ExportManager:
         self.exporter_instances[media_size.lower_name] = exporter_instance
         return exporter_instance
 
+    def get_variant_exporter_instance(self, media_size_name: str, width: int):
+        """ Returns the exporter of a srcset variant of a media size,
+            which downscales the exports of that media size to the given width.
+        """
+        media_size = self.get_media_size(media_size_name)
+        if width not in media_size.srcset_widths:
+            raise RuntimeError(f'width is not a srcset width of {media_size.lower_name}: {width}')
+        key = f'{media_size.lower_name}-{width}w'
+        if key in self.exporter_instances:
+            return self.exporter_instances[key]
+        exporter_instance = darktable.ResampledExporter(
+            source=self.get_exporter_instance(media_size.lower_name),
+            cache_key=key,
+            filename_format=self.EXPORT_FILENAME_FORMAT.render(media_size=key),
+            width=width,
+            height=media_size.dimensions.height,
+            debug=MediaExporter.defaults['debug'],
+        )
+        self.exporter_instances[key] = exporter_instance
+        return exporter_instance
+
+    def get_codec_exporter_instance(self, exporter: darktable.Exporter, out_ext: str):
+        """ Returns the exporter that encodes the exports of another exporter
+            in a different format, with the same dimensions.
+        """
+        key = f'{exporter.name}-{out_ext}'
+        if key in self.exporter_instances:
+            return self.exporter_instances[key]
+        exporter_instance = darktable.ResampledExporter(
+            source=exporter,
+            cache_key=key,
+            filename_format=self.EXPORT_FILENAME_FORMAT.render(media_size=key),
+            width=exporter.width,
+            height=exporter.height,
+            out_ext=out_ext,
+            debug=MediaExporter.defaults['debug'],
+        )
+        self.exporter_instances[key] = exporter_instance
+        return exporter_instance
+
+    def get_media_exporter(self, media_size_name: str, width: int = None, out_ext: str = None):
+        """ Returns the exporter for a media size,
+            its srcset variant with the given width and the given encoding.
+        """
+        if width is None:
+            exporter = self.get_exporter_instance(media_size_name)
+        else:
+            exporter = self.get_variant_exporter_instance(media_size_name, width)
+        if out_ext is not None and out_ext.lower() != exporter.out_ext.lower():
+            exporter = self.get_codec_exporter_instance(exporter, out_ext.lower())
+        return exporter
+
     def create_darktable_exporter(self, media_size: MediaSize):
         format_string = self.EXPORT_FILENAME_FORMAT.render(media_size=media_size.lower_name)
+        largest_media_size = self.largest_media_size
+        if self.multi_resolution and media_size.lower_name != largest_media_size.lower_name:
+            return darktable.ResampledExporter(
+                source=self.get_exporter_instance(largest_media_size.lower_name),
+                cache_key=media_size.lower_name,
+                filename_format=format_string,
+                width=media_size.dimensions.width,
+                height=media_size.dimensions.height,
+                debug=MediaExporter.defaults['debug'],
+                placeholders=True,
+            )
         return MediaExporter(
             cache_key=media_size.lower_name,
             filename_format=format_string,
             width=media_size.dimensions.width,
             height=media_size.dimensions.height,
+            placeholders=True,
         )
 
+    def create_sample_exporter(self):
+        if self.multi_resolution:
+            source = self.get_exporter_instance(self.largest_media_size.lower_name)
+            return ResampledSampleExporter(source)
+        return SampleExporter()
 
-export_manager = ExportManager()
+
+export_manager = ExportManager(
+    multi_resolution=config.get('EXPORT_MULTI_RESOLUTION', '').lower() == 'true'
+)
 # export_manager.register_media_size(MediaSize(MediaSize.LARGE, Dimensions(width=2560, height=1440)))
 # export_manager.register_media_size(MediaSize(MediaSize.LARGE, Dimensions(width=1920, height=1280)))
 # export_manager.register_media_size(MediaSize(MediaSize.MEDIUM, Dimensions(width=1592, height=896)))
-export_manager.register_media_size(MediaSize(MediaSize.LARGE, Dimensions(width=1728, height=972)))
-export_manager.register_media_size(MediaSize(MediaSize.MEDIUM, Dimensions(width=1080, height=972)))
+export_manager.register_media_size(MediaSize(MediaSize.LARGE, Dimensions(width=1728, height=972),
+                                             srcset_widths=[960, 1280]))
+export_manager.register_media_size(MediaSize(MediaSize.MEDIUM, Dimensions(width=1080, height=972),
+                                             srcset_widths=[360, 540, 720]))
 export_manager.register_media_size(MediaSize(MediaSize.SMALL, Dimensions(width=256, height=256)))
 
-sample_exporter = SampleExporter()
+sample_exporter = export_manager.create_sample_exporter()
+aspect_ratio_resolver = darktable.AspectRatioResolver(xmp_changes=sample_exporter.xmp_changes)
 
 portfolio_galleries = {
     tag: display_name
@@ -196,6 +349,9 @@ portfolio_galleries = {
 }
 
 
+photo_index = PhotoIndex(config['DARKTABLE_CONFIG_DIR'], config['PORTFOLIO_ROOT_TAG'])
+
+
 def get_darktable_library() -> darktable.DarktableLibrary:
     return darktable.DarktableLibrary(config['DARKTABLE_CONFIG_DIR'])
 
@@ -212,24 +368,120 @@ def get_darktable_library() -> darktable.DarktableLibrary:
 
 class MediaUrl:
     format = '/media/{media_size}/{id}.{file_extension}'
+    variant_format = '/media/{media_size}/{width}w/{id}.{file_extension}'
 
     @classmethod
     def render(cls, **kwargs):
         return cls.format.format(**kwargs)
 
+    @classmethod
+    def render_variant(cls, **kwargs):
+        return cls.variant_format.format(**kwargs)
+
 
 class PhotoAsset:
-    def __init__(self, photo: darktable.Photo, aspect_ratio: float, date_key: datetime.datetime):
+    def __init__(self, photo: darktable.Photo, aspect_ratio: float, date_key: datetime.datetime,
+                 source_digest: str = None):
         self.photo: darktable.Photo = photo
         self.aspect_ratio: float = aspect_ratio
         self.date_key: datetime.datetime = date_key
+        # digest of the photo's source files when the asset was created,
+        # assets are recreated whenever the photos of their gallery change,
+        # in the library or through their XMP sidecar (see PhotoIndex)
+        self.source_digest: str = source_digest
+
+    def get_url(self, media_size: str = MediaSize.DEFAULT, versioned=True, width: int = None,
+                out_ext: str = None):
+        """ Returns the url of the photo's export with the given size,
+            or of its srcset variant with the given width,
+            encoded with the given codec (see EXPORT_CODECS).
+            Versioned urls contain the digest of the current export,
+            so they change whenever the photo is edited.
+        """
+        file_extension = out_ext or config['EXPORT_EXT']
+        if width is None:
+            url = MediaUrl.render(
+                media_size=media_size.lower(),
+                id=str(self.photo.id),
+                file_extension=file_extension
+            )
+        else:
+            url = MediaUrl.render_variant(
+                media_size=media_size.lower(),
+                width=str(width),
+                id=str(self.photo.id),
+                file_extension=file_extension
+            )
+        exporter = export_manager.get_media_exporter(media_size, width, out_ext)
+        url = url.removeprefix('/')
+        if versioned:
+            url += '?v=' + media_version(exporter.export_digest(self.photo, self.source_digest))
+        return url
+
+    def srcset(self, media_size: str, out_ext: str = None) -> str:
+        """ Lists the export of the given size and all of its smaller variants
+            with their widths, for the srcset attribute of an image.
+        """
+        size = export_manager.get_media_size(media_size)
+        export_width = round(self.dimensions_for_media_size(size).width)
+        candidates = [
+            f'{self.get_url(media_size, width=width, out_ext=out_ext)} {width}w'
+            for width in self.srcset_widths(media_size)
+        ]
+        candidates.append(f'{self.get_url(media_size, out_ext=out_ext)} {export_width}w')
+        return ', '.join(candidates)
+
+    def srcset_widths(self, media_size: str) -> list[int]:
+        """ The widths of the srcset variants that are smaller than
+            the photo's export with the given size.
+        """
+        size = export_manager.get_media_size(media_size)
+        export_width = round(self.dimensions_for_media_size(size).width)
+        return [width for width in size.srcset_widths if width < export_width]
+
+    def media_exporters(self) -> list[darktable.Exporter]:
+        """ The exporters of all files that pages may link to for this photo:
+            every media size, its srcset variants and their encodings.
+            Exporters that others downscale from come first.
+        """
+        media_sizes = sorted(export_manager.media_sizes.values(),
+                             key=lambda size: size.dimensions.width * size.dimensions.height, reverse=True)
+        exporters = []
+        for out_ext in [None] + EXPORT_CODECS:
+            for media_size in media_sizes:
+                for width in [None] + self.srcset_widths(media_size.lower_name):
+                    exporters.append(export_manager.get_media_exporter(media_size.lower_name, width, out_ext))
+        return exporters
 
-    def get_url(self, media_size: str = MediaSize.DEFAULT):
-        return MediaUrl.render(
-            media_size=media_size.lower(),
-            id=str(self.photo.id),
-            file_extension=config['EXPORT_EXT']
-        ).removeprefix('/')
+    @property
+    def placeholder(self) -> tuple[str, str]:
+        """ The placeholder of the photo as (data uri, colour),
+            taken from its smallest export that already exists.
+            Photos are not exported for it, None if there is no export yet.
+        """
+        media_sizes = sorted(export_manager.media_sizes.values(),
+                             key=lambda size: size.dimensions.width * size.dimensions.height)
+        for media_size in media_sizes:
+            exporter = export_manager.get_exporter_instance(media_size.lower_name)
+            export, _ = exporter.find_export(self.photo, self.source_digest)
+            if export is not None:
+                return exporter.placeholder(export)
+        return None
+
+    def sizes(self, media_size: str) -> str:
+        """ The sizes attribute for srcset(), assuming the image is displayed
+            at most as wide as its export (the gallery script uses the actual width).
+        """
+        export_width = round(self.dimensions_for_media_size(export_manager.get_media_size(media_size)).width)
+        return f'(max-width: {export_width}px) 100vw, {export_width}px'
+
+    def date_group(self, gallery_name: str) -> tuple[str, str]:
+        """ The key and the display name of the group of photos
+            the photo is shown in, by day or by month.
+        """
+        if gallery_name == 'virtual':
+            return self.date_key.strftime('%Y-%m-%d'), self.date_key.strftime('%B %-d')
+        return self.date_key.strftime('%B').lower(), self.date_key.strftime('%B')
 
     def dimensions_for_media_size(self, media_size: MediaSize):
         calculated_width = media_size.dimensions.height * self.aspect_ratio
@@ -242,60 +494,21 @@ class PhotoAsset:
 
 
 def get_portfolio_photos(sub_tag: str = None, include_root_tag=False) -> list[darktable.Photo]:
-    photos: list[darktable.Photo] = list()
-    with get_darktable_library() as lib:
-        for tag in lib.get_subtags(config['PORTFOLIO_ROOT_TAG'], including_tag=include_root_tag):
-            tag_path = tag.name.split('|')
-            if sub_tag is None or len(tag_path) == 2 and tag_path[1] == sub_tag:
-                photos.extend(lib.get_tagged_photos(tag))
-    return photos
-
-
-def filmroll_average_dates(photos: list[darktable.Photo]) -> dict[int, datetime.datetime]:
-    """ Determines the average datetime for each film roll,
-        given a subset of the photos in that film roll.
-        Returns a dictionary mapping the film roll id to the average date.
-    """
-    # determine the minimum and maximum date in each film roll
-    filmroll_dates_minmax = dict()
-    for photo in photos:
-        fr = photo.film_roll.id
-        dt = photo.datetime_taken
-        if fr in filmroll_dates_minmax:
-            lo, hi = filmroll_dates_minmax[fr]
-            filmroll_dates_minmax[fr] = (min(lo, dt), max(hi, dt))
-        else:
-            filmroll_dates_minmax[fr] = (dt, dt)
-
-    # determine the average
-    filmroll_keys = dict()
-    for fr, (lo, hi) in filmroll_dates_minmax.items():
-        avg = lo + (hi - lo) / 2
-        filmroll_keys[fr] = avg
-
-    return filmroll_keys
+    return photo_index.get_photos(sub_tag, include_root_tag=include_root_tag)
 
 
-def create_photo_assets(photos: list[darktable.Photo]) -> list[PhotoAsset]:
-    filmroll_dates = filmroll_average_dates(photos)
+def create_photo_assets(photos: list[darktable.Photo], date_keys: list[datetime.datetime],
+                        source_digests: dict[int, str] = {}) -> list[PhotoAsset]:
     media_assets: list[PhotoAsset] = []
 
-    for photo in photos:
-        filmroll_date = filmroll_dates[photo.film_roll.id]
-        export = sample_exporter.get_sample_export(photo)
-        media_assets.append(PhotoAsset(photo, export.aspect_ratio, filmroll_date))
-
-    return media_assets
+    def sample_aspect_ratios(photos: list[darktable.Photo]) -> list[float]:
+        return [export.aspect_ratio for export in sample_exporter.get_sample_exports(photos)]
 
+    aspect_ratios = aspect_ratio_resolver.get_aspect_ratios(photos, fallback=sample_aspect_ratios)
+    for photo, aspect_ratio, date_key in zip(photos, aspect_ratios, date_keys):
+        media_assets.append(PhotoAsset(photo, aspect_ratio, date_key, source_digests.get(photo.id)))
 
-def sorted_photo_assets(photo_assets: list[PhotoAsset]) -> list[PhotoAsset]:
-    def filmroll_key(photo_asset: PhotoAsset):
-        return photo_asset.date_key
-    def datetime_key(photo_asset: PhotoAsset):
-        return photo_asset.photo.datetime_taken
-    sorted_assets = sorted(photo_assets, key=datetime_key)
-    sorted_assets = sorted(sorted_assets, key=filmroll_key, reverse=True)
-    return sorted_assets
+    return media_assets
 
 
 # 2023-07-01_13.09.19_highres.png
@@ -310,15 +523,119 @@ def fix_photo_datetime_taken(photos: list[darktable.Photo]) -> list[darktable.Ph
     return result
 
 
-def get_gallery_photos(gallery_tag: str) -> list[darktable.Photo]:
-    photos = get_portfolio_photos(gallery_tag)
-    # photos = fix_photo_datetime_taken(photos)
-    photo_assets = create_photo_assets(photos)
-    if gallery_tag == 'virtual':
+def get_source_digests(photos: list[darktable.Photo]) -> dict[int, str]:
+    """ The digests of the source files of the photos by their id.
+        Photos whose raw file or XMP sidecar is missing are left out.
+    """
+    source_digests = {}
+    for photo in photos:
+        try:
+            source_digests[photo.id] = darktable.photo_manifest.source_digest(photo)
+        except FileNotFoundError as e:
+            print(f'skipping photo {photo.id}, its source file is missing: {e.filename}')
+    return source_digests
+
+
+def get_gallery_photos(gallery_tag: str) -> list[PhotoAsset]:
+    def create_gallery_photos():
+        photos = get_portfolio_photos(gallery_tag)
+        # the digests are needed for every url of the gallery
+        source_digests = get_source_digests(photos)
+        photos = [photo for photo in photos if photo.id in source_digests]
+        # photos = fix_photo_datetime_taken(photos)
+        columns = PhotoColumns(photos)
+        if gallery_tag == 'virtual':
+            date_keys = columns.timestamps
+        else:
+            # photos are grouped by the average date of their film roll
+            date_keys = columns.film_roll_midpoints()
+        photo_assets = create_photo_assets(photos, timestamps_to_datetimes(date_keys), source_digests)
+        # latest first, photos of the same group in the order they were taken
+        return [photo_assets[i] for i in columns.date_order(date_keys)]
+
+    # only recreated when photos of the gallery or their sidecars changed,
+    # so the versioned urls of the assets always contain the current digests
+    tag_name = f"{config['PORTFOLIO_ROOT_TAG']}|{gallery_tag}"
+    return photo_index.memoize(('gallery', gallery_tag), [tag_name], create_gallery_photos)
+
+
+def get_gallery_layout(gallery_tag: str) -> str:
+    """ Returns the justified rows of a gallery for all layout breakpoints
+        (see app/layout.py) as compact JSON, to be embedded next to the gallery.
+    """
+    def create_gallery_layout():
+        photo_assets = get_gallery_photos(gallery_tag)
+        # the same values as the gallery script reads from the page
+        aspect_ratios = [round(asset.aspect_ratio, 6) for asset in photo_assets]
+        orders = []
+        previous_key = None
         for asset in photo_assets:
-            asset.date_key = asset.photo.datetime_taken
-    photo_assets = sorted_photo_assets(photo_assets)
-    return photo_assets
+            key, _ = asset.date_group(gallery_tag)
+            if previous_key is not None and key != previous_key:
+                orders.append(orders[-1] + 1)
+            else:
+                orders.append(orders[-1] if len(orders) > 0 else 0)
+            previous_key = key
+        return json.dumps(gallery_layout(aspect_ratios, orders), separators=(',', ':'))
+
+    tag_name = f"{config['PORTFOLIO_ROOT_TAG']}|{gallery_tag}"
+    return photo_index.memoize(('layout', gallery_tag), [tag_name], create_gallery_layout)
+
+
+class ExportPriorities:
+    """ Priorities of the exports that clients wait for (see ExportScheduler),
+        which all come before background exports:
+        photos of the most recently viewed gallery first, then smaller
+        media sizes (the grid) before larger ones (the viewer) and photos
+        in the order of the gallery, so that the first rows appear first.
+        The gallery of a media request is the page that referred to it.
+        Positions are only known once the gallery was rendered,
+        media requests never compute them.
+    """
+
+    def __init__(self):
+        # gallery name -> number of the latest view of it
+        self._views: dict[str, int] = {}
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def viewed(self, gallery: str):
+        with self._lock:
+            self._views[gallery] = next(self._counter)
+
+    def for_request(self, exporter: darktable.Exporter, photo: darktable.Photo) -> tuple:
+        gallery = referring_gallery()
+        if gallery is None:
+            return (0, 0, exporter.width * exporter.height, sys.maxsize)
+        positions = photo_index.memoized(('positions', gallery), {})
+        with self._lock:
+            view = self._views.get(gallery, 0)
+        return (0, -view, exporter.width * exporter.height, positions.get(photo.id, sys.maxsize))
+
+
+export_priorities = ExportPriorities()
+
+
+def referring_gallery() -> str:
+    """ The gallery of the page the current request was made from, if any.
+    """
+    if request.referrer is None:
+        return None
+    referrer = urlsplit(request.referrer)
+    if referrer.netloc and referrer.netloc != request.host:
+        return None
+    gallery = referrer.path.strip('/').lower() or config['PORTFOLIO_INDEX_GALLERY']
+    return gallery if gallery in portfolio_galleries else None
+
+
+def get_gallery_positions(gallery_tag: str) -> dict[int, int]:
+    """ The position of every photo of a gallery by the photo's id.
+    """
+    def create_gallery_positions():
+        return {asset.photo.id: i for i, asset in enumerate(get_gallery_photos(gallery_tag))}
+
+    tag_name = f"{config['PORTFOLIO_ROOT_TAG']}|{gallery_tag}"
+    return photo_index.memoize(('positions', gallery_tag), [tag_name], create_gallery_positions)
 
 
 @app.route(MediaUrl.render(
@@ -332,27 +649,201 @@ def media(media_size: str, id: int, file_extension: str):
         the extension must be the same as the one configured in config.env.
         the image is updated if the XMP or export parameters change,
         otherwise the cached export is returned for fast access.
+        Responses carry the export's digest as ETag and support
+        conditional and range requests. URLs with the current version
+        of the export (see PhotoAsset.get_url()) can be cached forever.
     """
 
-    if file_extension.lower() != config['EXPORT_EXT'].lower():
+    media_size, file_extension = check_media_request(media_size, file_extension)
+    return serve_media(export_manager.get_media_exporter(media_size, out_ext=file_extension), id)
+
+
+@app.route(MediaUrl.render_variant(
+    media_size='<string:media_size>',
+    width='<int:width>',
+    id='<int:id>',
+    file_extension='<string:file_extension>'
+))
+def media_variant(media_size: str, width: int, id: int, file_extension: str):
+    """ Like media(), but for a smaller srcset variant of the media size.
+    """
+
+    media_size, file_extension = check_media_request(media_size, file_extension)
+    if width not in export_manager.get_media_size(media_size).srcset_widths:
+        abort(404)
+    return serve_media(export_manager.get_media_exporter(media_size, width, file_extension), id)
+
+
+def check_media_request(media_size: str, file_extension: str) -> tuple[str, str]:
+    """ Requests for the configured extension are answered with
+        the smallest encoding the client accepts, other codecs are explicit.
+    """
+    file_extension = file_extension.lower()
+    if file_extension != config['EXPORT_EXT'].lower() and file_extension not in EXPORT_CODECS:
         raise RuntimeError('media file extension is not the configured extension')
     media_size = media_size.lower()
     if not export_manager.has_media_size(media_size):
         raise RuntimeError('unsupported media size')
-    exporter = export_manager.get_exporter_instance(media_size)
-    with get_darktable_library() as lib:
-        # only include portfolio photos, not others
-        portfolio_tag = lib.get_tag(config['PORTFOLIO_ROOT_TAG'])
-        photo = lib.get_photo_by_id_and_tag(id=id, tag=portfolio_tag)
+    return media_size, file_extension
+
+
+def serve_media(exporter: darktable.Exporter, id: int):
+    # only include portfolio photos, not others
+    photo = photo_index.get_photo(id, config['PORTFOLIO_ROOT_TAG'])
     if photo is None:
         abort(404)
-    photo_export = exporter.export_cached(photo, out_dir=config['EXPORT_DIR'])
+    # up to date exports (and thus 304 responses) need neither darktable nor the scheduler
+    photo_export, up_to_date = exporter.find_export(photo)
+    if not up_to_date:
+        # jumps ahead of background exports, e.g. of the watch command
+        priority = export_priorities.for_request(exporter, photo)
+        if ASYNC_MEDIA:
+            return async_media(photo, exporter, photo_export, priority)
+        photo_export = exporter.submit_export_cached(photo, config['EXPORT_DIR'], priority).result()
     if photo is None:
         raise RuntimeError('export is empty')
-    return send_file(
+    if exporter.out_ext.lower() == config['EXPORT_EXT'].lower() and len(EXPORT_CODECS) > 0:
+        return send_negotiated_export(exporter, photo_export)
+    return send_export(photo_export)
+
+
+def media_version(digest: str):
+    return digest[:MEDIA_VERSION_LENGTH]
+
+
+def send_export(photo_export: darktable.Export, version_digest: str = None):
+    """ Sends an export. version_digest is the digest that versioned urls
+        of the export refer to, which is the export's own by default.
+    """
+    photo = photo_export.photo
+    version_digest = version_digest or photo_export.digest
+    response = send_file(
         path_or_file=path.join(os.getcwd(), photo_export.filepath),
-        download_name=f'{os.path.splitext(os.path.basename(photo.filepath))[0]}{os.path.splitext(photo_export.filepath)[1]}'
+        download_name=f'{os.path.splitext(os.path.basename(photo.filepath))[0]}{os.path.splitext(photo_export.filepath)[1]}',
+        etag=photo_export.digest or True,
+        conditional=True
     )
+    version = request.args.get('v')
+    if version is not None and version_digest is not None \
+            and version == media_version(version_digest):
+        # the url changes whenever the export changes
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def send_negotiated_export(exporter: darktable.Exporter, photo_export: darktable.Export):
+    """ Sends the smallest encoding of an up to date export
+        that the client explicitly accepts. Encodings that don't exist yet
+        are created in the background, meanwhile the export itself is sent.
+    """
+    best_export = photo_export
+    best_size = exporter.export_size(photo_export)
+    for out_ext in EXPORT_CODECS:
+        mimetype = mimetypes.guess_type('media.' + out_ext)[0]
+        # every image request accepts */*, only explicitly listed types count
+        if not any(value == mimetype and quality > 0 for value, quality in request.accept_mimetypes):
+            continue
+        codec_exporter = export_manager.get_codec_exporter_instance(exporter, out_ext)
+        codec_export, up_to_date = codec_exporter.find_export(photo_export.photo)
+        if not up_to_date:
+            # after the exports of the same priority that clients wait for
+            priority = export_priorities.for_request(codec_exporter, photo_export.photo) + (1,)
+            codec_exporter.submit_export_cached(photo_export.photo, config['EXPORT_DIR'], priority)
+            continue
+        size = codec_exporter.export_size(codec_export)
+        if size < best_size:
+            best_export, best_size = codec_export, size
+    response = send_export(best_export, version_digest=photo_export.digest)
+    response.vary.add('Accept')
+    return response
+
+
+_codec_probes = None
+
+
+def codec_probes() -> dict[str, str]:
+    """ Tiny images of every codec in EXPORT_CODECS as data urls,
+        with which the gallery script detects which codecs a browser supports.
+    """
+    global _codec_probes
+    if _codec_probes is None:
+        probes = {}
+        for out_ext in EXPORT_CODECS:
+            buffer = io.BytesIO()
+            image_format = Image.registered_extensions()['.' + out_ext]
+            Image.new('RGB', (2, 2), (128, 128, 128)).save(buffer, format=image_format)
+            mimetype = mimetypes.guess_type('media.' + out_ext)[0]
+            probes[out_ext] = f'data:{mimetype};base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+        _codec_probes = probes
+    return _codec_probes
+
+
+def async_media(photo: darktable.Photo, exporter: darktable.Exporter, photo_export: darktable.Export = None,
+                priority: tuple = None):
+    """ Responds without waiting for Darktable.
+        An outdated export is served as is while the photo is exported again.
+        If there is no export yet, the export of another media size
+        or a placeholder image is served, with a hint to retry later.
+        Concurrent requests for the same photo share one export job.
+    """
+    exporter.submit_export_cached(photo, config['EXPORT_DIR'], priority)
+
+    if photo_export is None:
+        # fall back to the closest other media size that was already exported
+        for other_exporter in fallback_exporters(exporter):
+            photo_export, _ = other_exporter.find_export(photo)
+            if photo_export is not None:
+                break
+
+    if photo_export is not None:
+        response = send_export(photo_export)
+    else:
+        response = send_file(io.BytesIO(placeholder_image()), mimetype=placeholder_mimetype())
+        response.status_code = 503
+        response.headers['Retry-After'] = str(ASYNC_MEDIA_RETRY_AFTER)
+    # the response is replaced once the export is done
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def fallback_exporters(exporter: darktable.Exporter) -> list[darktable.Exporter]:
+    """ The exporters of the other media sizes whose exports can stand in
+        for those of the given exporter, closest first: larger sizes
+        from the smallest up, then smaller sizes from the largest down.
+        Sizes that are much larger are left out, they would be too heavy.
+    """
+    larger = []
+    smaller = []
+    for media_size in export_manager.media_sizes.values():
+        other_exporter = export_manager.get_exporter_instance(media_size.lower_name)
+        if other_exporter is exporter:
+            continue
+        scale = max(other_exporter.width / exporter.width, other_exporter.height / exporter.height)
+        if scale > ASYNC_MEDIA_MAX_FALLBACK_SCALE:
+            continue
+        (larger if scale >= 1 else smaller).append((scale, other_exporter))
+    larger.sort(key=lambda item: item[0])
+    smaller.sort(key=lambda item: item[0], reverse=True)
+    return [other_exporter for _, other_exporter in larger + smaller]
+
+
+_placeholder_image = None
+
+
+def placeholder_image() -> bytes:
+    """ A small grey image in the configured export format.
+    """
+    global _placeholder_image
+    if _placeholder_image is None:
+        buffer = io.BytesIO()
+        image_format = Image.registered_extensions()['.' + config['EXPORT_EXT'].lower()]
+        Image.new('RGB', (16, 16), (128, 128, 128)).save(buffer, format=image_format)
+        _placeholder_image = buffer.getvalue()
+    return _placeholder_image
+
+
+def placeholder_mimetype():
+    return mimetypes.guess_type('placeholder.' + config['EXPORT_EXT'])[0]
 
 
 @app.route("/")
@@ -368,23 +859,40 @@ def gallery(gallery: str):
     if gallery not in portfolio_galleries:
         abort(404)
     display_name = portfolio_galleries[gallery]
-    return render_template(
-        'gallery.jinja',
-        title=display_name,
-        menu_item=gallery,
-        photo_assets=get_gallery_photos(gallery),
-        export_manager=export_manager,
-        gallery_name=gallery
-    )
+    # the media requests of this page are exported first
+    export_priorities.viewed(gallery)
+    photo_assets = get_gallery_photos(gallery)
+    get_gallery_positions(gallery)
+    layout = get_gallery_layout(gallery)
+    with metrics.timer('template_render', template='gallery.jinja'):
+        return render_template(
+            'gallery.jinja',
+            title=display_name,
+            menu_item=gallery,
+            photo_assets=photo_assets,
+            export_manager=export_manager,
+            export_codecs=EXPORT_CODECS,
+            codec_probes=codec_probes(),
+            gallery_layout=layout,
+            gallery_name=gallery
+        )
 
 
 @app.route("/about")
 def contact():
-    return render_template(
-        'about.jinja',
-        title='About'
-    )
+    with metrics.timer('template_render', template='about.jinja'):
+        return render_template(
+            'about.jinja',
+            title='About'
+        )
+
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """ Timings of the export pipeline and cache hits of this process
+        in the Prometheus text format.
+    """
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
 
 
 @app.before_request
@@ -395,15 +903,15 @@ def check_duplicates():
     if not request.endpoint or request.endpoint.startswith(STATIC_URL):
         return
     media_url = str(pathlib.Path(*pathlib.Path(MediaUrl.format).parts[:2]))
-    if request.endpoint.startswith(media_url):
+    if request.endpoint.startswith(media_url) or request.endpoint == 'metrics_endpoint':
         return
-    if os.getenv(DEBUG_ENV) == '1':
-        print('checking if photos have multiple versions')
-    photos = get_portfolio_photos(include_root_tag=True)
-    visited = dict()
-    for photo in photos:
-        if photo.filepath in visited:
-            other_version = visited[photo.filepath]
-            if photo.version != other_version:
-                raise RuntimeError(f'multiple versions of the same photo: {photo.filepath}')
-        visited[photo.filepath] = photo.version
+    # only reads the verdict, the index validates whenever the library changes
+    photo_index.validate()
+
+
+@app.cli.command('validate')
+def validate_command():
+    """ Checks that no photo of the portfolio is included with multiple versions.
+    """
+    photo_index.validate()
+    print(f'{len(photo_index.snapshot.photos)} photos, no multiple versions')
@@ -0,0 +1,220 @@
+import os
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Hashable
+
+from app.metrics import metrics
+
+
+class JobQueue:
+    """ Priority queue of scheduled jobs. Lower priorities are taken first,
+        jobs with the same priority in the order they were put.
+        Only bounded jobs count towards maxsize, putting them blocks while it is full.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._heap = []
+        self._counter = itertools.count()
+        self._bounded = 0
+        self._changed = threading.Condition()
+
+    def put(self, priority: tuple, entry: tuple, bounded=True):
+        with self._changed:
+            if bounded:
+                while self._bounded >= self.maxsize:
+                    self._changed.wait()
+                self._bounded += 1
+            heapq.heappush(self._heap, (priority, next(self._counter), bounded, entry))
+            self._changed.notify_all()
+
+    def get(self) -> tuple:
+        with self._changed:
+            while len(self._heap) == 0:
+                self._changed.wait()
+            _, _, bounded, entry = heapq.heappop(self._heap)
+            if bounded:
+                self._bounded -= 1
+                self._changed.notify_all()
+            return entry
+
+
+class ExportScheduler:
+    """ Runs export jobs on a fixed number of worker threads.
+        Jobs are identified by a key and jobs with the same key
+        that are queued or running at the same time are only run once,
+        every caller receives the same future.
+        Queued jobs are run in the order of their priority (lower first),
+        submitting a queued job again with a lower priority promotes it.
+        Only background jobs are bounded, submitting them blocks while the queue is full.
+    """
+
+    # priority of jobs that nobody waits for yet, e.g. of freeze and watch
+    BACKGROUND = (1,)
+
+    def __init__(self, workers: int = None, queue_size: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size or self.workers * 16
+        self._queue = JobQueue(maxsize=self.queue_size)
+        self._pending: dict[Hashable, Future] = {}
+        # key of a job that is part of a batch -> key of the batch
+        self._batched: dict[Hashable, Hashable] = {}
+        # key of a job or batch that is not running yet -> [priority, queue entry]
+        self._queued: dict[Hashable, list] = {}
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+        self._local = threading.local()
+
+    @property
+    def in_worker(self):
+        return getattr(self._local, 'is_worker', False)
+
+    def submit(self, key: Hashable, fn: Callable, *args, priority: tuple = None, **kwargs) -> Future:
+        """ Schedules fn(*args, **kwargs) unless a job with the same key
+            is already queued or running, in which case its future is returned
+            and the queued job is promoted to the given priority, if that is lower.
+            Jobs that are submitted from within a worker are run immediately
+            in that worker, so that jobs can wait for other jobs
+            without exhausting the pool.
+        """
+        priority = priority or self.BACKGROUND
+        created = False
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = Future()
+                self._pending[key] = future
+                created = True
+                entry = (key, future, fn, args, kwargs, time.perf_counter())
+                if self.in_worker:
+                    future.set_running_or_notify_cancel()
+                else:
+                    self._queued[key] = [priority, entry]
+            else:
+                # jobs of a batch are queued as part of their batch
+                queue_key = self._batched.get(key, key)
+                queued = self._queued.get(queue_key)
+                if queued is None:
+                    # the job is running or done
+                    return future
+                entry = queued[1]
+                if self.in_worker:
+                    # claim the queued job (or its batch), its queue entry is skipped later
+                    del self._queued[queue_key]
+                    entry[1].set_running_or_notify_cancel()
+                elif priority < queued[0]:
+                    # whichever queue entry comes first runs the job
+                    queued[0] = priority
+                else:
+                    return future
+        if self.in_worker:
+            self._run(*entry[:5])
+            return future
+        if created:
+            self._start_workers()
+        # promotions don't wait for the queue
+        self._queue.put(priority, entry, bounded=created and priority >= self.BACKGROUND)
+        return future
+
+    def submit_batch(self, jobs: list[tuple[Hashable, object]], fn: Callable, *args,
+                     priority: tuple = None) -> list[Future]:
+        """ Schedules fn(items, *args) as a single job for all (key, item) jobs,
+            fn has to return a result for every item in the same order.
+            Items whose key is already queued or running are left out
+            and receive the future of that job. Every key gets its own future,
+            which can be shared with later submit() calls of the same key.
+        """
+        priority = priority or self.BACKGROUND
+        futures = []
+        batch = []
+        batch_future = Future()
+        batch_key = ('batch', id(batch_future))
+
+        def run_batch():
+            for _, _, future in batch:
+                future.set_running_or_notify_cancel()
+            try:
+                results = fn([item for _, item, _ in batch], *args)
+                if len(results) != len(batch):
+                    raise RuntimeError(f'expected {len(batch)} results of the batch, got {len(results)}')
+            except BaseException as e:
+                for key, _, future in batch:
+                    self._finish(key)
+                    future.set_exception(e)
+            else:
+                for (key, _, future), result in zip(batch, results):
+                    self._finish(key)
+                    future.set_result(result)
+
+        with self._lock:
+            for key, item in jobs:
+                future = self._pending.get(key)
+                if future is None:
+                    future = Future()
+                    self._pending[key] = future
+                    self._batched[key] = batch_key
+                    batch.append((key, item, future))
+                futures.append(future)
+            if len(batch) == 0:
+                return futures
+            entry = (batch_key, batch_future, run_batch, (), {}, time.perf_counter())
+            if self.in_worker:
+                batch_future.set_running_or_notify_cancel()
+            else:
+                self._queued[batch_key] = [priority, entry]
+        if self.in_worker:
+            self._run(*entry[:5])
+            return futures
+        self._start_workers()
+        self._queue.put(priority, entry, bounded=priority >= self.BACKGROUND)
+        return futures
+
+    def map(self, jobs: list[tuple[Hashable, Callable, tuple]]) -> list:
+        """ Submits all (key, fn, args) jobs at once and waits for them.
+            Returns the results in the order of the jobs.
+        """
+        futures = [self.submit(key, fn, *args) for key, fn, args in jobs]
+        return [future.result() for future in futures]
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f'{self.__class__.__name__}-{len(self._threads)}',
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        self._local.is_worker = True
+        while True:
+            key, future, fn, args, kwargs, queued = self._queue.get()
+            with self._lock:
+                # the job might have been run by a worker that waited for it
+                if future.running() or future.done():
+                    continue
+                future.set_running_or_notify_cancel()
+                self._queued.pop(key, None)
+            # long waits mean that more workers would help
+            metrics.observe('export_queue_wait', time.perf_counter() - queued)
+            self._run(key, future, fn, args, kwargs)
+
+    def _run(self, key, future: Future, fn, args, kwargs):
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key)
+            future.set_exception(e)
+        else:
+            self._finish(key)
+            future.set_result(result)
+
+    def _finish(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._batched.pop(key, None)
@@ -1,8 +1,11 @@
-import sys
+import os
+import pickle
 import hashlib
 import sqlite3
+import threading
+from contextlib import contextmanager
 
-import simple_cache
+from app.metrics import metrics
 
 
 def fullname(o):
@@ -21,22 +24,120 @@ def filehash(filepath):
     return sha1.hexdigest()
 
 
-def readonly_sqlite_connection(db_path):
-    con = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+def readonly_sqlite_connection(db_path, **kwargs):
+    con = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, **kwargs)
     con.row_factory = sqlite3.Row
     return con
 
 
+class CacheDatabase:
+    """ SQLite database in WAL mode that stores the entries of all caches
+        which share the same file. Every thread gets its own connection,
+        transactions are tracked per thread and may be nested,
+        only the outermost transaction commits.
+    """
+
+    # fixed so that pickled values (and thus lookups by value)
+    # stay stable across python versions
+    PICKLE_PROTOCOL = 4
+
+    _instances: dict[str, 'CacheDatabase'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._local = threading.local()
+
+    @classmethod
+    def open(cls, filepath) -> 'CacheDatabase':
+        filepath = os.path.abspath(filepath)
+        with cls._instances_lock:
+            if filepath not in cls._instances:
+                cls._instances[filepath] = cls(filepath)
+            return cls._instances[filepath]
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, 'connection', None)
+        if con is None:
+            con = sqlite3.connect(self.filepath, isolation_level=None, timeout=30)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.execute("""--sql
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY NOT NULL,
+                    value BLOB
+                ) WITHOUT ROWID
+            """)
+            con.execute("""--sql
+                CREATE INDEX IF NOT EXISTS cache_value ON cache (value)
+            """)
+            self._local.connection = con
+            self._local.depth = 0
+        return con
+
+    @contextmanager
+    def transaction(self):
+        con = self.connection
+        if self._local.depth == 0:
+            con.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield con
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                con.execute('ROLLBACK')
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            con.execute('COMMIT')
+
+    @classmethod
+    def dumps(cls, value) -> bytes:
+        return pickle.dumps(value, protocol=cls.PICKLE_PROTOCOL)
+
+    @staticmethod
+    def loads(data: bytes):
+        return pickle.loads(data)
+
+
 class Cache:
+    """ Persistent key-value cache. Keys are strings that are namespaced
+        with the given prefix, so that several caches can share one file.
+        Every operation is a single indexed query,
+        use transaction() to batch multiple writes into one commit.
+    """
+
     def __init__(self, cache_filepath, *, prefix=''):
         self.cache_filepath = cache_filepath
         self.key_prefix = prefix
+        self.db = CacheDatabase.open(cache_filepath)
+        self.metrics_label = prefix.rstrip(':') or 'default'
+
+    def _prefix_range(self):
+        # all keys that start with the prefix are within this range,
+        # which lets sqlite use the primary key index for prefix scans
+        if not self.key_prefix:
+            return ('', chr(0x10ffff))
+        upper = self.key_prefix[:-1] + chr(ord(self.key_prefix[-1]) + 1)
+        return (self.key_prefix, upper)
+
+    def transaction(self):
+        return self.db.transaction()
 
     def save(self, key, value):
-        return simple_cache.save_key(self.cache_filepath, self.key_prefix + key, value, sys.maxsize)
+        with metrics.timer('cache_write', cache=self.metrics_label):
+            self.db.connection.execute("""--sql
+                INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)
+            """, (self.key_prefix + key, self.db.dumps(value)))
 
     def load(self, key):
-        return simple_cache.load_key(self.cache_filepath, self.key_prefix + key)
+        with metrics.timer('cache_read', cache=self.metrics_label):
+            row = self.db.connection.execute("""--sql
+                SELECT value FROM cache WHERE key = ?
+            """, (self.key_prefix + key,)).fetchone()
+            return self.db.loads(row[0]) if row is not None else None
 
     def store(self, key):
         return self.save(key, True)
@@ -45,37 +146,50 @@ class Cache:
         return self.load(key) != None
 
     def delete(self, key):
-        cache = simple_cache.read_cache(self.cache_filepath)
-        actual_key = self.key_prefix + key
-        if actual_key in cache:
-            del cache[actual_key]
-        simple_cache.write_cache(self.cache_filepath, cache)
+        self.db.connection.execute("""--sql
+            DELETE FROM cache WHERE key = ?
+        """, (self.key_prefix + key,))
+
+    def delete_many(self, keys):
+        with metrics.timer('cache_write', cache=self.metrics_label), self.transaction() as con:
+            con.executemany("""--sql
+                DELETE FROM cache WHERE key = ?
+            """, [(self.key_prefix + key,) for key in keys])
 
     def prune(self):
-        cache = simple_cache.read_cache(self.cache_filepath)
-        for key in list(cache.keys()):
-            if key.startswith(self.key_prefix):
-                del cache[key]
-        simple_cache.write_cache(self.cache_filepath, cache)
+        self.db.connection.execute("""--sql
+            DELETE FROM cache WHERE key >= ? AND key < ?
+        """, self._prefix_range())
 
     def update(self, dictionary):
-        cache = simple_cache.read_cache(self.cache_filepath)
-        for key, value in dictionary.items():
-            cache[self.key_prefix + key] = (sys.maxsize, value)
-        simple_cache.write_cache(self.cache_filepath, cache)
+        with metrics.timer('cache_write', cache=self.metrics_label), self.transaction() as con:
+            con.executemany("""--sql
+                INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)
+            """, [
+                (self.key_prefix + key, self.db.dumps(value))
+                for key, value in dictionary.items()
+            ])
 
     def replace(self, dictionary):
-        self.prune()
-        self.update(dictionary)
+        with self.transaction():
+            self.prune()
+            self.update(dictionary)
 
     def items(self, *, has_value=None):
-        cache = simple_cache.read_cache(self.cache_filepath)
-        return [
-            (key.removeprefix(self.key_prefix), value)
-            for key, (_, value) in cache.items()
-            if key.startswith(self.key_prefix)
-            and (has_value is None or value == has_value)
-        ]
+        with metrics.timer('cache_read', cache=self.metrics_label):
+            if has_value is None:
+                cur = self.db.connection.execute("""--sql
+                    SELECT key, value FROM cache WHERE key >= ? AND key < ?
+                """, self._prefix_range())
+            else:
+                cur = self.db.connection.execute("""--sql
+                    SELECT key, value FROM cache
+                    WHERE value = ? AND key >= ? AND key < ?
+                """, (self.db.dumps(has_value),) + self._prefix_range())
+            return [
+                (key.removeprefix(self.key_prefix), self.db.loads(value))
+                for key, value in cur.fetchall()
+            ]
 
     def keys(self, *, has_value=None):
         return [k for k, v in self.items(has_value=has_value)]
@@ -0,0 +1,342 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+import traceback
+from collections import defaultdict
+from concurrent.futures import Future
+from os import path
+
+import click
+
+from app import app, darktable
+from app.config import config
+from app.index import PhotoIndex
+from app.routes import PhotoAsset, get_gallery_photos, photo_index, portfolio_galleries
+
+
+class PollingWatcher:
+    """ Detects changes of files by comparing their size and mtime
+        every few seconds. Works on every platform and file system.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._signatures: dict[str, tuple] = {}
+
+    def watch(self, filepaths: set[str]):
+        """ Replaces the watched files. Files that were watched before
+            keep their last known state, so that no change is missed.
+        """
+        self._signatures = {
+            filepath: self._signatures[filepath] if filepath in self._signatures else file_signature(filepath)
+            for filepath in filepaths
+        }
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Blocks until any of the watched files changed
+            or the timeout expired. Returns whether a file changed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if delay <= 0:
+                return False
+            time.sleep(delay)
+            changed = False
+            for filepath, signature in self._signatures.items():
+                current = file_signature(filepath)
+                if current != signature:
+                    self._signatures[filepath] = current
+                    changed = True
+            if changed:
+                return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """ Detects changes of files with Linux's inotify API (through ctypes),
+        by watching the directories that contain them.
+        Raises an OSError if inotify is not available.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o0004000
+
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('the c library does not support inotify')
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # directory -> names of the watched files in it
+        self._names: dict[str, set[str]] = {}
+        self._descriptors: dict[str, int] = {}
+        self._directories: dict[int, str] = {}
+
+    def watch(self, filepaths: set[str]):
+        """ Replaces the watched files.
+            Files in directories that don't exist are not watched.
+        """
+        names: dict[str, set[str]] = defaultdict(set)
+        for filepath in filepaths:
+            directory, name = path.split(path.abspath(filepath))
+            names[directory].add(name)
+        for directory in set(self._descriptors) - set(names):
+            self._libc.inotify_rm_watch(self._fd, self._descriptors.pop(directory))
+        for directory in set(names) - set(self._descriptors):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.WATCH_MASK)
+            if wd >= 0:
+                self._descriptors[directory] = wd
+                self._directories[wd] = directory
+        self._names = dict(names)
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Blocks until any of the watched files changed
+            or the timeout expired. Returns whether a file changed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if len(readable) == 0:
+                return False
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            if self._is_relevant(data):
+                return True
+
+    def _is_relevant(self, data: bytes) -> bool:
+        relevant = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                relevant = True
+            elif mask & self.IN_IGNORED:
+                # the directory was removed
+                directory = self._directories.pop(wd, None)
+                if directory is not None and self._descriptors.get(directory) == wd:
+                    del self._descriptors[directory]
+                relevant = True
+            elif name in self._names.get(self._directories.get(wd), ()):
+                relevant = True
+        return relevant
+
+    def close(self):
+        os.close(self._fd)
+
+
+def file_signature(filepath):
+    try:
+        return darktable.stat_signature(filepath)
+    except FileNotFoundError:
+        return None
+
+
+def create_watcher(polling=False, interval=2.0):
+    """ Returns an InotifyWatcher if possible, otherwise a PollingWatcher.
+    """
+    if not polling:
+        try:
+            return InotifyWatcher()
+        except OSError:
+            pass
+    return PollingWatcher(interval)
+
+
+class ExportWarmer:
+    """ Exports the photos of the portfolio ahead of time,
+        so that pages and media never wait for darktable.
+        Every pass determines which photos entered, left or changed
+        (in the library or through their XMP sidecar) since the previous pass
+        and exports only those. When photos left the portfolio,
+        their exports are removed with Exporter.sync(), unless sync is False.
+    """
+
+    def __init__(self, index: PhotoIndex, out_dir, debug=False, sync=True):
+        self.index = index
+        self.out_dir = out_dir
+        self.debug = debug
+        self.sync = sync
+        # photo id -> state of the photo in the previous pass
+        self._states: dict[int, tuple] = None
+
+    def watched_files(self) -> set[str]:
+        """ The darktable databases and the XMP sidecars of the portfolio.
+        """
+        filepaths = set(path.join(self.index.config_dir, filename) for filename in PhotoIndex.DB_FILES)
+        for photo in self.index.snapshot.photos.values():
+            filepaths.add(photo.xmp_path)
+        return filepaths
+
+    def gallery_assets(self) -> dict[int, PhotoAsset]:
+        assets: dict[int, PhotoAsset] = {}
+        for gallery in portfolio_galleries.keys():
+            for asset in get_gallery_photos(gallery):
+                assets.setdefault(asset.photo.id, asset)
+        return assets
+
+    def run_pass(self) -> bool:
+        """ Exports new and changed photos and removes the exports
+            of photos that left the portfolio. Returns whether anything changed.
+        """
+        started = time.monotonic()
+        # the index is reloaded for changed sidecars as well,
+        # so the gallery assets below reflect the current edits
+        self.index.refresh(check_sidecars=True)
+        states = dict(self.index.snapshot.photo_signatures)
+        first_pass = self._states is None
+        previous = self._states or {}
+        entered = [id for id in states if id not in previous]
+        left = [id for id in previous if id not in states]
+        changed = [id for id in states if id in previous and states[id] != previous[id]]
+        if not first_pass and len(entered) + len(left) + len(changed) == 0:
+            return False
+
+        assets = self.gallery_assets()
+        # the exports of all photos have to be part of the exporters' session
+        # before sync() removes everything else (which is cheap for exported photos)
+        needs_sync = self.sync and (first_pass or len(left) > 0)
+        export_ids = assets.keys() if needs_sync else set(entered + changed) & assets.keys()
+        exporters: dict[str, darktable.Exporter] = {}
+        exporter_photos: dict[str, list[darktable.Photo]] = {}
+        for id in export_ids:
+            asset = assets[id]
+            for exporter in asset.media_exporters():
+                exporters[exporter.name] = exporter
+                exporter_photos.setdefault(exporter.name, []).append(asset.photo)
+        # the largest media sizes come first (see media_exporters()),
+        # the photos of an exporter are exported in batches
+        jobs: list[tuple[darktable.Exporter, darktable.Photo, Future]] = []
+        for name, photos in exporter_photos.items():
+            futures = exporters[name].submit_export_cached_many(photos, self.out_dir)
+            jobs.extend((exporters[name], photo, future) for photo, future in zip(photos, futures))
+        failed_ids = set()
+        failed = 0
+        for exporter, photo, future in jobs:
+            try:
+                future.result()
+            except Exception as e:
+                failed_ids.add(photo.id)
+                failed += 1
+                print(f'failed to export {photo.filepath} ({exporter.name}): {e}')
+
+        print(f'{len(entered)} entered, {len(changed)} changed, {len(left)} left: '
+              f'{len(jobs) - failed} exports up to date in {time.monotonic() - started:.1f}s'
+              + (f', {failed} failed' if failed > 0 else ''))
+        if needs_sync:
+            if failed > 0:
+                # outdated exports of the failed photos would be removed
+                print('exports are not synced, since some failed')
+            else:
+                for name, exporter in sorted(exporters.items()):
+                    directory = path.join(self.out_dir, path.dirname(exporter.filename_format))
+                    report = exporter.sync(directory)
+                    if self.debug or len(report.removed_files) > 0:
+                        print(f'{name}: {report}')
+        # failed photos are tried again in the next pass
+        self._states = {id: state for id, state in states.items() if id not in failed_ids}
+        return True
+
+    def watch(self, watcher, settle: float):
+        """ Runs a pass whenever watched files changed, forever.
+        """
+        while True:
+            watcher.watch(self.watched_files())
+            watcher.wait()
+            while watcher.wait(settle):
+                pass
+            try:
+                self.run_pass()
+            except Exception:
+                traceback.print_exc()
+
+
+# export ahead of time in a thread of the server,
+# where requests of clients take priority over it (see ExportPriorities)
+WATCH_IN_SERVER = config.get('EXPORT_WATCH', '').lower() == 'true'
+
+_background_watch: threading.Thread = None
+_background_watch_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_watch():
+    """ Starts watching with the first request of the server,
+        so that neither CLI commands nor the reloader's process watch.
+    """
+    global _background_watch
+    if not WATCH_IN_SERVER or _background_watch is not None:
+        return
+    with _background_watch_lock:
+        if _background_watch is None:
+            _background_watch = threading.Thread(target=run_background_watch, name='ExportWarmer', daemon=True)
+            _background_watch.start()
+
+
+def run_background_watch():
+    # requests export and serve files concurrently, which sync() could remove
+    # while they're being written or read, "flask watch" and "flask freeze" sync instead
+    warmer = ExportWarmer(photo_index, config['EXPORT_DIR'], sync=False)
+    watcher = create_watcher()
+    try:
+        try:
+            warmer.run_pass()
+        except Exception:
+            traceback.print_exc()
+        warmer.watch(watcher, settle=1.0)
+    finally:
+        watcher.close()
+
+
+@app.cli.command('watch')
+@click.option('--poll', is_flag=True, help='Poll for changes instead of using inotify.')
+@click.option('--interval', default=2.0, show_default=True, help='Seconds between polls.')
+@click.option('--settle', default=1.0, show_default=True,
+              help='Seconds without changes before exporting, darktable writes in bursts.')
+@click.option('--once', is_flag=True, help='Export once and exit.')
+@click.option('--debug', is_flag=True, help='Print a sync report for every media size.')
+def watch_command(poll, interval, settle, once, debug):
+    """ Watches the darktable library and the XMP sidecars of the portfolio
+        and exports photos as soon as they are added to the portfolio or edited.
+    """
+    warmer = ExportWarmer(photo_index, config['EXPORT_DIR'], debug=debug)
+    warmer.run_pass()
+    if once:
+        return
+    watcher = create_watcher(polling=poll, interval=interval)
+    print(f'watching with {watcher.__class__.__name__}')
+    try:
+        warmer.watch(watcher, settle)
+    finally:
+        watcher.close()
@@ -0,0 +1,188 @@
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Callable
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element
+
+from app.metrics import metrics
+from app.util import fullname
+
+
+XMP_NAMESPACES = {
+    'x': 'adobe:ns:meta/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'darktable': 'http://darktable.sf.net/',
+}
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+XmpChange = Callable[[Element, dict[str, str]], None]
+
+
+def parse_xmp(in_filename) -> tuple[Element, dict[str, str]]:
+    """ Parses an XMP file in a single pass.
+        Returns the root element and the namespaces declared in the file.
+    """
+    namespaces = {}
+    parser = ElementTree.iterparse(in_filename, events=['start-ns'])
+    for _, (name, uri) in parser:
+        namespaces[name] = uri
+    return parser.root, namespaces
+
+
+def clark_name(name: str) -> str:
+    """ Turns a prefixed name of XMP_NAMESPACES (e.g. "rdf:li")
+        into ElementTree's "{uri}local" notation.
+    """
+    prefix, local = name.split(':')
+    return f'{{{XMP_NAMESPACES[prefix]}}}{local}'
+
+
+def xmp_visitor(tag: str, within: str = None):
+    """ Declares an XMP change as a visitor of all elements with the given tag
+        (e.g. "rdf:li"), optionally only of those below an element
+        with the tag within. Instead of the root of the XMP
+        the change is called with every matching element,
+        so that all changes of an XmpTransform need a single walk of the tree.
+    """
+    def decorator(func: XmpChange) -> XmpChange:
+        func.xmp_visitor = (clark_name(tag), clark_name(within) if within else None)
+        return func
+    return decorator
+
+
+class XmpTransform:
+    """ Applies a list of changes to XMP files.
+        Changes that are visitors (see xmp_visitor()) are applied
+        in a single walk of the tree, others are called with the root.
+        The result is serialized without ElementTree's global namespace registry,
+        so transforms can be used from many threads at once.
+        Results are memoized by the hash of the XMP's contents.
+        Transforms are shared by everything that uses the same changes,
+        see for_changes().
+    """
+
+    MEMO_SIZE = 256
+
+    _transforms: dict[tuple[str, ...], 'XmpTransform'] = {}
+    _transforms_lock = threading.Lock()
+
+    def __init__(self, changes: list[XmpChange]):
+        self.changes = list(changes)
+        self._visitors: dict[str, list[tuple[str, XmpChange]]] = defaultdict(list)
+        self._root_changes: list[XmpChange] = []
+        for func in self.changes:
+            if hasattr(func, 'xmp_visitor'):
+                tag, within = func.xmp_visitor
+                self._visitors[tag].append((within, func))
+            else:
+                self._root_changes.append(func)
+        self._memo: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_changes(cls, changes: list[XmpChange]) -> 'XmpTransform':
+        key = tuple(fullname(func) for func in changes)
+        with cls._transforms_lock:
+            if key not in cls._transforms:
+                cls._transforms[key] = cls(changes)
+            return cls._transforms[key]
+
+    def apply(self, root: Element, namespaces: dict[str, str]):
+        """ Changes the tree of an XMP in place.
+        """
+        if len(self._visitors) > 0:
+            ancestors: dict[str, int] = defaultdict(int)
+
+            def walk(element: Element):
+                for within, func in self._visitors.get(element.tag, []):
+                    if within is None or ancestors[within] > 0:
+                        func(element, namespaces)
+                ancestors[element.tag] += 1
+                for child in element:
+                    walk(child)
+                ancestors[element.tag] -= 1
+
+            walk(root)
+        for func in self._root_changes:
+            func(root, namespaces)
+
+    def transform(self, in_filename, xmp_hash: str = None) -> bytes:
+        """ Returns the changed contents of an XMP file.
+            If the hash of the file's contents is given,
+            a file with the same contents is only transformed once.
+        """
+        if xmp_hash is not None:
+            with self._lock:
+                data = self._memo.get(xmp_hash)
+                if data is not None:
+                    self._memo.move_to_end(xmp_hash)
+                    return data
+        with metrics.timer('xmp_transform'):
+            root, namespaces = parse_xmp(in_filename)
+            self.apply(root, namespaces)
+            data = serialize_xmp(root, namespaces)
+        if xmp_hash is not None:
+            with self._lock:
+                self._memo[xmp_hash] = data
+                while len(self._memo) > self.MEMO_SIZE:
+                    self._memo.popitem(last=False)
+        return data
+
+
+def _escape_text(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _escape_attribute(value: str) -> str:
+    return _escape_text(value).replace('"', '&quot;') \
+        .replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#09;')
+
+
+def serialize_xmp(root: Element, namespaces: dict[str, str]) -> bytes:
+    """ Serializes the tree of an XMP with the namespace prefixes
+        that were declared in its file (see parse_xmp()),
+        all declarations are placed on the root element.
+    """
+    prefixes = {uri: prefix for prefix, uri in namespaces.items()}
+    # bound without a declaration, e.g. in xml:lang
+    prefixes[XML_NAMESPACE] = 'xml'
+    qnames: dict[str, str] = {}
+
+    def qname(name: str) -> str:
+        if name not in qnames:
+            if name.startswith('{'):
+                uri, local = name[1:].split('}', 1)
+                if uri not in prefixes:
+                    raise RuntimeError(f'namespace is not declared in the xmp: {uri}')
+                prefix = prefixes[uri]
+                qnames[name] = f'{prefix}:{local}' if prefix else local
+            else:
+                qnames[name] = name
+        return qnames[name]
+
+    chunks = ['<?xml version="1.0" encoding="UTF-8"?>\n']
+
+    def write(element: Element, attributes: list[tuple[str, str]]):
+        tag = qname(element.tag)
+        chunks.append('<' + tag)
+        for key, value in attributes + [(qname(key), value) for key, value in element.items()]:
+            chunks.append(f' {key}="{_escape_attribute(value)}"')
+        if element.text or len(element) > 0:
+            chunks.append('>')
+            if element.text:
+                chunks.append(_escape_text(element.text))
+            for child in element:
+                write(child, [])
+            chunks.append(f'</{tag}>')
+        else:
+            chunks.append('/>')
+        if element.tail:
+            chunks.append(_escape_text(element.tail))
+
+    declarations = [
+        (f'xmlns:{prefix}' if prefix else 'xmlns', uri)
+        for prefix, uri in namespaces.items()
+    ]
+    write(root, declarations)
+    chunks.append('\n')
+    return ''.join(chunks).encode('utf-8')
@@ -0,0 +1,79 @@
+""" Stub of darktable-cli for benchmarks, which does not develop anything.
+    It writes a flat image with the requested maximum size to the output path
+    (with darktable's variables substituted) and prints the same
+    "exported to" line as darktable-cli, which Exporter.export() parses.
+
+        darktable-cli <input> [<input> ...] [<xmp>] <output> [options] [--core <options>]
+"""
+
+import os
+import sys
+import datetime
+from os import path
+
+from PIL import Image
+
+
+# the date all stub exports are taken on
+DATETIME_TAKEN = datetime.datetime(2023, 5, 6, 7, 8, 9)
+# the aspect ratio of all stub exports
+SOURCE_SIZE = (6000, 4000)
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_IFD = 0x8769
+EXIF_MAKE = 0x010F
+
+
+def parse_arguments(argv: list[str]) -> tuple[list[str], dict[str, str]]:
+    if '--core' in argv:
+        argv = argv[:argv.index('--core')]
+    positional = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--'):
+            options[argv[i]] = argv[i + 1]
+            i += 2
+        else:
+            positional.append(argv[i])
+            i += 1
+    return positional, options
+
+
+def output_filepath(output: str, input_filepath: str, out_ext: str) -> str:
+    filepath = output.replace('$(FILE.NAME)', path.splitext(path.basename(input_filepath))[0])
+    for variable, format in [('YEAR', '%Y'), ('MONTH', '%m'), ('DAY', '%d'),
+                             ('HOUR', '%H'), ('MINUTE', '%M'), ('SECOND', '%S')]:
+        filepath = filepath.replace(f'$(EXIF.{variable})', DATETIME_TAKEN.strftime(format))
+    return filepath + '.' + out_ext
+
+
+def export(input_filepath: str, output: str, options: dict[str, str]) -> str:
+    out_ext = options.get('--out-ext', 'jpg')
+    filepath = output_filepath(output, input_filepath, out_ext)
+    os.makedirs(path.dirname(filepath) or '.', exist_ok=True)
+    width, height = int(options.get('--width', 0)), int(options.get('--height', 0))
+    scale = min(width / SOURCE_SIZE[0] if width > 0 else 1.0,
+                height / SOURCE_SIZE[1] if height > 0 else 1.0, 1.0)
+    size = (max(1, round(SOURCE_SIZE[0] * scale)), max(1, round(SOURCE_SIZE[1] * scale)))
+    exif = Image.Exif()
+    exif[EXIF_MAKE] = 'darktable'
+    exif[EXIF_IFD] = {EXIF_DATETIME_ORIGINAL: DATETIME_TAKEN.strftime('%Y:%m:%d %H:%M:%S')}
+    Image.new('RGB', size, (120, 140, 160)).save(filepath, exif=exif.tobytes())
+    return filepath
+
+
+def main(argv: list[str]):
+    positional, options = parse_arguments(argv)
+    if len(positional) < 2:
+        print(__doc__, file=sys.stderr)
+        return 1
+    # an xmp file may follow the inputs
+    inputs = [argument for argument in positional[:-1] if not argument.lower().endswith('.xmp')]
+    for input_filepath in inputs:
+        filepath = export(input_filepath, positional[-1], options)
+        print(f'[dt_imageio_export_job] exported to `{filepath}\'')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,129 @@
+""" Compares peak memory and wall time of rewriting the EXIF data of an export
+    segment by segment (app.metadata.rewrite_exif) with the previous approach,
+    which copied all pixels through Python and wrote the file three times.
+
+    Run from the project directory (a config.env is required to import the app):
+
+        $ python3 -m benchmarks.exif_rewrite --width 1728 --height 1152 --ext jpg
+
+    The previous approach additionally requires the "exif" package
+    and only supports JPEG files.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from os import path
+
+from PIL import Image
+
+from app.metadata import build_exif, rewrite_exif
+
+
+ARTIST = 'Benchmark Artist'
+COPYRIGHT = 'All rights reserved.'
+
+
+def create_image(filepath, width, height):
+    image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    image.save(filepath, exif=build_exif(artist='darktable', datetime_original='2023:05:06 07:08:09'))
+    image.close()
+
+
+def legacy_rewrite_exif(export_filepath):
+    import exif
+
+    # save personal details in exif
+    with open(export_filepath, 'rb') as image_file:
+        original_exif_image = exif.Image(image_file)
+
+    # remove exif data
+    image = Image.open(export_filepath)
+    data = list(image.getdata())
+    image_noexif = Image.new(image.mode, image.size)
+    image_noexif.putdata(data)
+    image_noexif.save(export_filepath)
+    image_noexif.close()
+
+    # save personal details in exif
+    with open(export_filepath, 'rb') as image_file:
+        exif_image = exif.Image(image_file)
+    exif_image.set('artist', ARTIST)
+    exif_image.set('copyright', COPYRIGHT)
+    exif_image.set('datetime_original', original_exif_image.get('datetime_original'))
+    with open(export_filepath, 'wb') as image_file:
+        image_file.write(exif_image.get_file())
+
+
+def segment_rewrite_exif(export_filepath):
+    rewrite_exif(export_filepath, artist=ARTIST, copyright=COPYRIGHT)
+
+
+def measure(func, source_filepath, work_dir, iterations):
+    times = []
+    peaks = []
+    for i in range(iterations):
+        filepath = path.join(work_dir, f'{i}' + path.splitext(source_filepath)[1])
+        shutil.copyfile(source_filepath, filepath)
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(filepath)
+        times.append(time.perf_counter() - start)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+        os.remove(filepath)
+    return {
+        'iterations': iterations,
+        'wall_time_mean_ms': sum(times) / len(times) * 1000,
+        'wall_time_min_ms': min(times) * 1000,
+        'peak_memory_max_mib': max(peaks) / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--width', type=int, default=1728)
+    parser.add_argument('--height', type=int, default=1152)
+    parser.add_argument('--ext', default='jpg', choices=['jpg', 'webp'])
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_filepath = path.join(work_dir, 'source.' + args.ext)
+        create_image(source_filepath, args.width, args.height)
+        results['image'] = {
+            'width': args.width,
+            'height': args.height,
+            'ext': args.ext,
+            'bytes': os.stat(source_filepath).st_size,
+        }
+        results['segment'] = measure(segment_rewrite_exif, source_filepath, work_dir, args.iterations)
+        try:
+            import exif  # noqa: F401
+        except ImportError:
+            print('skipping the previous approach, the exif package is not installed', file=sys.stderr)
+        else:
+            # the exif package only supports jpeg files
+            if args.ext == 'jpg':
+                results['legacy'] = measure(legacy_rewrite_exif, source_filepath, work_dir, args.iterations)
+
+    for name in ['legacy', 'segment']:
+        if name in results:
+            result = results[name]
+            print(f'{name:>8}: {result["wall_time_mean_ms"]:9.2f} ms (mean), '
+                  f'{result["peak_memory_max_mib"]:9.2f} MiB (peak)')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+""" Generates a synthetic darktable library for benchmarks:
+    library.db and data.db with the tables the app reads,
+    (empty) raw files with XMP sidecars, a stub of darktable-cli
+    (see benchmarks/darktable_cli.py) and a config.env that uses all of them.
+    The library only depends on the arguments, so runs are reproducible.
+
+        $ python3 -m benchmarks.fixture /tmp/library --photos 1000
+"""
+
+import os
+import sys
+import random
+import sqlite3
+import argparse
+from os import path
+
+
+ROOT_TAG = 'portfolio'
+INDEX_GALLERY = 'index'
+# darktable stores timestamps as microseconds since 0001-01-01
+DATETIME_START = 63776016000 * 1000000  # 2022-01-01
+DATETIME_RANGE = 2 * 365 * 86400 * 1000000
+DIMENSIONS = [(6000, 4000), (4000, 6000), (5000, 5000), (6240, 4160), (4160, 6240)]
+
+XMP_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmlns:darktable="http://darktable.sf.net/"
+   xmp:Rating="{rating}"
+   darktable:import_timestamp="{id}"
+   darktable:history_end="{history_end}">
+   <darktable:history>
+    <rdf:Seq>
+     <rdf:li darktable:num="0" darktable:operation="flip" darktable:enabled="1"
+      darktable:modversion="2" darktable:params="ffffffff" darktable:multi_name="" darktable:multi_priority="0"/>
+     <rdf:li darktable:num="1" darktable:operation="exposure" darktable:enabled="1"
+      darktable:modversion="6" darktable:params="0000000000000000" darktable:multi_name="" darktable:multi_priority="0"/>
+{borders}    </rdf:Seq>
+   </darktable:history>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+'''
+XMP_BORDERS = '''     <rdf:li darktable:num="2" darktable:operation="borders" darktable:enabled="1"
+      darktable:modversion="3" darktable:params="00" darktable:multi_name="" darktable:multi_priority="0"/>
+'''
+
+LIBRARY_SCHEMA = '''
+    CREATE TABLE film_rolls (
+        id INTEGER PRIMARY KEY, access_timestamp INTEGER, folder VARCHAR(1024) NOT NULL);
+    CREATE TABLE images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, film_id INTEGER,
+        width INTEGER, height INTEGER, filename VARCHAR, maker VARCHAR, model VARCHAR,
+        datetime_taken INTEGER, flags INTEGER, orientation INTEGER, version INTEGER,
+        max_version INTEGER, write_timestamp INTEGER, history_end INTEGER, position INTEGER,
+        aspect_ratio REAL, change_timestamp INTEGER);
+    CREATE TABLE tagged_images (
+        imgid INTEGER, tagid INTEGER, position INTEGER, PRIMARY KEY (imgid, tagid));
+    CREATE INDEX tagged_images_tagid_index ON tagged_images (tagid);
+    CREATE INDEX images_film_id_index ON images (film_id);
+'''
+DATA_SCHEMA = '''
+    CREATE TABLE tags (id INTEGER PRIMARY KEY, name VARCHAR, synonyms VARCHAR, flags INTEGER);
+    CREATE UNIQUE INDEX tags_name_idx ON tags (name);
+'''
+
+
+class LibraryFixture:
+    """ Paths of a generated library.
+    """
+
+    def __init__(self, directory, photos, galleries: list[str]):
+        self.directory = path.abspath(directory)
+        self.photos = photos
+        self.galleries = galleries
+        self.config_dir = path.join(self.directory, 'config')
+        self.raw_dir = path.join(self.directory, 'raws')
+        self.export_dir = path.join(self.directory, 'exports')
+        self.cache_file = path.join(self.directory, 'cache.sqlite')
+        self.cli_bin = path.join(self.directory, 'darktable-cli')
+        self.config_file = path.join(self.directory, 'config.env')
+
+
+def create_library(directory, photos=1000, film_rolls=None, galleries=3, tags=20,
+                   portfolio_ratio=0.8, seed=1) -> LibraryFixture:
+    """ Creates a library with the given number of photos in the directory.
+        A portfolio_ratio of the photos is tagged with the root tag
+        and one of the galleries (the first gallery is the index),
+        every photo has up to three of the other tags.
+        By default there is a film roll for every 50 photos.
+    """
+    rng = random.Random(seed)
+    gallery_names = [INDEX_GALLERY] + [f'gallery{i}' for i in range(1, galleries)]
+    fixture = LibraryFixture(directory, photos, gallery_names)
+    os.makedirs(fixture.config_dir, exist_ok=True)
+    os.makedirs(fixture.raw_dir, exist_ok=True)
+    for filename in ['library.db', 'data.db']:
+        if path.exists(path.join(fixture.config_dir, filename)):
+            os.remove(path.join(fixture.config_dir, filename))
+
+    data = sqlite3.connect(path.join(fixture.config_dir, 'data.db'))
+    data.executescript(DATA_SCHEMA)
+    tag_names = ['darktable|format|raf', ROOT_TAG] + [f'{ROOT_TAG}|{name}' for name in gallery_names] \
+        + [f'keyword|{i}' for i in range(tags)]
+    data.executemany('INSERT INTO tags (id, name, synonyms, flags) VALUES (?, ?, NULL, 0)',
+                     [(id, name) for id, name in enumerate(tag_names, 1)])
+    data.commit()
+    data.close()
+    tag_ids = {name: id for id, name in enumerate(tag_names, 1)}
+    gallery_tag_ids = [tag_ids[f'{ROOT_TAG}|{name}'] for name in gallery_names]
+    keyword_tag_ids = [tag_ids[f'keyword|{i}'] for i in range(tags)]
+
+    film_rolls = film_rolls or max(1, photos // 50)
+    library = sqlite3.connect(path.join(fixture.config_dir, 'library.db'))
+    library.executescript(LIBRARY_SCHEMA)
+    film_roll_dirs = []
+    for film_id in range(1, film_rolls + 1):
+        film_roll_dir = path.join(fixture.raw_dir, f'roll{film_id:05}')
+        os.makedirs(film_roll_dir, exist_ok=True)
+        film_roll_dirs.append(film_roll_dir)
+    library.executemany('INSERT INTO film_rolls (id, access_timestamp, folder) VALUES (?, 0, ?)',
+                        [(film_id, folder) for film_id, folder in enumerate(film_roll_dirs, 1)])
+
+    images = []
+    tagged_images = []
+    # photos of a film roll are taken close to each other
+    film_roll_starts = [DATETIME_START + rng.randrange(DATETIME_RANGE) for _ in range(film_rolls)]
+    for id in range(1, photos + 1):
+        film_id = (id - 1) * film_rolls // photos + 1
+        filename = f'IMG_{id:06}.RAF'
+        width, height = rng.choice(DIMENSIONS)
+        datetime_taken = film_roll_starts[film_id - 1] + rng.randrange(7 * 86400 * 1000000)
+        has_borders = rng.random() < 0.3
+        images.append((id, id, film_id, width, height, filename, datetime_taken,
+                       3 if has_borders else 2, id, id))
+
+        raw_filepath = path.join(film_roll_dirs[film_id - 1], filename)
+        with open(raw_filepath, 'wb') as f:
+            f.write(id.to_bytes(4, 'little'))
+        with open(raw_filepath + '.xmp', 'w', encoding='utf-8') as f:
+            f.write(XMP_TEMPLATE.format(rating=rng.randint(0, 5), id=id,
+                                        history_end=3 if has_borders else 2,
+                                        borders=XMP_BORDERS if has_borders else ''))
+
+        tagged_images.append((id, tag_ids['darktable|format|raf'], 0))
+        if rng.random() < portfolio_ratio:
+            tagged_images.append((id, tag_ids[ROOT_TAG], id))
+            gallery_tag_id = rng.choice(gallery_tag_ids)
+            tagged_images.append((id, gallery_tag_id, id))
+            # some photos are shown on the index page as well
+            if gallery_tag_id != gallery_tag_ids[0] and rng.random() < 0.2:
+                tagged_images.append((id, gallery_tag_ids[0], id))
+        for tag_id in rng.sample(keyword_tag_ids, min(len(keyword_tag_ids), rng.randint(0, 3))):
+            tagged_images.append((id, tag_id, id))
+
+    library.executemany('''
+        INSERT INTO images (
+            id, group_id, film_id, width, height, filename, maker, model, datetime_taken, flags,
+            orientation, version, max_version, write_timestamp, history_end, position,
+            aspect_ratio, change_timestamp
+        ) VALUES (?, ?, ?, ?, ?, ?, 'Fujifilm', 'X-T3', ?, 0, 0, 0, 0, 0, ?, ?, 0, ?)
+    ''', images)
+    library.executemany('INSERT INTO tagged_images (imgid, tagid, position) VALUES (?, ?, ?)', tagged_images)
+    library.commit()
+    library.close()
+
+    write_cli_stub(fixture)
+    write_config(fixture)
+    return fixture
+
+
+def write_cli_stub(fixture: LibraryFixture):
+    # runs the stub with the interpreter of the benchmark, which has Pillow
+    stub = path.join(path.dirname(path.abspath(__file__)), 'darktable_cli.py')
+    with open(fixture.cli_bin, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{stub}" "$@"\n')
+    os.chmod(fixture.cli_bin, 0o755)
+
+
+def write_config(fixture: LibraryFixture, **overrides):
+    values = {
+        'DARKTABLE_CLI_BIN': fixture.cli_bin,
+        'DARKTABLE_CONFIG_DIR': fixture.config_dir,
+        'EXPORT_DIR': fixture.export_dir,
+        'EXPORT_CACHE_FILE': fixture.cache_file,
+        'EXPORT_EXT': 'jpg',
+        'EXPORT_FORMAT_OPTIONS': '"jpeg/quality=90,jpeg/progressive=1,webp/quality=86"',
+        'EXPORT_CODECS': 'webp',
+        'EXPORT_HQ_RESAMPLING': 'true',
+        'EXPORT_WORKERS': '',
+        'EXPORT_BATCH_SIZE': '4',
+        'EXPORT_MULTI_RESOLUTION': 'true',
+        'EXPORT_ASYNC_MEDIA': 'false',
+        'PORTFOLIO_ROOT_TAG': ROOT_TAG,
+        'PORTFOLIO_GALLERY_TAGS': ','.join(f'{name}:{name.title()}' for name in fixture.galleries),
+        'PORTFOLIO_INDEX_GALLERY': INDEX_GALLERY,
+        'EXIF_SET_ARTIST': 'Benchmark Artist',
+        'EXIF_SET_COPYRIGHT': 'All rights reserved.',
+    }
+    values.update(overrides)
+    with open(fixture.config_file, 'w') as f:
+        for key, value in values.items():
+            f.write(f'{key}={value}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory')
+    parser.add_argument('--photos', type=int, default=1000)
+    parser.add_argument('--film-rolls', type=int, help='defaults to one for every 50 photos')
+    parser.add_argument('--galleries', type=int, default=3)
+    parser.add_argument('--tags', type=int, default=20, help='number of tags besides the portfolio tags')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    fixture = create_library(args.directory, photos=args.photos, film_rolls=args.film_rolls,
+                             galleries=args.galleries, tags=args.tags, seed=args.seed)
+    print(f'{fixture.photos} photos in {fixture.directory}, run the app from there')
+
+
+if __name__ == '__main__':
+    main()
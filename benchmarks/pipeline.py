@@ -0,0 +1,234 @@
+""" Benchmarks the app on synthetic darktable libraries of several sizes
+    (see benchmarks/fixture.py), with a stub of darktable-cli:
+    library queries, cache operations, cached and uncached exports,
+    rendering a gallery and a full freeze of the site.
+    Every library size is benchmarked in its own process,
+    since the app reads its configuration when it's imported.
+
+        $ python3 -m benchmarks.pipeline --photos 100,1000,10000,50000 --json results.json
+        $ python3 -m benchmarks.pipeline --photos 100,1000 --baseline results.json
+
+    The results of the app's metrics (see app/metrics.py) are included.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import datetime
+import tempfile
+import subprocess
+from os import path
+
+from benchmarks.fixture import ROOT_TAG, create_library, write_config
+
+
+PROJECT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def measure(func, iterations) -> dict:
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        'iterations': iterations,
+        'wall_time_mean_ms': sum(times) / len(times) * 1000,
+        'wall_time_min_ms': min(times) * 1000,
+    }
+
+
+def measure_operations(func, items) -> dict:
+    """ Calls func with every item and reports the time per call.
+    """
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    total = time.perf_counter() - start
+    return {
+        'operations': len(items),
+        'wall_time_ms': total * 1000,
+        'per_operation_us': total / max(1, len(items)) * 1000000,
+    }
+
+
+def run_benchmarks(fixture_dir, photos, iterations, export_sample, freeze_max) -> dict:
+    """ Runs all benchmarks in the directory of a fixture,
+        which has to be the working directory.
+    """
+    from app import app
+    from app.darktable import DarktableLibrary
+    from app.freeze import SiteBuilder
+    from app.metrics import metrics
+    from app.routes import export_manager, get_portfolio_photos, photo_index, portfolio_galleries
+    from app.util import Cache
+
+    config_dir = path.join(fixture_dir, 'config')
+    results = {}
+
+    def query_hierarchy():
+        with DarktableLibrary(config_dir) as lib:
+            lib.get_photos_in_hierarchy(ROOT_TAG, including_tag=True)
+
+    def query_tagged_photos():
+        with DarktableLibrary(config_dir) as lib:
+            lib.get_tagged_photos(lib.get_tag(ROOT_TAG))
+
+    results['library_photos_in_hierarchy'] = measure(query_hierarchy, iterations)
+    results['library_tagged_photos'] = measure(query_tagged_photos, iterations)
+    results['photo_index_reload'] = measure(lambda: photo_index.refresh(force=True), iterations)
+
+    cache = Cache(path.join(fixture_dir, 'benchmark-cache.sqlite'), prefix='benchmark:')
+    keys = [f'{i:08}' for i in range(photos)]
+    values = {key: (key, len(key), path.join('exports', key + '.jpg')) for key in keys}
+    with cache.transaction():
+        results['cache_save'] = measure_operations(lambda key: cache.save(key, values[key]), keys)
+    random.Random(1).shuffle(keys)
+    results['cache_load'] = measure_operations(cache.load, keys)
+    results['cache_items'] = measure(cache.items, iterations)
+    results['cache_update'] = measure(lambda: cache.update(values), iterations)
+    results['cache_delete_many'] = measure(lambda: cache.delete_many(keys), 1)
+
+    # the largest media size is exported with darktable-cli, all others are downscaled from it
+    sample = sorted(get_portfolio_photos(), key=lambda photo: photo.id)[:export_sample]
+    exporter = export_manager.get_exporter_instance(export_manager.largest_media_size.lower_name)
+    out_dir = path.join(fixture_dir, 'exports')
+    results['export_cached_miss'] = measure_operations(lambda photo: exporter.export_cached(photo, out_dir), sample)
+    results['export_cached_hit'] = measure_operations(lambda photo: exporter.export_cached(photo, out_dir), sample)
+    resampled = export_manager.get_media_exporter('medium')
+    results['export_cached_resample_miss'] = measure_operations(
+        lambda photo: resampled.export_cached(photo, out_dir), sample)
+    results['export_cached_many_hit'] = measure(lambda: exporter.export_cached_many(sample, out_dir), iterations)
+
+    with app.test_client() as client:
+        def render(url):
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f'failed to render {url}: {response.status}')
+
+        # the first request resolves the aspect ratios of all photos
+        results['gallery_render_cold'] = measure(lambda: render('/'), 1)
+        results['gallery_render'] = measure(lambda: render('/'), iterations)
+    results['gallery_photos'] = {
+        gallery: len(photo_index.get_photos(gallery)) for gallery in portfolio_galleries
+    }
+
+    # the site builder needs the script bundle, which is built with gulp
+    script = path.join(PROJECT_DIR, 'static', 'scripts', 'app.js')
+    if photos <= freeze_max and not path.exists(script):
+        print(f'skipping the freeze, {script} is missing', file=sys.stderr)
+    elif photos <= freeze_max:
+        site_dir = path.join(fixture_dir, 'site')
+        results['freeze_cold'] = measure(lambda: SiteBuilder(site_dir).build(), 1)
+        results['freeze_warm'] = measure(lambda: SiteBuilder(site_dir).build(), 1)
+
+    results['metrics'] = metrics.summary()
+    return results
+
+
+def run_child(args):
+    os.chdir(args.fixture_dir)
+    results = run_benchmarks(args.fixture_dir, args.child_photos, args.iterations,
+                             args.export_sample, args.freeze_max)
+    with open(args.child_results, 'w') as f:
+        json.dump(results, f)
+    return 0
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, results: dict):
+    """ Prints the change of every timing against the results of a previous run.
+    """
+    for photos, benchmarks in results['results'].items():
+        previous_benchmarks = baseline.get('results', {}).get(photos)
+        if previous_benchmarks is None:
+            continue
+        for name, result in benchmarks.items():
+            previous = previous_benchmarks.get(name)
+            for key in ['per_operation_us', 'wall_time_mean_ms']:
+                if isinstance(previous, dict) and key in result and key in previous and previous[key] > 0:
+                    change = (result[key] - previous[key]) / previous[key] * 100
+                    print(f'{photos:>6} {name:<32} {previous[key]:12.2f} -> {result[key]:12.2f} '
+                          f'{key.rsplit("_", 1)[-1]:<2} ({change:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--photos', default='100,1000,10000,50000',
+                        help='comma separated sizes of the libraries')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--export-sample', type=int, default=50,
+                        help='number of photos that are exported with the stub')
+    parser.add_argument('--freeze-max', type=int, default=1000,
+                        help='largest library that is frozen, which exports every photo in every size')
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help='number of photos per darktable-cli process (EXPORT_BATCH_SIZE)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work-dir', help='directory for the libraries, temporary by default')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare the results with a previous run')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the app')
+    parser.add_argument('--child', dest='fixture_dir', help=argparse.SUPPRESS)
+    parser.add_argument('--child-photos', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--child-results', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fixture_dir is not None:
+        return run_child(args)
+
+    results = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'arguments': vars(args),
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for photos in [int(value) for value in args.photos.split(',')]:
+            fixture_dir = path.join(work_dir, f'library-{photos}')
+            start = time.perf_counter()
+            fixture = create_library(fixture_dir, photos=photos, seed=args.seed)
+            write_config(fixture, EXPORT_BATCH_SIZE=str(args.batch_size))
+            print(f'{photos} photos: library created in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+            child_results = path.join(work_dir, f'results-{photos}.json')
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_DIR, os.getenv('PYTHONPATH')])))
+            subprocess.run([
+                sys.executable, '-m', 'benchmarks.pipeline',
+                '--child', fixture_dir, '--child-photos', str(photos), '--child-results', child_results,
+                '--iterations', str(args.iterations), '--export-sample', str(args.export_sample),
+                '--freeze-max', str(args.freeze_max),
+            ], cwd=PROJECT_DIR, env=env, check=True, stdout=None if args.verbose else subprocess.DEVNULL)
+            with open(child_results) as f:
+                results['results'][str(photos)] = json.load(f)
+            for name, result in results['results'][str(photos)].items():
+                if 'wall_time_mean_ms' in result:
+                    print(f'{photos:>6} {name:<32} {result["wall_time_mean_ms"]:12.2f} ms (mean)')
+                elif 'per_operation_us' in result:
+                    print(f'{photos:>6} {name:<32} {result["per_operation_us"]:12.2f} us (per operation)')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
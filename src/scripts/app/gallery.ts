@@ -5,6 +5,7 @@ import { normalizedWidthPixels } from "./app";
 import { showApp, showAppImmediately, styling } from "./app";
 import navigation from "./navigation";
 import { addScrollListener } from "./scrolling";
+import { detectSupportedCodecs, preferredSrcset } from "./util/codecs";
 import { toTitleCase } from "./util/strings";
 
 export default { init }
@@ -18,6 +19,9 @@ var config = {
   monthCardAspectRatio: 2/3, // 1/4 with text
   rowVisiblePercentage: 1/2,
   scrollToOffsetTopPaddingPixels: 10,
+  // images that are still being exported are requested again
+  imageRetryDelayMilliseconds: 5000,
+  imageMaxRetries: 5,
   scrollToOffsetTopPixels: (function () {
     return document.querySelector('#navigation').clientHeight;
   })()
@@ -310,6 +314,16 @@ function finalizeImageOrder(galleryElement: HTMLElement) {
   }
 }
 
+function showPlaceholders(galleryElement: HTMLElement) {
+  var imageContainers: NodeListOf<HTMLElement> = galleryElement.querySelectorAll('.image-container[data-placeholder]');
+  for (var imageContainer of Array.from(imageContainers)) {
+    // shown as the background of the container until its image is loaded
+    imageContainer.style.backgroundColor = imageContainer.getAttribute('data-placeholder-color');
+    imageContainer.style.backgroundImage = 'url("' + imageContainer.getAttribute('data-placeholder') + '")';
+    imageContainer.classList.add('has-placeholder');
+  }
+}
+
 function renderGalleries() {
   galleryManager.registerRendererFactory(
     function (galleryElement: HTMLElement): Renderer {
@@ -323,6 +337,9 @@ function renderGalleries() {
       var renderStrategy = new RowRenderStrategy();
       var imageMinWidthPixels = config.imageMinWidthPixels; // 300
       var allowWideColumnLandscapes = true;
+      // rows that were computed by the server, if any
+      var layoutElement = galleryContainer.querySelector('script.gallery-layout');
+      var layout = layoutElement ? JSON.parse(layoutElement.textContent) : null;
 
       return new Renderer(renderStrategy, {
         galleryContainerElement: galleryContainer,
@@ -331,6 +348,7 @@ function renderGalleries() {
         paddingPixels: styling.padding,
         galleryPaddingPixels: styling.padding - styling.borderWidth,
         allowWideColumnLandscapes: allowWideColumnLandscapes,
+        layout: layout,
       });
     });
 
@@ -344,22 +362,46 @@ function renderGalleries() {
         showApp();
       }
 
+      var isDone = false;
       var loadNext = function () {
+        // a retried image might load after the next images were loaded
+        if (isDone) {
+          return;
+        }
+        isDone = true;
         if (isLast) {
           // make sure to show the app if this was the last image
           showApp();
         }
         cb();
       };
+      var retries = 0;
       image.addEventListener('load', function (e) {
         this.parentElement.classList.remove('not-loaded');
         loadNext();
       })
       image.addEventListener('error', function (e) {
         loadNext();
+        if (retries < config.imageMaxRetries) {
+          retries++;
+          setTimeout(function () {
+            var src = image.getAttribute('data-src');
+            image.removeAttribute('srcset');
+            image.src = src + (src.indexOf('?') < 0 ? '?' : '&') + 'retry=' + retries;
+          }, config.imageRetryDelayMilliseconds);
+        }
       })
-      // console.log(image, image.getAttribute('data-src'));
-      image.src = image.getAttribute('data-src');
+      detectSupportedCodecs().then(function (codecs) {
+        var srcset = preferredSrcset(image, 'data-srcset', codecs);
+        if (srcset) {
+          // the container is already positioned, so the displayed width is known
+          var width = Math.ceil(imageContainer.getBoundingClientRect().width);
+          image.sizes = width > 0 ? width + 'px' : image.getAttribute('data-sizes');
+          image.srcset = srcset;
+        }
+        // console.log(image, image.getAttribute('data-src'));
+        image.src = image.getAttribute('data-src');
+      });
     });
 
   var galleries: NodeListOf<HTMLElement> = document.querySelectorAll('.gallery');
@@ -367,6 +409,7 @@ function renderGalleries() {
   for (var galleryElement of Array.from(galleries)) {
     // createMonthCards(galleryElement);
     finalizeImageOrder(galleryElement);
+    showPlaceholders(galleryElement);
   }
 
   if (galleries.length > 0)
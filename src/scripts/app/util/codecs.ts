@@ -0,0 +1,41 @@
+// image codecs the browser can decode, in the server's order of preference
+var supportedCodecs: Promise<string[]> = null;
+
+export function detectSupportedCodecs(): Promise<string[]> {
+  if (supportedCodecs !== null) {
+    return supportedCodecs;
+  }
+  // the server renders a tiny image of every codec it offers
+  var element = document.querySelector('[data-codec-probes]');
+  var probes: { [codec: string]: string } = element !== null
+    ? JSON.parse(element.getAttribute('data-codec-probes'))
+    : {};
+  var codecs = Object.keys(probes);
+  supportedCodecs = Promise.all(codecs.map(function (codec) {
+    return new Promise<boolean>(function (resolve) {
+      var image = new Image();
+      image.onload = function () {
+        resolve(image.width > 0);
+      };
+      image.onerror = function () {
+        resolve(false);
+      };
+      image.src = probes[codec];
+    });
+  })).then(function (results) {
+    return codecs.filter(function (codec, i) {
+      return results[i];
+    });
+  });
+  return supportedCodecs;
+}
+
+export function preferredSrcset(element: Element, attribute: string, codecs: string[]): string {
+  for (var codec of codecs) {
+    var srcset = element.getAttribute(attribute + '-' + codec);
+    if (srcset) {
+      return srcset;
+    }
+  }
+  return element.getAttribute(attribute);
+}
@@ -2,6 +2,7 @@ import { Animator } from "../components/animation/Animator";
 import { styling } from "./app";
 import navigation from "./navigation";
 import scrolling from "./scrolling";
+import { detectSupportedCodecs, preferredSrcset } from "./util/codecs";
 import { easeOutQuart } from "./util/easings";
 import { toTitleCase } from "./util/strings";
 
@@ -26,7 +27,13 @@ var viewerState: {
   viewerElement: HTMLElement,
 } = initialViewerState();
 
+// filled once the gallery detected the supported codecs
+var supportedCodecs: string[] = [];
+
 function init() {
+  detectSupportedCodecs().then(function (codecs) {
+    supportedCodecs = codecs;
+  });
   var viewerElement = document.querySelector('#viewer');
   var viewerContentElement = viewerElement.querySelector('.viewer-content');
 
@@ -48,8 +55,7 @@ function init() {
     </div>
     */
     var imageElement: HTMLImageElement = fromImageContainer.querySelector('img');
-    var viewerSource = imageElement.getAttribute('data-viewer-src');
-    var loadedSmallerSource = imageElement.src;
+    var loadedSmallerSource = imageElement.currentSrc || imageElement.src;
     var div1 = document.createElement('div');
     var div2 = document.createElement('div');
     div1.classList.add('viewer-image');
@@ -71,7 +77,7 @@ function init() {
     img2.style.width = imageElement.getAttribute('data-viewer-width') + 'px';
     img2.style.height = imageElement.getAttribute('data-viewer-height') + 'px';
     img2.src = loadedSmallerSource;
-    img1.src = viewerSource;
+    setViewerSource(img1, imageElement);
     var children = viewerContentElement.children;
     var zIndex = 0;
     if (children.length > 0) {
@@ -172,7 +178,18 @@ function init() {
     img.onload = function () {
       // console.log('preloaded');
     };
-    img.src = imageContainerElement.querySelector('img').getAttribute('data-viewer-src');
+    setViewerSource(img, imageContainerElement.querySelector('img'));
+  }
+
+  function setViewerSource(img: HTMLImageElement, fromImageElement: HTMLImageElement) {
+    // the viewer displays the image with a fixed size,
+    // preloading and displaying it must select the same candidate
+    var srcset = preferredSrcset(fromImageElement, 'data-viewer-srcset', supportedCodecs);
+    if (srcset) {
+      img.sizes = fromImageElement.getAttribute('data-viewer-width') + 'px';
+      img.srcset = srcset;
+    }
+    img.src = fromImageElement.getAttribute('data-viewer-src');
   }
 
   function clearViewer() {
@@ -0,0 +1,10 @@
+// justified rows of a gallery that were computed by the server
+// for every number of columns up to some maximum (see app/layout.py).
+// each row lists the indices of its images in placement order,
+// only the pixel sizes of the images are left to the renderer.
+
+export type GalleryLayout = {
+  images: number;
+  wideLandscapes: boolean;
+  rows: { [columns: string]: number[][] };
+};
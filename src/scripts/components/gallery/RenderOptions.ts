@@ -1,3 +1,5 @@
+import { GalleryLayout } from "./GalleryLayout";
+
 export type RenderOptions = {
   galleryContainerElement: HTMLElement;
   imageContainerElement: HTMLElement;
@@ -5,4 +7,5 @@ export type RenderOptions = {
   paddingPixels: number;
   galleryPaddingPixels: number;
   allowWideColumnLandscapes: boolean;
+  layout?: GalleryLayout;
 };
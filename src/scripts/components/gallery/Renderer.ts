@@ -32,6 +32,7 @@ export class Renderer {
       imageMinWidthPixels: 256,
       paddingPixels: 10,
       allowWideColumnLandscapes: false,
+      layout: null,
     }, options);
     this.renderStrategy = renderStrategy;
     this.galleryContainer = this.options.galleryContainerElement;
@@ -91,6 +92,11 @@ export class Renderer {
   render(): GalleryImage[] {
     var columns = this.determineColumns();
 
+    var rows = this.getLayoutRows(columns);
+    if (rows !== null) {
+      return this._renderRows(columns, rows);
+    }
+
     if (this.lastPlacementOrder !== null && columns == this.lastColumnCount) {
       this._render(columns, this.lastPlacementOrder);
     }
@@ -105,6 +111,73 @@ export class Renderer {
     return images
   }
 
+  getLayoutRows(columns: number): number[][] {
+    var layout = this.options.layout;
+    if (!layout || !(columns in layout.rows)
+        || layout.images !== this.getImageCount()
+        || layout.wideLandscapes !== this.options.allowWideColumnLandscapes) {
+      return null;
+    }
+    return layout.rows[columns];
+  }
+
+  // positions the images in the rows of the precomputed layout,
+  // with the same sizes as the RowRenderStrategy would determine
+  _renderRows(columns: number, rows: number[][]): GalleryImage[] {
+    var images = this.getImages();
+    var galleryWidth = this.determineGalleryWidth();
+    var columnSize = this.determineColumnSize(columns);
+    var padding = this.options.paddingPixels;
+
+    var placementOrder: GalleryImage[] = [];
+    var top = 0;
+    var height = 0;
+    for (var r = 0; r < rows.length; r++) {
+      var row = rows[r].map((i: number) => images[i]);
+      var sumAspectRatios = 0;
+      var numIncludePadding = 0;
+      var totalColumnWidth = 0;
+      var columnWidths: number[] = [];
+      for (var image of row) {
+        var columnWidth = this.options.allowWideColumnLandscapes && image.isLandscape() && columns > 1 ? 2 : 1;
+        columnWidths.push(columnWidth);
+        sumAspectRatios += image.aspectRatio;
+        numIncludePadding += columnWidth == 2 ? 1 : 0;
+        totalColumnWidth += columnWidth;
+      }
+      numIncludePadding -= Math.max(0, totalColumnWidth - columns);
+      var rowHeight = (galleryWidth - (columns - 1 - numIncludePadding) * padding) / sumAspectRatios;
+
+      var widths = row.map((image: GalleryImage) => columns == 1 ? galleryWidth : image.aspectRatio * rowHeight);
+      if (r == rows.length - 1) {
+        // make sure columns aren't too large on the last row
+        for (var i = 0; i < row.length; i++) {
+          rowHeight = Math.min(rowHeight, columnSize * columnWidths[i] / row[i].aspectRatio);
+        }
+        widths = row.map((image: GalleryImage) => rowHeight * image.aspectRatio);
+      }
+
+      var left = 0;
+      for (var i = 0; i < row.length; i++) {
+        var element = row[i].containerElement;
+        element.style.width = widths[i] + 'px';
+        element.style.height = rowHeight + 'px';
+        element.style.top = top + 'px';
+        element.style.left = left + 'px';
+        left += widths[i] + padding;
+        placementOrder.push(row[i]);
+      }
+      height = top + rowHeight;
+      top += rowHeight + padding;
+    }
+
+    this.galleryContainer.style.padding = this.options.galleryPaddingPixels + 'px';
+    this.imageContainer.style.height = height + 'px';
+    this.imageContainer.setAttribute('data-columns', (columns).toString());
+
+    return placementOrder;
+  }
+
   _render(
     columns: number,
     cachedPlacementOrder: ImagePlacement[] = undefined
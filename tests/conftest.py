@@ -0,0 +1,50 @@
+""" The app reads config.env from the working directory when it's imported,
+    so the tests run in a small synthetic library (see benchmarks/fixture.py).
+    It's set up before the test modules are collected and import the app.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from os import path
+
+import pytest
+
+PROJECT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from benchmarks.fixture import create_library  # noqa: E402
+
+
+def pytest_configure(config):
+    config._fixture_cwd = os.getcwd()
+    config._fixture_dir = tempfile.mkdtemp(prefix='portfolio-tests-')
+    create_library(config._fixture_dir, photos=10)
+    os.chdir(config._fixture_dir)
+
+
+def pytest_unconfigure(config):
+    fixture_dir = getattr(config, '_fixture_dir', None)
+    if fixture_dir is None:
+        return
+    os.chdir(config._fixture_cwd)
+    shutil.rmtree(fixture_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def edit_sidecar():
+    """ Edits the XMP sidecar of a photo of the library until the test ends.
+    """
+    edited = {}
+
+    def edit(photo):
+        with open(photo.xmp_path, 'rb') as f:
+            edited[photo.xmp_path] = f.read()
+        with open(photo.xmp_path, 'ab') as f:
+            f.write(b'\n')
+
+    yield edit
+    for xmp_path, contents in edited.items():
+        with open(xmp_path, 'wb') as f:
+            f.write(contents)
@@ -0,0 +1,98 @@
+import random
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from dateutil.relativedelta import relativedelta
+
+from app.columns import PhotoColumns, timestamps_to_datetimes
+from app.darktable import parse_darktable_datetimes
+
+
+# reference implementations that the columns replaced,
+# the results have to stay exactly the same
+
+def filmroll_average_dates(photos):
+    filmroll_dates_minmax = dict()
+    for photo in photos:
+        fr = photo.film_roll.id
+        dt = photo.datetime_taken
+        if fr in filmroll_dates_minmax:
+            lo, hi = filmroll_dates_minmax[fr]
+            filmroll_dates_minmax[fr] = (min(lo, dt), max(hi, dt))
+        else:
+            filmroll_dates_minmax[fr] = (dt, dt)
+    return {fr: lo + (hi - lo) / 2 for fr, (lo, hi) in filmroll_dates_minmax.items()}
+
+
+def sorted_photo_assets(photo_assets):
+    sorted_assets = sorted(photo_assets, key=lambda asset: asset.photo.datetime_taken)
+    return sorted(sorted_assets, key=lambda asset: asset.date_key, reverse=True)
+
+
+def parse_darktable_datetime(datetime_taken):
+    dt = datetime.datetime.utcfromtimestamp(datetime_taken/1000/1000 % 100000000000)
+    return dt - relativedelta(years=1969) + relativedelta(days=1)
+
+
+START = datetime.datetime(2022, 1, 1)
+US = datetime.timedelta(microseconds=1)
+
+
+def create_photos(film_roll_offsets: list[tuple[int, int]]):
+    """ Photos of the given film roll ids, taken at the given offsets
+        in microseconds after START.
+    """
+    return [
+        SimpleNamespace(id=i, film_roll=SimpleNamespace(id=film_roll_id), datetime_taken=START + offset * US)
+        for i, (film_roll_id, offset) in enumerate(film_roll_offsets)
+    ]
+
+
+def random_photos(seed, count, film_rolls, span):
+    rng = random.Random(seed)
+    return create_photos([(rng.randrange(film_rolls), rng.randrange(span)) for _ in range(count)])
+
+
+CASES = {
+    'single': create_photos([(1, 0)]),
+    # halves of a microsecond are rounded to even
+    'odd spans': create_photos([(1, 0), (1, 1), (2, 10), (2, 13), (3, 20), (3, 25), (4, 7), (4, 8)]),
+    'equal timestamps': create_photos([(1, 5), (2, 5), (1, 5), (2, 5), (3, 5)]),
+    # different film rolls with the same midpoint
+    'tied midpoints': create_photos([(1, 0), (2, 4), (1, 10), (2, 6), (3, 5), (1, 5)]),
+    'multiple rolls': random_photos(1, 200, film_rolls=12, span=10 ** 12),
+    'many ties': random_photos(2, 300, film_rolls=5, span=8),
+}
+
+
+@pytest.mark.parametrize('photos', CASES.values(), ids=CASES.keys())
+def test_film_roll_midpoints_match_the_average_dates(photos):
+    expected = filmroll_average_dates(photos)
+    midpoints = timestamps_to_datetimes(PhotoColumns(photos).film_roll_midpoints())
+    assert midpoints == [expected[photo.film_roll.id] for photo in photos]
+
+
+@pytest.mark.parametrize('photos', CASES.values(), ids=CASES.keys())
+def test_date_order_matches_the_sorted_assets(photos):
+    columns = PhotoColumns(photos)
+    date_keys = columns.film_roll_midpoints()
+    assets = [SimpleNamespace(photo=photo, date_key=date_key)
+              for photo, date_key in zip(photos, timestamps_to_datetimes(date_keys))]
+    expected = [asset.photo.id for asset in sorted_photo_assets(assets)]
+    assert [photos[i].id for i in columns.date_order(date_keys)] == expected
+
+
+def test_parse_darktable_datetimes_matches_parse_darktable_datetime():
+    rng = random.Random(3)
+    # microseconds since 0001-01-01, most of them aren't exact as floats
+    values = [rng.randrange(60000000000 * 10 ** 6, 66000000000 * 10 ** 6) for _ in range(5000)]
+    values += [rng.randrange(0, 2 ** 53) for _ in range(500)]
+    values += [0, 1, 999, 1000, 2 ** 53, 2 ** 53 + 1, 63776016000 * 10 ** 6, 63776016000 * 10 ** 6 - 1]
+    # the last days of the months, which relativedelta() clamps
+    for year in [2020, 2021, 2023, 2024]:
+        for month in range(1, 13):
+            day = START.replace(year=year, month=month, day=1) + relativedelta(months=1, days=-1)
+            value = (day - datetime.datetime(1, 1, 1)) // US
+            values += [value, value + 86400 * 10 ** 6 - 1]
+    assert parse_darktable_datetimes(values) == [parse_darktable_datetime(value) for value in values]
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from app.config import config
+from app.index import PhotoIndex
+
+
+ROOT_TAG = config['PORTFOLIO_ROOT_TAG']
+
+
+@pytest.fixture
+def index():
+    index = PhotoIndex(config['DARKTABLE_CONFIG_DIR'], ROOT_TAG)
+    index.SIDECAR_CHECK_INTERVAL = 3600
+    index.refresh()
+    return index
+
+
+def test_unchanged_library_is_not_reloaded(index):
+    snapshot = index.snapshot
+    assert not index.refresh(check_sidecars=True)
+    assert index.snapshot is snapshot
+
+
+def test_sidecar_edits_are_checked_periodically(index, edit_sidecar):
+    photo = next(iter(index.snapshot.photos.values()))
+    edit_sidecar(photo)
+    # checked at most every SIDECAR_CHECK_INTERVAL seconds
+    assert not index.refresh()
+    index.SIDECAR_CHECK_INTERVAL = 0
+    assert index.refresh()
+
+
+def test_sidecar_edits_invalidate_memoized_data(index, edit_sidecar):
+    photos = index.get_photos(include_root_tag=True)
+    index.memoize('photos', [ROOT_TAG], lambda: 'stale')
+    edited, unchanged = photos[0], photos[1]
+    edit_sidecar(edited)
+
+    assert index.refresh(check_sidecars=True)
+    assert index.memoized('photos') is None
+    assert index.snapshot.photos[edited.id] is not edited
+    assert index.snapshot.photos[unchanged.id] is unchanged
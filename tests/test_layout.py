@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+from app.layout import MAX_LAYOUT_COLUMNS, gallery_layout, justified_rows
+
+
+P = 2 / 3  # portrait
+L = 3 / 2  # landscape
+
+
+# rows as the RowRenderStrategy of the gallery script places them,
+# the script only checks the number of photos and wideLandscapes
+@pytest.mark.parametrize('aspect_ratios, orders, columns, wide_landscapes, rows', [
+    # one photo per row
+    ([P, L, L, P], [0, 0, 0, 1], 1, True, [[0], [1], [2], [3]]),
+    # a landscape in the last column, since the next portrait is of a later group
+    ([P, L, L, P], [0, 0, 0, 1], 2, True, [[0, 1], [2], [3]]),
+    # the next portrait of the same group is pulled forward into the last column
+    ([P, L, L, P], [0, 0, 0, 0], 2, True, [[0, 3], [1], [2]]),
+    ([P, L, L, P], [0, 0, 0, 0], 2, False, [[0, 3], [1, 2]]),
+    ([L, P, L, P, P, L], [0, 0, 0, 0, 1, 1], 3, True, [[0, 1], [2, 3], [4, 5]]),
+    ([P, P, L, L, P], [0, 0, 0, 0, 1], 3, True, [[0, 1, 2], [3, 4]]),
+    ([P, P, L, L, P], [0, 0, 0, 0, 0], 3, True, [[0, 1, 4], [2, 3]]),
+    ([L, L, P, L, P, P, L, P], [0, 0, 0, 1, 1, 1, 2, 2], 4, True, [[0, 1], [2, 3, 4], [5, 6, 7]]),
+    ([L, L, P, L, P, P, L, P], [0, 0, 0, 1, 1, 1, 2, 2], 4, False, [[0, 1, 2, 4], [3, 5, 6, 7]]),
+    # squares are placed like portraits
+    ([1.0, L, 1.0], [0, 0, 0], 2, True, [[0, 2], [1]]),
+])
+def test_justified_rows(aspect_ratios, orders, columns, wide_landscapes, rows):
+    assert justified_rows(aspect_ratios, orders, columns, wide_landscapes) == rows
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_justified_rows_fill_every_column(seed):
+    rng = random.Random(seed)
+    aspect_ratios = [rng.choice([P, L]) for _ in range(60)]
+    orders = sorted(rng.randrange(8) for _ in aspect_ratios)
+    for columns in range(1, MAX_LAYOUT_COLUMNS + 1):
+        rows = justified_rows(aspect_ratios, orders, columns)
+        assert sorted(i for row in rows for i in row) == list(range(len(aspect_ratios)))
+        for row in rows[:-1]:
+            widths = [2 if columns > 1 and aspect_ratios[i] > 1.0 else 1 for i in row]
+            # a wide photo only occupies the last column
+            assert sum(widths[:-1]) < columns <= sum(widths)
+
+
+def test_gallery_layout():
+    layout = gallery_layout([P, L, P], [0, 0, 1], wide_landscapes=False)
+    assert layout['images'] == 3
+    assert layout['wideLandscapes'] is False
+    assert list(layout['rows'].keys()) == [str(columns) for columns in range(1, MAX_LAYOUT_COLUMNS + 1)]
+    assert layout['rows']['2'] == [[0, 1], [2]]
+    assert layout['rows']['3'] == [[0, 1, 2]]
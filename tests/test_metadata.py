@@ -0,0 +1,81 @@
+import pytest
+from PIL import Image
+
+from app.metadata import (
+    TAG_ARTIST, TAG_COPYRIGHT, TAG_DATETIME_ORIGINAL, TAG_EXIF_IFD,
+    build_exif, read_datetime_original, rewrite_exif
+)
+
+
+TAG_MAKE = 0x010f
+DATETIME_ORIGINAL = '2023:05:06 07:08:09'
+XMP_PACKET = b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><secret/></x:xmpmeta>'
+
+
+def create_image(filepath, format, **save_options):
+    exif = Image.Exif()
+    exif[TAG_MAKE] = 'darktable'
+    exif[TAG_ARTIST] = 'Someone Else'
+    exif[TAG_EXIF_IFD] = {TAG_DATETIME_ORIGINAL: DATETIME_ORIGINAL}
+    image = Image.linear_gradient('L').convert('RGB').resize((64, 48))
+    image.save(filepath, format=format, exif=exif.tobytes(), **save_options)
+
+
+def read_image(filepath):
+    with Image.open(filepath) as image:
+        return image.getexif(), image.info, image.convert('RGB').tobytes()
+
+
+def test_build_exif_contains_only_the_given_tags():
+    exif_data = build_exif(artist='Artist', datetime_original=DATETIME_ORIGINAL)
+    exif = Image.Exif()
+    exif.load(exif_data)
+    assert dict(exif) == {TAG_ARTIST: 'Artist', TAG_EXIF_IFD: exif[TAG_EXIF_IFD]}
+    assert read_datetime_original(exif_data) == DATETIME_ORIGINAL
+    assert read_datetime_original(b'') is None
+
+
+@pytest.mark.parametrize('filename, format, save_options', [
+    ('image.jpg', 'JPEG', {'xmp': XMP_PACKET, 'comment': b'comment'}),
+    ('image.webp', 'WEBP', {'xmp': XMP_PACKET}),
+    ('image.webp', 'WEBP', {'lossless': True}),
+    ('image.png', 'PNG', {}),
+])
+def test_rewrite_exif_replaces_all_metadata(tmp_path, filename, format, save_options):
+    filepath = tmp_path / filename
+    create_image(filepath, format, **save_options)
+    _, _, pixels = read_image(filepath)
+
+    rewrite_exif(str(filepath), artist='Artist', copyright='Copyright')
+
+    exif, info, rewritten_pixels = read_image(filepath)
+    assert exif.get(TAG_ARTIST) == 'Artist'
+    assert exif.get(TAG_COPYRIGHT) == 'Copyright'
+    assert exif.get(TAG_MAKE) is None
+    assert exif.get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL) == DATETIME_ORIGINAL
+    assert 'xmp' not in info and 'comment' not in info
+    # jpeg and webp are rewritten without encoding them again
+    assert rewritten_pixels == pixels
+    assert list(tmp_path.iterdir()) == [filepath]
+
+
+def test_rewrite_exif_of_an_image_without_metadata(tmp_path):
+    filepath = tmp_path / 'image.jpg'
+    Image.new('RGB', (16, 16), (10, 20, 30)).save(filepath)
+
+    rewrite_exif(str(filepath), artist='Artist', copyright='Copyright')
+
+    exif, _, _ = read_image(filepath)
+    assert exif.get(TAG_ARTIST) == 'Artist'
+    assert exif.get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL) is None
+
+
+def test_rewrite_exif_keeps_the_file_if_it_fails(tmp_path):
+    filepath = tmp_path / 'image.jpg'
+    filepath.write_bytes(b'not an image')
+
+    with pytest.raises(RuntimeError):
+        rewrite_exif(str(filepath), artist='Artist', copyright='Copyright')
+
+    assert filepath.read_bytes() == b'not an image'
+    assert list(tmp_path.iterdir()) == [filepath]
@@ -0,0 +1,25 @@
+import pytest
+
+from app.config import config
+from app.routes import get_gallery_photos, photo_index
+
+
+GALLERY = config['PORTFOLIO_GALLERY_TAGS'].split(',')[0].split(':')[0]
+
+
+@pytest.fixture
+def check_sidecars(monkeypatch):
+    monkeypatch.setattr(photo_index, 'SIDECAR_CHECK_INTERVAL', 0)
+
+
+def test_sidecar_edits_change_the_versioned_urls(check_sidecars, edit_sidecar):
+    asset = get_gallery_photos(GALLERY)[0]
+    url = asset.get_url()
+    assert get_gallery_photos(GALLERY)[0] is asset
+
+    edit_sidecar(asset.photo)
+
+    edited = next(a for a in get_gallery_photos(GALLERY) if a.photo.id == asset.photo.id)
+    assert edited.source_digest != asset.source_digest
+    assert edited.get_url() != url
+    assert edited.get_url().split('?')[0] == url.split('?')[0]
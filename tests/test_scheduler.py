@@ -0,0 +1,165 @@
+import threading
+
+import pytest
+
+from app.scheduler import ExportScheduler, JobQueue
+
+
+TIMEOUT = 5
+
+
+class Recorder:
+    """ Records the order in which jobs run. The first job
+        that is submitted with block() keeps the only worker busy
+        until release() is called, so that other jobs stay queued.
+    """
+
+    def __init__(self):
+        self.order = []
+        self.gate = threading.Event()
+        self.started = threading.Event()
+
+    def job(self, name):
+        self.order.append(name)
+        return name
+
+    def block(self):
+        self.started.set()
+        self.gate.wait(TIMEOUT)
+        return 'blocker'
+
+    def release(self):
+        self.gate.set()
+
+
+@pytest.fixture
+def scheduler():
+    return ExportScheduler(workers=1, queue_size=8)
+
+
+@pytest.fixture
+def recorder(scheduler):
+    recorder = Recorder()
+    scheduler.submit('blocker', recorder.block)
+    assert recorder.started.wait(TIMEOUT)
+    yield recorder
+    recorder.release()
+
+
+def test_jobs_with_the_same_key_share_a_future(scheduler, recorder):
+    first = scheduler.submit('a', recorder.job, 'a')
+    second = scheduler.submit('a', recorder.job, 'a again')
+    recorder.release()
+    assert first is second
+    assert first.result(TIMEOUT) == 'a'
+    assert recorder.order == ['a']
+
+
+def test_jobs_run_in_the_order_of_their_priority(scheduler, recorder):
+    futures = [
+        scheduler.submit('background', recorder.job, 'background'),
+        scheduler.submit('low', recorder.job, 'low', priority=(0, 2)),
+        scheduler.submit('high', recorder.job, 'high', priority=(0, 1)),
+    ]
+    recorder.release()
+    for future in futures:
+        future.result(TIMEOUT)
+    assert recorder.order == ['high', 'low', 'background']
+
+
+def test_queued_jobs_are_promoted(scheduler, recorder):
+    futures = [scheduler.submit(name, recorder.job, name) for name in ['a', 'b', 'c']]
+    assert scheduler.submit('c', recorder.job, 'c', priority=(0,)) is futures[2]
+    # a higher priority does not demote it again
+    assert scheduler.submit('c', recorder.job, 'c', priority=(2,)) is futures[2]
+    recorder.release()
+    for future in futures:
+        future.result(TIMEOUT)
+    assert recorder.order == ['c', 'a', 'b']
+
+
+def test_workers_claim_the_queued_jobs_they_wait_for(scheduler, recorder):
+    queued = scheduler.submit('dependency', recorder.job, 'dependency')
+
+    def dependent():
+        # the only worker runs this job, waiting in line would deadlock
+        return scheduler.submit('dependency', recorder.job, 'never').result(TIMEOUT) + ' done'
+
+    future = scheduler.submit('dependent', dependent, priority=(0,))
+    recorder.release()
+    assert future.result(TIMEOUT) == 'dependency done'
+    assert queued.result(TIMEOUT) == 'dependency'
+    assert recorder.order == ['dependency']
+
+
+def test_exceptions_are_set_on_the_future(scheduler):
+    def fail():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        scheduler.submit('fail', fail).result(TIMEOUT)
+    # the key is free again
+    assert scheduler.submit('fail', lambda: 'ok').result(TIMEOUT) == 'ok'
+
+
+def test_batches_leave_out_pending_jobs(scheduler, recorder):
+    pending = scheduler.submit('b', recorder.job, 'b')
+    batches = []
+
+    def run_batch(items, suffix):
+        batches.append(items)
+        return [item + suffix for item in items]
+
+    futures = scheduler.submit_batch([('a', 'a'), ('b', 'b'), ('c', 'c')], run_batch, '!')
+    assert futures[1] is pending
+    # later submits of batched keys share the batch's futures
+    assert scheduler.submit('c', recorder.job, 'never') is futures[2]
+    recorder.release()
+    assert [future.result(TIMEOUT) for future in futures] == ['a!', 'b', 'c!']
+    assert batches == [['a', 'c']]
+
+
+def test_workers_claim_the_queued_batch_of_a_job(scheduler, recorder):
+    batch = scheduler.submit_batch([('a', 1), ('b', 2)], lambda items: [item * 10 for item in items])
+
+    def dependent():
+        return scheduler.submit('b', recorder.job, 'never').result(TIMEOUT)
+
+    future = scheduler.submit('dependent', dependent, priority=(0,))
+    recorder.release()
+    assert future.result(TIMEOUT) == 20
+    assert [f.result(TIMEOUT) for f in batch] == [10, 20]
+    assert recorder.order == []
+
+
+def test_batch_failures_are_set_on_every_future(scheduler):
+    def fail(items):
+        raise ValueError('failed')
+
+    futures = scheduler.submit_batch([('a', 1), ('b', 2)], fail)
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(TIMEOUT)
+
+
+def test_batches_must_return_a_result_for_every_item(scheduler):
+    futures = scheduler.submit_batch([('a', 1), ('b', 2)], lambda items: items[:1])
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(TIMEOUT)
+
+
+def test_job_queue_bounds_only_bounded_entries():
+    job_queue = JobQueue(maxsize=1)
+    job_queue.put((1,), 'bounded')
+    # would block if it counted towards the bound
+    job_queue.put((0,), 'unbounded', bounded=False)
+    assert job_queue.get() == 'unbounded'
+
+    put = threading.Thread(target=job_queue.put, args=((1,), 'second'))
+    put.start()
+    put.join(0.1)
+    assert put.is_alive()
+    assert job_queue.get() == 'bounded'
+    put.join(TIMEOUT)
+    assert job_queue.get() == 'second'